@@ -0,0 +1,47 @@
+# Commands of CommandBot and the configuration of AdvanceBot.
+
+import atexit
+import os
+import tempfile
+
+from harness import benchmark
+
+from mumble import AdvanceBot, CommandBot
+from mumble.user import User
+
+class _Bot(CommandBot):
+  def on_bang(self, from_user, *args):
+    pass
+
+def _command_bot():
+  bot = _Bot()
+  bot.state.user = User(bot, 1)
+  sender = User(bot, 2)
+  return bot, sender
+
+@benchmark('commands.on_text_message.command', number = 20000)
+def command():
+  bot, sender = _command_bot()
+  to_users = [bot.state.user]
+  return lambda: bot.on_text_message(
+      sender, to_users, [], [], u'!move "Some User" "Some channel" now')
+
+@benchmark('commands.on_text_message.chat', number = 20000)
+def chat():
+  bot, sender = _command_bot()
+  to_users = [bot.state.user]
+  return lambda: bot.on_text_message(
+      sender, to_users, [], [], u'Hello there, how is it going today?')
+
+@benchmark('config.save_config', number = 500)
+def save_config():
+  bot = AdvanceBot()
+  bot.vars = dict(('var%d' % i, 'value %d' % i) for i in range(100))
+  bot.rights = dict((i, ['get', 'set', 'moveall']) for i in range(500))
+  bot.all_rights = ['get', 'list_var']
+  fd, path = tempfile.mkstemp(suffix = '.cfg')
+  os.close(fd)
+  atexit.register(os.remove, path)
+  def op():
+    bot.save_config(path)
+  return op
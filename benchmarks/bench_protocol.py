@@ -0,0 +1,166 @@
+# Serialization and parsing of messages, and splitting of voice packets.
+
+from harness import benchmark, register
+
+from mumble import mumble_pb2, protocol
+from mumble.connection import BaseConnection
+
+def _message(msg_class, **fields):
+  msg = msg_class()
+  for name, value in fields.items():
+    if isinstance(value, list):
+      getattr(msg, name).extend(value)
+    else:
+      setattr(msg, name, value)
+  return msg
+
+# A typical message of each type a bot sends or receives a lot.
+MESSAGES = [
+  _message(mumble_pb2.Version, version = 66050, release = "1.2.2",
+           os = "Linux", os_version = "3.2"),
+  _message(mumble_pb2.Ping, timestamp = 1380000000000, good = 1000, late = 3,
+           lost = 2, udp_packets = 1000, tcp_packets = 20,
+           udp_ping_avg = 20.5, udp_ping_var = 3.2),
+  _message(mumble_pb2.CryptSetup, key = '\x01' * 16,
+           client_nonce = '\x02' * 16, server_nonce = '\x03' * 16),
+  _message(mumble_pb2.ServerSync, session = 42, max_bandwidth = 72000,
+           welcome_text = "Welcome to the server!", permissions = 0xf07ff),
+  _message(mumble_pb2.ChannelState, channel_id = 12, parent = 3,
+           name = "Some channel", position = 2,
+           description_hash = '\x04' * 20),
+  _message(mumble_pb2.UserState, session = 42, name = "SomeUser",
+           user_id = 1234, channel_id = 12, self_mute = True,
+           comment_hash = '\x05' * 20, hash = 'a' * 40),
+  _message(mumble_pb2.UserRemove, session = 42, actor = 1,
+           reason = "Bye"),
+  _message(mumble_pb2.TextMessage, actor = 42, session = [1, 2],
+           message = "!command with some arguments"),
+  _message(mumble_pb2.UserStats, session = 42, onlinesecs = 3600,
+           idlesecs = 120),
+]
+
+def _serialize_factory(msg):
+  return lambda: lambda: protocol.serialize_(msg)
+
+def _parse_factory(msg):
+  def factory():
+    frame = protocol.serialize_(msg)
+    header, body = frame[:protocol.HEADER_SIZE], frame[protocol.HEADER_SIZE:]
+    return lambda: protocol.parse(header, body)
+  return factory
+
+for _msg in MESSAGES:
+  register('protocol.serialize.%s' % type(_msg).__name__,
+           _serialize_factory(_msg), number = 20000)
+  register('protocol.parse.%s' % type(_msg).__name__,
+           _parse_factory(_msg), number = 20000)
+
+# Voice packet of a user talking: CELT alpha, to the channel, with 3 frames.
+VOICE_PACKET = (chr(0) + protocol.encode_varint(42) +
+                protocol.encode_varint(1000) +
+                ''.join(chr(0x80 | 40) + 'x' * 40 for _ in range(2)) +
+                chr(40) + 'x' * 40)
+
+# Varints of every size, as found in voice headers: sessions, sequences,
+# timestamps of pings.
+VARINTS = [5, 1000, 100000, 20000000, 1380000000, 1380000000000, -3, -1000]
+ENCODED_VARINTS = ''.join(protocol.encode_varint(value) for value in VARINTS)
+
+@benchmark('protocol.varint.encode', number = 10000, units = len(VARINTS))
+def varint_encode():
+  encode = protocol.encode_varint
+  return lambda: [encode(value) for value in VARINTS]
+
+@benchmark('protocol.varint.decode', number = 10000, units = len(VARINTS))
+def varint_decode():
+  decode = protocol.decode_varint
+  def run():
+    offset = 0
+    for _ in VARINTS:
+      offset += decode(ENCODED_VARINTS, offset)[1]
+  return run
+
+@benchmark('protocol.parse_voice_header', number = 50000)
+def parse_voice_header():
+  return lambda: protocol.parse_voice_header(VOICE_PACKET)
+
+class _NullServer(object):
+  def connect(self):
+    return self
+
+  def close(self):
+    pass
+
+class _VoiceDelegate(object):
+  def on_voice_talk(self, session, sequence, frame):
+    pass
+
+class _VoiceFramesDelegate(object):
+  def on_voice_frames(self, session, sequence, target, codec, frames):
+    pass
+
+def _call_voice_factory(delegate):
+  def factory():
+    conn = BaseConnection(_NullServer(), 'bench', delegate = delegate,
+                          udp = False)
+    type, target, session, sequence, header_length = (
+        protocol.parse_voice_header(VOICE_PACKET))
+    return lambda: conn._call_voice('on_voice_talk', type, target, session,
+                                    sequence, VOICE_PACKET, header_length)
+  return factory
+
+register('connection.call_voice', _call_voice_factory(_VoiceDelegate()),
+         number = 50000)
+register('connection.call_voice.frames',
+         _call_voice_factory(_VoiceFramesDelegate()), number = 50000)
+
+# Opus voice packet: one 60 bytes frame.
+OPUS_PACKET = (chr(protocol.VOICE_OPUS << 5) + protocol.encode_varint(42) +
+               protocol.encode_varint(1000) + protocol.encode_varint(60) +
+               'x' * 60)
+
+@benchmark('protocol.iter_voice_frames.opus', number = 50000)
+def iter_voice_frames_opus():
+  header_length = protocol.parse_voice_header(OPUS_PACKET)[4]
+  return lambda: list(protocol.iter_voice_frames(OPUS_PACKET, header_length,
+                                                 protocol.VOICE_OPUS))
+
+# Builders of the frames a bot sends all the time.
+@benchmark('protocol.build.ping', number = 50000)
+def build_ping():
+  return lambda: protocol.ping(1380000000000, good = 1000, late = 3, lost = 2,
+                               udp_packets = 1000, tcp_packets = 20,
+                               udp_ping_avg = 20.5, udp_ping_var = 3.2)
+
+@benchmark('protocol.build.user_stats', number = 50000)
+def build_user_stats():
+  return lambda: protocol.user_stats(4242)
+
+@benchmark('protocol.build.version', number = 50000)
+def build_version():
+  return lambda: protocol.version("hBOT 0.1")
+
+@benchmark('protocol.build.authenticate', number = 50000)
+def build_authenticate():
+  return lambda: protocol.authenticate("-Bot-")
+
+# Frames through the connection handlers: bodies are only parsed when a
+# handler reads them.
+class _StateDelegate(object):
+  def on_user_state(self, msg):
+    return msg.session, msg.channel_id
+
+def _handle_frame_factory(delegate):
+  def factory():
+    conn = BaseConnection(_NullServer(), 'bench', delegate = delegate,
+                          udp = False)
+    frame = protocol.serialize_(MESSAGES[5])
+    msg_type = protocol.HEADER_STRUCT.unpack_from(frame)[0]
+    body = frame[protocol.HEADER_SIZE:]
+    return lambda: conn._handle_frame(msg_type, body)
+  return factory
+
+register('connection.handle_frame.UserState.read',
+         _handle_frame_factory(_StateDelegate()), number = 20000)
+register('connection.handle_frame.UserState.ignored',
+         _handle_frame_factory(None), number = 20000)
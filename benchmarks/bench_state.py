@@ -0,0 +1,95 @@
+# Ingestion of the server state by BotState, at the scale of a large server.
+
+from harness import benchmark
+
+from mumble import Bot, mumble_pb2
+
+USERS = 10000
+CHANNELS = 2000
+
+# Stands in for the connection of the bot, which the state asks for comments,
+# descriptions and stats.
+class _NullConnection(object):
+  def ask_comment_for_user(self, session_id):
+    pass
+  def ask_description_for_channel(self, channel_id):
+    pass
+  def ask_stats_for_user(self, session_id):
+    pass
+
+def _bot():
+  bot = Bot()
+  bot.connection = _NullConnection()
+  return bot
+
+def _channel_states():
+  messages = []
+  msg = mumble_pb2.ChannelState()
+  msg.channel_id = 0
+  msg.parent = 0
+  msg.name = "Root"
+  messages.append(msg)
+  for channel_id in range(1, CHANNELS):
+    msg = mumble_pb2.ChannelState()
+    msg.channel_id = channel_id
+    # A tree with a fan-out of 8.
+    msg.parent = (channel_id - 1) // 8
+    msg.name = "Channel %d" % channel_id
+    msg.description_hash = '%020d' % channel_id
+    messages.append(msg)
+  return messages
+
+def _user_states():
+  messages = []
+  for session in range(1, USERS + 1):
+    msg = mumble_pb2.UserState()
+    msg.session = session
+    msg.name = "User%d" % session
+    if session % 2:
+      msg.user_id = session
+    msg.channel_id = session % CHANNELS
+    msg.comment_hash = '%020d' % session
+    messages.append(msg)
+  return messages
+
+def _load(bot, channels, users):
+  for msg in channels:
+    bot.state.on_channel_state(msg)
+  for msg in users:
+    bot.state.on_user_state(msg)
+
+@benchmark('state.on_channel_state.%d_channels' % CHANNELS, number = 3,
+           units = CHANNELS)
+def channel_states():
+  channels = _channel_states()
+  def op():
+    bot = _bot()
+    for msg in channels:
+      bot.state.on_channel_state(msg)
+  return op
+
+@benchmark('state.on_user_state.join_%d_users' % USERS, number = 3,
+           units = USERS)
+def user_joins():
+  channels = _channel_states()
+  users = _user_states()
+  def op():
+    bot = _bot()
+    for msg in channels:
+      bot.state.on_channel_state(msg)
+    for msg in users:
+      bot.state.on_user_state(msg)
+  return op
+
+@benchmark('state.on_user_state.move_among_%d_users' % USERS, number = 20000)
+def user_moves():
+  bot = _bot()
+  _load(bot, _channel_states(), _user_states())
+  moves = []
+  for i in range(1000):
+    msg = mumble_pb2.UserState()
+    msg.session = (i * 7919) % USERS + 1
+    msg.channel_id = (i * 104729) % CHANNELS
+    moves.append(msg)
+  moves = iter(moves * 1000).next
+  return lambda: bot.state.on_user_state(moves())
@@ -0,0 +1,97 @@
+# Handling of the voice of many speakers at once.
+
+import atexit
+import os
+import shutil
+import tempfile
+
+from harness import benchmark
+
+from mumble import (JitterBuffers, VoiceActivity, VoiceMixer, VoiceRecorder,
+                    mixer, protocol)
+from mumble.player import join_opus_packets, read_ogg_opus
+from mumble.recorder import OggOpusWriter
+
+SPEAKERS = 30
+# A second of 20 ms packets from each speaker, slightly out of order.
+PACKETS = 50
+
+def _arrivals():
+  arrivals = []
+  for i in range(PACKETS):
+    for session in range(1, SPEAKERS + 1):
+      # Swap every fourth packet with the next one.
+      j = i + 1 if i % 4 == 0 else i - 1 if i % 4 == 1 else i
+      arrivals.append((session, j * 2, i * 0.02))
+  return arrivals
+
+@benchmark('voice.jitter', number = 20, units = SPEAKERS * PACKETS)
+def jitter():
+  arrivals = _arrivals()
+  def run():
+    buffers = JitterBuffers(delay = 0.06)
+    tick = 0.0
+    for session, sequence, now in arrivals:
+      buffers.put(session, sequence, None, now)
+      if now >= tick:
+        buffers.release(now)
+        tick = now + buffers.interval
+    buffers.release(now + 1)
+  return run
+
+# 20 ms Opus frame of 60 bytes (CELT, fullband, mono).
+OPUS_FRAME = memoryview(chr(31 << 3) + 'x' * 59)
+
+@benchmark('voice.recorder', number = 10, units = SPEAKERS * PACKETS)
+def recorder():
+  directory = tempfile.mkdtemp()
+  atexit.register(shutil.rmtree, directory, True)
+  def run():
+    recorder = VoiceRecorder(directory)
+    for i in range(PACKETS):
+      for session in range(1, SPEAKERS + 1):
+        recorder.record(session, i * 2, protocol.VOICE_OPUS, [OPUS_FRAME],
+                        now = i * 0.02)
+    recorder.close()
+  return run
+
+# What a player does with each packet: read it from an Ogg Opus file, join it
+# with the next and wrap them in a voice packet.
+@benchmark('voice.player', number = 10, units = SPEAKERS * PACKETS)
+def player():
+  directory = tempfile.mkdtemp()
+  atexit.register(shutil.rmtree, directory, True)
+  path = os.path.join(directory, 'play.opus')
+  writer = OggOpusWriter(path)
+  for i in range(SPEAKERS * PACKETS):
+    writer.write(OPUS_FRAME.tobytes(), 960)
+  writer.close()
+  def run():
+    packets = read_ogg_opus(path)
+    for sequence, first in enumerate(packets):
+      packet = join_opus_packets([first, next(packets, first)])
+      protocol.opus_voice(sequence * 4, packet)
+  return run
+
+# Mixing 20 ms of every speaker into a block, as decoded PCM. Only with NumPy.
+if mixer.numpy is not None:
+  @benchmark('voice.mixer', number = 10, units = SPEAKERS * PACKETS)
+  def voice_mixer():
+    pcm = mixer.numpy.arange(960, dtype = mixer.numpy.int16)
+    def run():
+      voice_mixer = VoiceMixer(max_speakers = SPEAKERS)
+      for i in range(PACKETS):
+        for session in range(1, SPEAKERS + 1):
+          voice_mixer.put_pcm(session, pcm, now = i * 0.02)
+        voice_mixer.mix()
+    return run
+
+@benchmark('voice.activity', number = 20, units = SPEAKERS * PACKETS)
+def activity():
+  def run():
+    activity = VoiceActivity()
+    for i in range(PACKETS):
+      for session in range(1, SPEAKERS + 1):
+        activity.record(session, protocol.VOICE_OPUS, [OPUS_FRAME],
+                        channel_id = session % 3, now = i * 0.02)
+  return run
@@ -0,0 +1,105 @@
+# Registry and runner of the benchmarks.
+#
+# Each benchmark is a factory returning the operation to time, so all the
+# setup stays out of the measure. An operation can stand for several units of
+# work (e.g. a whole server state of messages); rates are in units/second.
+#
+# Allocations are measured on a separate run of the operation: with
+# tracemalloc where available (pytracemalloc on Python 2), the bytes and
+# blocks still allocated afterward and the peak reached, per unit;
+# everywhere, the number of objects tracked by the garbage collector left
+# behind, per unit.
+
+import gc
+import platform
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+BENCHMARKS = []
+
+class Benchmark(object):
+  def __init__(self, name, factory, number, units = 1):
+    """
+    Arguments: name Dotted name, grouping benchmarks by area.
+               factory Returns the operation to time, a callable.
+               number Calls of the operation per timing.
+               units Units of work done by each call.
+    """
+    self.name = name
+    self.factory = factory
+    self.number = number
+    self.units = units
+
+
+def register(name, factory, number, units = 1):
+  BENCHMARKS.append(Benchmark(name, factory, number, units))
+
+# Decorator registering a factory.
+def benchmark(name, number, units = 1):
+  def decorator(factory):
+    register(name, factory, number, units)
+    return factory
+  return decorator
+
+def _time(op, number):
+  started = time.time()
+  for _ in xrange(number):
+    op()
+  return time.time() - started
+
+def _allocations(op, number, units):
+  result = {}
+  gc.collect()
+  objects = len(gc.get_objects())
+  if tracemalloc is not None:
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+  for _ in xrange(number):
+    op()
+  if tracemalloc is not None:
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    result['retained_bytes_per_unit'] = (
+        sum(s.size_diff for s in stats) / float(number * units))
+    result['retained_blocks_per_unit'] = (
+        sum(s.count_diff for s in stats) / float(number * units))
+    result['peak_bytes_per_unit'] = peak / float(number * units)
+  gc.collect()
+  result['retained_objects_per_unit'] = (
+      (len(gc.get_objects()) - objects) / float(number * units))
+  return result
+
+# Run bench, returning a dictionary of its results.
+def run(bench, repeat = 5, scale = 1.0):
+  number = max(1, int(bench.number * scale))
+  op = bench.factory()
+  # Warm up caches and lazy initializations.
+  op()
+  timings = [_time(op, number) for _ in range(repeat)]
+  best = min(timings)
+  result = {
+    'name': bench.name,
+    'number': number,
+    'units': bench.units,
+    'repeat': repeat,
+    'best_seconds': best,
+    'mean_seconds': sum(timings) / len(timings),
+    'ops_per_sec': number * bench.units / best if best > 0 else None,
+  }
+  result.update(_allocations(bench.factory(), number, bench.units))
+  return result
+
+def environment():
+  return {
+    'python': platform.python_version(),
+    'implementation': platform.python_implementation(),
+    'platform': platform.platform(),
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'tracemalloc': tracemalloc is not None,
+  }
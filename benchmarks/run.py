@@ -0,0 +1,70 @@
+#!/bin/python
+#
+# Run the benchmarks and write their results as JSON, to compare releases:
+#   python benchmarks/run.py -o before.json
+#   ... change things ...
+#   python benchmarks/run.py -o after.json -c before.json
+#
+# -k only runs the benchmarks whose name contains the given string, --quick
+# runs fewer iterations for a rough idea.
+
+from optparse import OptionParser
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import harness
+import bench_commands
+import bench_protocol
+import bench_state
+import bench_voice
+
+def compare(results, baseline):
+  previous = dict((r['name'], r) for r in baseline['results'])
+  for result in results:
+    before = previous.get(result['name'])
+    if before is None or not before['ops_per_sec']:
+      continue
+    ratio = result['ops_per_sec'] / before['ops_per_sec']
+    print "%-55s %8.2fx%s" % (result['name'], ratio,
+                              "  <- slower" if ratio < 0.9 else "")
+
+def main(argv):
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("-o", "--output", default = None,
+                    help = "File to write the JSON results to (default: "
+                           "standard output).")
+  parser.add_option("-k", "--filter", default = "",
+                    help = "Only run the benchmarks containing this.")
+  parser.add_option("-r", "--repeat", type = "int", default = 5,
+                    help = "Timings of each benchmark, the best is kept.")
+  parser.add_option("-q", "--quick", action = "store_true", default = False,
+                    help = "Fewer iterations, for a rough idea.")
+  parser.add_option("-c", "--compare", default = None,
+                    help = "JSON results to compare against.")
+  options, args = parser.parse_args(argv[1:])
+  scale = 0.1 if options.quick else 1.0
+  results = []
+  for bench in harness.BENCHMARKS:
+    if options.filter not in bench.name:
+      continue
+    result = harness.run(bench, repeat = options.repeat, scale = scale)
+    sys.stderr.write("%-55s %14.1f ops/s\n" % (bench.name,
+                                              result['ops_per_sec'] or 0))
+    results.append(result)
+  report = {'environment': harness.environment(), 'results': results}
+  if options.output is None:
+    json.dump(report, sys.stdout, indent = 2, sort_keys = True)
+    print
+  else:
+    with open(options.output, 'w') as fout:
+      json.dump(report, fout, indent = 2, sort_keys = True)
+  if options.compare is not None:
+    with open(options.compare, 'r') as fin:
+      compare(results, json.load(fin))
+
+if __name__ == '__main__':
+  main(sys.argv)
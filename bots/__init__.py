@@ -1,2 +1,3 @@
 from echo import EchoBot
+from eve import EveBot
 from interactive import InteractiveBot
@@ -4,41 +4,40 @@
 # This requires admin rights. The bot will set its own comment if it's inactive.
 #
 
-import threading
-import time
-
 import mumble
 
-class WatchDogThread(threading.Thread):
-  def __init__(self, bot):
-    threading.Thread.__init__(self)
-    self.keep_going = True
-    self.__bot = bot
-
-  def run(self):
-    while self.keep_going:
-      # Sleep 30 seconds.
-      time.sleep(30)
-      if self.bot.args['max_idle'] == 0:
-        continue
-      if not self.bot.get_channel_by_id(self.bot.args['afk_channel']):
-        continue
-
-      users = self.__bot.users()
-      for u in users:
-        if u.idlesecs >= self.bot.args['max_idle']:
-          u.move_to(self.__bot.get_channel_by_id(self.bot.args['afk_channel'])
-
 class AfkMoveBot(mumble.CommandBot):
-  def __init__(self, server, name = "EchoBot by HansL"):
-    mumble.CommandBot.__init__(self, server, name = name)
+  # Seconds between two checks of the idle users.
+  CHECK_INTERVAL = 30
+
+  def __init__(self, name = "AfkMoveBot by HansL"):
+    mumble.CommandBot.__init__(self, name = name)
     self.args = {
-      'max_idle': 60
+      'max_idle': 60,
+      'afk_channel': None,
     }
+    self.watchdog = None
 
   def connected(self):
-    self.thread = WatchDogThread(self)
-    self.thread.run()
+    if self.watchdog is None:
+      self.watchdog = self.call_every(self.CHECK_INTERVAL, self.check_idle)
 
   def stopping(self):
-    self.thread.keep_going = False
+    if self.watchdog is not None:
+      self.watchdog.cancel()
+      self.watchdog = None
+
+  def check_idle(self):
+    if self.args['max_idle'] == 0:
+      return
+    afk_channel = self.state.channels_by_id.get(self.args['afk_channel'])
+    if not afk_channel:
+      return
+
+    for u in self.users():
+      if u is self.state.user or u.channel is afk_channel:
+        continue
+      if u.idlesecs >= self.args['max_idle']:
+        u.move_to(afk_channel)
+      # Idle times come with the user stats, refresh them for the next check.
+      self.connection.ask_stats_for_user(u.session)
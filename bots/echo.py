@@ -7,26 +7,18 @@ from optparse import OptionParser
 
 import logging
 import sys
-import threading
-import time
 
 import mumble
 
 class EchoBot(mumble.CommandBot):
-  def __init__(self, server, name = "EchoBot by HansL"):
-    mumble.CommandBot.__init__(self, server, name = name)
+  def __init__(self, name = "EchoBot by HansL"):
+    mumble.CommandBot.__init__(self, name = name)
 
-  # When a text message is receive from user to user, we create a new thread
-  # that waits and send a new message back to the user.
-  def on_message_self(self, from_id, message):
-    bot = self
+  # When a text message is received from user to user, we send it back to
+  # the user after a delay.
+  def on_message_self(self, from_user, message):
     print "Received message: ", message
-    class EchoThread(threading.Thread):
-      def run(self):
-        time.sleep(1)
-        bot.send_message(destination = from_id, message = message)
-    tr = EchoThread()
-    tr.run()
+    self.call_later(1, self.send_message, from_user, message)
 
   def on_command_text(self, from_id, command, args):
     print "Command '%s'('%s')" % (command, args)
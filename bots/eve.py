@@ -1,27 +1,261 @@
 #!/bin/python
 #
-# Simple bot that repeats whatever text message was sent to it after a delay,
-# on a potentially different channel.
+# Bot that eavesdrops on a channel and relays what is said there, voice and
+# text, to another channel, potentially on another server, after a delay.
+#
+#   eve = EveBot(delay = 5)
+#   eve.start(server, "Eve", source_channel = "Lobby",
+#             target_channel = "Delayed")
+#
+# Eve listens from the source channel; a second connection, the relay, talks
+# in the target channel. Voice is relayed as received, without decoding it,
+# one speaker at a time: whoever talks first keeps the floor until their
+# transmission ends.
 #
 
 import logging
-import sys
-import threading
+import math
+import thread
 import time
 
 import mumble
+from mumble import protocol
+from mumble.jitter import SEQUENCE_DURATION
+from mumble.recorder import RESTART_SILENCE
+
+LOGGER = logging.getLogger(__name__)
+
+# Ring of items each due at a given time, released in the order they were
+# put. It holds at most capacity items: once full, the oldest are dropped.
+class DelayRing(object):
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.dropped = 0
+    self.__slots = [None] * capacity
+    self.__head = 0
+    self.__count = 0
+
+  def put(self, due, item):
+    if self.__count == self.capacity:
+      self.__slots[self.__head] = None
+      self.__head = (self.__head + 1) % self.capacity
+      self.__count -= 1
+      self.dropped += 1
+    self.__slots[(self.__head + self.__count) % self.capacity] = (due, item)
+    self.__count += 1
+
+  # The items due at now, in order.
+  def release(self, now):
+    released = []
+    slots = self.__slots
+    while self.__count and slots[self.__head][0] <= now:
+      released.append(slots[self.__head][1])
+      slots[self.__head] = None
+      self.__head = (self.__head + 1) % self.capacity
+      self.__count -= 1
+    return released
+
+  # Time at which the oldest item is due, or None.
+  def next_due(self):
+    if not self.__count:
+      return None
+    return self.__slots[self.__head][0]
+
+  def __len__(self):
+    return self.__count
+
+
+# The connection of Eve talking in the target channel.
+class RelayBot(mumble.Bot):
+  def __init__(self, channel = None, name = "EveBot relay"):
+    mumble.Bot.__init__(self, name)
+    self.channel = channel
+
+  def connected(self):
+    channel = find_channel(self, self.channel)
+    if channel is not None:
+      self.join_channel(channel.id)
+
+  def send_voice(self, packet):
+    connection = self.connection
+    if connection is not None:
+      connection.send_voice(packet)
+
+  def send_channel_message(self, message):
+    connection = self.connection
+    user = self.state.user
+    if connection is not None and user is not None and user.channel:
+      connection.send_channel_message(message, user.channel.id)
+
+
+# The channel of a bot with the given id or name, or None.
+def find_channel(bot, channel):
+  if channel is None:
+    return None
+  for chan in bot.channels():
+    if chan.id == channel or getattr(chan, 'name', None) == channel:
+      return chan
+  LOGGER.warning("No channel %r on %s." % (channel, bot.connection))
+  return None
+
+
+class EveBot(mumble.Bot):
+  # Packets held for each second of delay: clients send a packet every
+  # 10 ms at most.
+  PACKETS_PER_SECOND = int(1 / SEQUENCE_DURATION)
+  # Room for the text messages, and for what a burst of late packets adds.
+  SLACK = 64
+
+  def __init__(self, delay = 0.0, name = "EveBot by HansL"):
+    """
+    Arguments: delay Seconds between what is said in the source channel and
+                     its replay in the target channel. With no delay, voice
+                     is relayed as soon as it arrives.
+    """
+    mumble.Bot.__init__(self, name)
+    self.delay = delay
+    self.relay = None
+    self.source_channel = None
+    self.__same_server = True
+    self.mutex = thread.allocate_lock()
+    self.__ring = DelayRing(int(math.ceil(delay * self.PACKETS_PER_SECOND)) +
+                            self.SLACK)
+    self.__timer = None
+    # Speaker relayed, and when their transmission started: source sequence
+    # number, due time, and the sequence number it has in the relay.
+    self.__floor = None
+    self.__last_arrival = None
+    self.__base = None
+    self.__sequence = 0
+
+  # Listen in source_channel of server, and relay to target_channel of
+  # target_server (the same server by default), as target_nickname.
+  def start(self, server, nickname, source_channel = None,
+                  target_channel = None, target_server = None,
+                  target_nickname = None):
+    self.__setup(server, source_channel, target_channel, target_server)
+    self.relay.start(target_server or server,
+                     target_nickname or nickname + "-relay")
+    mumble.Bot.start(self, server, nickname)
+
+  # Same as start(), with both connections served by mumble.loop().
+  def start_async(self, server, nickname, source_channel = None,
+                        target_channel = None, target_server = None,
+                        target_nickname = None, socket_map = None):
+    self.__setup(server, source_channel, target_channel, target_server)
+    self.relay.start_async(target_server or server,
+                           target_nickname or nickname + "-relay",
+                           socket_map = socket_map)
+    mumble.Bot.start_async(self, server, nickname, socket_map = socket_map)
+
+  def stop(self):
+    mumble.Bot.stop(self)
+    if self.relay is not None:
+      self.relay.stop()
+
+  def connected(self):
+    channel = find_channel(self, self.source_channel)
+    if channel is not None:
+      self.join_channel(channel.id)
+
+  # Packets and messages waiting for their turn.
+  def pending(self):
+    self.mutex.acquire()
+    try:
+      return len(self.__ring)
+    finally:
+      self.mutex.release()
+
+  def on_message_channels(self, from_user, to_channels, message):
+    user = self.state.user
+    if (user is None or user.channel not in to_channels or
+        self.__from_relay(from_user)):
+      return
+    name = from_user.name if from_user is not None else "?"
+    self.__relay(time.time() + self.delay, (None, "%s: %s" % (name, message)))
+
+  def on_voice_frames(self, from_user, sequence, target, codec, frames):
+    if (from_user is None or codec == protocol.VOICE_PING or
+        self.__from_relay(from_user)):
+      return
+    now = time.time()
+    self.mutex.acquire()
+    try:
+      item = self.__voice(from_user.session, sequence, codec, frames, now)
+    finally:
+      self.mutex.release()
+    if item is None:
+      return
+    if not self.delay:
+      self.relay.send_voice(item[1])
+    else:
+      self.__relay(item[0], (item[1], None))
+
+  ##############################################################################
+  # Private.
+  def __setup(self, server, source_channel, target_channel, target_server):
+    self.source_channel = source_channel
+    self.relay = RelayBot(target_channel)
+    self.__same_server = target_server is None or (
+        (target_server.hostname, target_server.port) ==
+        (server.hostname, server.port))
 
-class EveBot(mumble.CommandBot):
-  def __init__(self, server, name = "EchoBot by HansL"):
-    mumble.CommandBot.__init__(self, server, name = name)
-    self.relays = {}
+  # Whether user is the relay, heard when it talks where Eve listens: relaying
+  # it again would loop.
+  def __from_relay(self, user):
+    if not self.__same_server:
+      return False
+    relay = self.relay.state.user
+    return relay is not None and user.session == relay.session
 
-  def start(self, server, nickname, prefix_relay):
-    
+  # The due time and relayed packet of a voice packet, or None if someone
+  # else has the floor.
+  def __voice(self, session, sequence, codec, frames, now):
+    if self.__floor != session:
+      if (self.__floor is not None and
+          now - self.__last_arrival < RESTART_SILENCE):
+        return None
+      self.__floor = session
+      self.__base = None
+    elif self.__base is not None and (sequence < self.__base[0] or
+        now - self.__last_arrival >= RESTART_SILENCE):
+      # A new transmission of the same speaker.
+      self.__base = None
+    if self.__base is None:
+      self.__base = (sequence, now + self.delay, self.__sequence)
+    base_sequence, base_due, base_relayed = self.__base
+    offset = sequence - base_sequence
+    self.__last_arrival = now
+    relayed = base_relayed + offset
+    self.__sequence = max(self.__sequence, relayed + 1)
+    if frames and not len(frames[-1]):
+      # End of the transmission: the floor is free.
+      self.__floor = None
+    packet = protocol.voice_packet(codec, relayed,
+                                   [frame.tobytes() for frame in frames])
+    return base_due + offset * SEQUENCE_DURATION, packet
 
-  def on_command_text(self, from_id, command, args):
-    print "Command '%s'('%s')" % (command, args)
-    return True  # Do not echo.
+  def __relay(self, due, item):
+    self.mutex.acquire()
+    try:
+      self.__ring.put(due, item)
+      if self.__timer is None:
+        self.__timer = self.timers.call_at(self.__ring.next_due(),
+                                           self.__release)
+    finally:
+      self.mutex.release()
 
-  def on_voice_talk(self, from_id, sequence, data):
-    print "Received voice: %d bytes" % len(data)
+  def __release(self):
+    self.mutex.acquire()
+    try:
+      released = self.__ring.release(time.time())
+      due = self.__ring.next_due()
+      self.__timer = (None if due is None else
+                      self.timers.call_at(due, self.__release))
+    finally:
+      self.mutex.release()
+    for packet, message in released:
+      if packet is not None:
+        self.relay.send_voice(packet)
+      else:
+        self.relay.send_channel_message(message)
@@ -1,4 +1,16 @@
+from activity import VoiceActivity
+from async_connection import AsyncConnection, loop
+from capture import CaptureWriter, ReplayConnection, read_capture
 from connection import Connection
+from executor import SessionExecutor
+from jitter import JitterBuffers
+from mixer import VoiceMixer
+from player import VoicePlayer
+from reactor import Reactor
+from ratelimit import RateLimiter
+from recorder import VoiceRecorder
+from reconnect import ReconnectPolicy
+from scheduler import Scheduler
 from server import Server
 from bot import Bot
 from command_bot import CommandBot
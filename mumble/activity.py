@@ -0,0 +1,251 @@
+# Who talks, how much, and where: voice activity of each user and channel,
+# from the voice packets a bot hears.
+#
+#   bot.activity = mumble.VoiceActivity()
+#   ...
+#   bot.activity.user(user.session).talk_time
+#   bot.activity.channel(channel.id).speakers
+#
+# Every packet costs the same whatever the history: the counters are arrays
+# of fixed size, allocated once per user and channel, and used as rings.
+
+from array import array
+import thread
+import time
+
+from jitter import SEQUENCE_DURATION
+from recorder import SAMPLE_RATE, opus_samples
+import protocol
+
+# What a user or channel said, as of a query.
+class ActivityStats(object):
+  def __init__(self):
+    # Seconds of voice.
+    self.talk_time = 0.0
+    self.frames = 0
+    # Frames of each of the last seconds, oldest first.
+    self.frames_per_second = []
+    # Talk spurts, the current one included, and the average length of the
+    # last ones and of the silences between them, in seconds.
+    self.spurts = 0
+    self.mean_spurt = 0.0
+    self.mean_gap = 0.0
+    self.talking = False
+    # For channels, the seconds each session talked there.
+    self.speakers = {}
+
+  def __repr__(self):
+    return ("ActivityStats(talk_time=%.1fs, frames=%d, spurts=%d, "
+            "mean_spurt=%.2fs, mean_gap=%.2fs, talking=%s)" % (
+            self.talk_time, self.frames, self.spurts, self.mean_spurt,
+            self.mean_gap, self.talking))
+
+
+# Frames per second over the last window seconds: a ring of counts, each
+# slot tagged with the second it counts so stale ones read as zero.
+class _Window(object):
+  def __init__(self, window):
+    self.counts = array('i', [0]) * window
+    self.seconds = array('l', [-1]) * window
+
+  def add(self, second, frames):
+    index = second % len(self.counts)
+    if self.seconds[index] != second:
+      self.seconds[index] = second
+      self.counts[index] = frames
+    else:
+      self.counts[index] += frames
+
+  def last(self, second):
+    window = len(self.counts)
+    rates = []
+    for s in xrange(second - window + 1, second + 1):
+      index = s % window
+      rates.append(self.counts[index] if self.seconds[index] == s else 0)
+    return rates
+
+
+# Activity of a user: totals, frames per second, and the lengths of the last
+# history spurts and gaps in rings.
+class _User(object):
+  def __init__(self, window, history):
+    self.talk_time = 0.0
+    self.frames = 0
+    self.rates = _Window(window)
+    self.spurts = 0
+    self.spurt_start = None
+    self.spurt_end = None
+    self.last_arrival = None
+    self.spurt_lengths = array('d', [0.0]) * history
+    self.gaps = array('d', [0.0]) * history
+    self.gap_count = 0
+    self.channel_id = None
+
+  def end_spurt(self):
+    if self.spurt_start is None:
+      return
+    history = len(self.spurt_lengths)
+    self.spurt_lengths[(self.spurts - 1) % history] = (self.spurt_end -
+                                                       self.spurt_start)
+    self.spurt_start = None
+
+
+# Activity of a channel: totals, frames per second and talk time by session.
+class _Channel(object):
+  def __init__(self, window):
+    self.talk_time = 0.0
+    self.frames = 0
+    self.rates = _Window(window)
+    self.speakers = {}
+
+
+# Tracks the voice activity of each session, and of each channel they talk
+# in. A talk spurt ends with the transmission, or after spurt_gap seconds
+# without voice.
+class VoiceActivity(object):
+  def __init__(self, window = 60, history = 32, spurt_gap = 0.5):
+    """
+    Arguments: window Seconds of frames per second kept.
+               history Spurts and gaps kept for their mean lengths.
+               spurt_gap Seconds of silence ending a spurt that the speaker
+                         didn't end.
+    """
+    self.window = window
+    self.history = history
+    self.spurt_gap = spurt_gap
+    self.mutex = thread.allocate_lock()
+    self.__users = {}
+    self.__channels = {}
+
+  # Count the frames of a voice packet of session, sent from channel_id.
+  def record(self, session, codec, frames, channel_id = None, now = None):
+    if now is None:
+      now = time.time()
+    duration = 0.0
+    count = 0
+    for frame in frames:
+      if len(frame):
+        count += 1
+        duration += _duration(codec, frame)
+    ended = bool(frames) and not len(frames[-1])
+    second = int(now)
+    self.mutex.acquire()
+    try:
+      user = self.__users.get(session)
+      if user is None:
+        user = self.__users[session] = _User(self.window, self.history)
+      if count:
+        if (user.spurt_start is not None and
+            now - user.last_arrival > self.spurt_gap):
+          user.end_spurt()
+        if user.spurt_start is None:
+          if user.spurt_end is not None:
+            user.gaps[user.gap_count % self.history] = now - user.spurt_end
+            user.gap_count += 1
+          user.spurts += 1
+          user.spurt_start = now
+        user.spurt_end = now + duration
+        user.last_arrival = now
+        user.talk_time += duration
+        user.frames += count
+        user.rates.add(second, count)
+        user.channel_id = channel_id
+        if channel_id is not None:
+          channel = self.__channels.get(channel_id)
+          if channel is None:
+            channel = self.__channels[channel_id] = _Channel(self.window)
+          channel.talk_time += duration
+          channel.frames += count
+          channel.rates.add(second, count)
+          channel.speakers[session] = (channel.speakers.get(session, 0.0) +
+                                       duration)
+      if ended:
+        user.end_spurt()
+    finally:
+      self.mutex.release()
+
+  # ActivityStats of session, or None if it never talked.
+  def user(self, session, now = None):
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      user = self.__users.get(session)
+      if user is None:
+        return None
+      stats = ActivityStats()
+      stats.talk_time = user.talk_time
+      stats.frames = user.frames
+      stats.frames_per_second = user.rates.last(int(now))
+      stats.spurts = user.spurts
+      stats.talking = (user.spurt_start is not None and
+                       now - user.last_arrival <= self.spurt_gap)
+      ended = user.spurts - (1 if user.spurt_start is not None else 0)
+      stats.mean_spurt = _mean(user.spurt_lengths, ended)
+      stats.mean_gap = _mean(user.gaps, user.gap_count)
+      return stats
+    finally:
+      self.mutex.release()
+
+  # ActivityStats of the voice heard in channel_id, or None. Its speakers
+  # tell how long each session talked there.
+  def channel(self, channel_id, now = None):
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      channel = self.__channels.get(channel_id)
+      if channel is None:
+        return None
+      stats = ActivityStats()
+      stats.talk_time = channel.talk_time
+      stats.frames = channel.frames
+      stats.frames_per_second = channel.rates.last(int(now))
+      stats.speakers = dict(channel.speakers)
+      stats.talking = any(
+          user.channel_id == channel_id and user.spurt_start is not None and
+          now - user.last_arrival <= self.spurt_gap
+          for user in (self.__users.get(s) for s in channel.speakers)
+          if user is not None)
+      return stats
+    finally:
+      self.mutex.release()
+
+  # Sessions by seconds talked, most first.
+  def top(self, count = None):
+    self.mutex.acquire()
+    try:
+      ranking = sorted(self.__users, key = lambda s: -self.__users[s].talk_time)
+    finally:
+      self.mutex.release()
+    return ranking[:count] if count is not None else ranking
+
+  # Forget a user, e.g. once they left.
+  def remove(self, session):
+    self.mutex.acquire()
+    try:
+      self.__users.pop(session, None)
+      for channel in self.__channels.values():
+        channel.speakers.pop(session, None)
+    finally:
+      self.mutex.release()
+
+
+# Seconds of audio of a frame.
+def _duration(codec, frame):
+  if codec == protocol.VOICE_OPUS:
+    try:
+      return float(opus_samples(frame)) / SAMPLE_RATE
+    except IndexError:
+      return 0.0
+  # CELT and Speex frames hold 10 ms.
+  return SEQUENCE_DURATION
+
+# Mean of the last count values of a ring.
+def _mean(ring, count):
+  count = min(count, len(ring))
+  if not count:
+    return 0.0
+  if count == len(ring):
+    return sum(ring) / count
+  return sum(ring[:count]) / count
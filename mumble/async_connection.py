@@ -0,0 +1,221 @@
+import asyncore
+import logging
+import os
+import select
+import socket
+import thread
+import threading
+import time
+
+from connection import BaseConnection, wakeup_pipe
+from scheduler import Scheduler
+
+LOGGER = logging.getLogger(__name__)
+
+# A connection driven by a loop shared with other connections, instead of a
+# thread of its own. Any number of AsyncConnection can live in the same
+# socket map; loop() then serves all of them from the calling thread, only
+# waking up for incoming data or when a timer (a ping, for one) is due.
+# Other threads can send, add timers or stop it: they wake the loop up.
+class AsyncConnection(BaseConnection, asyncore.dispatcher):
+  def __init__(self, server, nickname, password = None, version = "hBOT 0.1",
+                     delegate = None, socket_map = None, udp = True,
+                     timers = None, limiter = None, capture = None):
+    self.__waker = None
+    BaseConnection.__init__(self, server, nickname, password = password,
+                            version = version, delegate = delegate, udp = udp,
+                            timers = timers, limiter = limiter,
+                            capture = capture)
+    asyncore.dispatcher.__init__(self, self.socket, map = socket_map)
+    self.__udp_dispatcher = None
+    self.__done = threading.Event()
+    _WAKERS_MUTEX.acquire()
+    try:
+      self.__waker = _waker(self._map)
+    finally:
+      _WAKERS_MUTEX.release()
+
+  def stop(self):
+    BaseConnection.stop(self)
+    if self.__udp_dispatcher is not None:
+      self.__udp_dispatcher.del_channel()
+    self.del_channel()
+    self._close()
+    self.__done.set()
+    # A loop blocked on this connection alone stops blocking.
+    self._wake()
+
+  # Wait until the connection is closed. Not from the thread running loop(),
+  # which would then wait for itself.
+  def join(self, timeout = None):
+    self.__done.wait(timeout)
+
+  def _wake(self):
+    # Not before it's in the socket map, the loop has nothing to wake up for.
+    if self.__waker is not None:
+      self.__waker.wake()
+
+  ##############################################################################
+  # asyncore.dispatcher events.
+  def readable(self):
+    return self.keep_going
+
+  def writable(self):
+    return bool(self.outbound)
+
+  def handle_read(self):
+    if not self._handle_read():
+      self.handle_close()
+    elif self.udp is not None and self.__udp_dispatcher is None:
+      # The CryptSetup just set up UDP voice.
+      self.__udp_dispatcher = _UdpDispatcher(self, self._map)
+
+  def handle_write(self):
+    self.outbound.flush(self.socket)
+
+  def handle_close(self):
+    self._call("on_socket_error")
+    self.stop()
+
+  def handle_error(self):
+    LOGGER.exception("Error while handling the connection to %s." %
+                     self.server)
+    self._call("on_socket_exception", None)
+    self.stop()
+
+
+# Serves the UDP voice socket of an AsyncConnection on the same loop.
+class _UdpDispatcher(asyncore.dispatcher):
+  def __init__(self, conn, socket_map):
+    asyncore.dispatcher.__init__(self, map = socket_map)
+    self.conn = conn
+    self.set_socket(conn.udp.socket, socket_map)
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.conn._handle_udp_read()
+    except socket.error as msg:
+      LOGGER.warning("UDP voice failed, using TCP only: %s" % msg)
+      self.del_channel()
+      self.conn.udp.close()
+      self.conn.udp = None
+
+
+# Wakes loop() up from other threads, and runs the timers of its socket map
+# that belong to no connection, e.g. those of bots waiting to reconnect. There
+# is one per socket map, made when first needed.
+class _Waker(asyncore.file_dispatcher):
+  def __init__(self, socket_map):
+    self.timers = Scheduler(wake = self.wake)
+    # Thread running loop(), which needs no waking up.
+    self.loop_thread = None
+    # Once closed, the fd may be reused by anything, so writes check under
+    # the mutex.
+    self.__mutex = thread.allocate_lock()
+    self.__closed = False
+    read_fd, self.__write_fd = wakeup_pipe()
+    # The dispatcher reads a copy of read_fd.
+    asyncore.file_dispatcher.__init__(self, read_fd, map = socket_map)
+    os.close(read_fd)
+
+  def wake(self):
+    if thread.get_ident() == self.loop_thread:
+      return
+    self.__mutex.acquire()
+    try:
+      if self.__closed:
+        return
+      try:
+        os.write(self.__write_fd, 'w')
+      except OSError:
+        # The pipe is full: the loop has enough to wake up for.
+        pass
+    finally:
+      self.__mutex.release()
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      os.read(self._fileno, 4096)
+    except OSError:
+      pass
+
+  def close(self):
+    self.__mutex.acquire()
+    try:
+      if not self.__closed:
+        self.__closed = True
+        os.close(self.__write_fd)
+    finally:
+      self.__mutex.release()
+    asyncore.file_dispatcher.close(self)
+
+_WAKERS_MUTEX = thread.allocate_lock()
+
+# The _Waker of socket_map, made if it has none. Call with _WAKERS_MUTEX held.
+def _waker(socket_map):
+  for dispatcher in socket_map.values():
+    if isinstance(dispatcher, _Waker):
+      return dispatcher
+  return _Waker(socket_map)
+
+# Call func(*args) in delay seconds from loop(socket_map) (asyncore's global
+# map by default), even if no connection is left in it then: the loop keeps
+# going until it's done. Returns a Timer that can be cancel()ed.
+def call_later(socket_map, delay, func, *args):
+  if socket_map is None:
+    socket_map = asyncore.socket_map
+  _WAKERS_MUTEX.acquire()
+  try:
+    return _waker(socket_map).timers.call_later(delay, func, *args)
+  finally:
+    _WAKERS_MUTEX.release()
+
+# Serve all the AsyncConnection in socket_map (asyncore's global map by
+# default) until every one of them is stopped, and no call_later() is left to
+# run.
+def loop(socket_map = None):
+  if socket_map is None:
+    socket_map = asyncore.socket_map
+  poll = asyncore.poll2 if hasattr(select, 'poll') else asyncore.poll
+  while True:
+    _WAKERS_MUTEX.acquire()
+    try:
+      waker = _waker(socket_map)
+      waker.loop_thread = thread.get_ident()
+      if len(socket_map) == 1 and not len(waker.timers):
+        waker.close()
+        return True
+    finally:
+      _WAKERS_MUTEX.release()
+    now = time.time()
+    timeout = waker.timers.timeout(now)
+    connections = [c for c in socket_map.values()
+                   if isinstance(c, AsyncConnection)]
+    for conn in connections:
+      conn_timeout = conn._timeout(now)
+      if conn_timeout is not None and (timeout is None or
+                                       conn_timeout < timeout):
+        timeout = conn_timeout
+    try:
+      poll(timeout, socket_map)
+    except socket.error as msg:
+      LOGGER.error("Socket error in the connection loop: %s" % msg)
+      for conn in connections:
+        conn._call("on_socket_exception", msg)
+        conn.stop()
+      # Nothing is left to run what was scheduled.
+      _WAKERS_MUTEX.acquire()
+      try:
+        waker.close()
+      finally:
+        _WAKERS_MUTEX.release()
+      return False
+    for conn in connections:
+      conn._run_timers()
+    waker.timers.run_due(time.time())
@@ -1,8 +1,17 @@
 import logging
+import socket
+import threading
+import time
 
+from async_connection import AsyncConnection
+import async_connection
+from capture import ReplayConnection
 from channel import Channel
 from connection import Connection
 from permissions import Permissions
+from player import VoicePlayer
+from ratelimit import RateLimiter
+from scheduler import Scheduler
 from user import User
 
 LOGGER = logging.getLogger(__name__)
@@ -23,6 +32,9 @@ class BotState(object):
     self.user = None
     # The current channel the bot is in.
     self.channel = None
+    # What we knew before losing the connection, while resynchronizing with
+    # the server after reconnecting. None otherwise.
+    self.resync = None
 
   def get_actor(self, session_id):
     if not session_id in self.users_by_session:
@@ -38,6 +50,35 @@ class BotState(object):
     else:
       return self.channels_by_id[chan_id]
 
+  # Called when the connection is lost. Everything known is kept, but flagged
+  # as stale until the server tells us about it again.
+  def begin_resync(self):
+    if self.resync is None:
+      self.resync = Resync(self)
+    else:
+      # Lost it again before syncing, start over.
+      self.resync.restart()
+    self.users_by_session = {}
+    self.user = None
+
+  # Called on ServerSync after a reconnection. Drops whatever the server
+  # didn't mention again and returns the ResyncDiff of what changed.
+  def end_resync(self):
+    resync, self.resync = self.resync, None
+    return resync.finish()
+
+  def on_connecting(self, connection):
+    # The messages may come before the bot is done creating the connection.
+    self.bot._connecting(connection)
+
+  def on_socket_error(self):
+    LOGGER.warning('Lost the connection to the server.')
+    self.bot.disconnected()
+
+  def on_socket_exception(self, error):
+    LOGGER.warning('Lost the connection to the server: %s' % error)
+    self.bot.disconnected()
+
   def on_version(self, msg):
     self.version = msg.version
     self.release = msg.release
@@ -45,16 +86,14 @@ class BotState(object):
     self.os_version = msg.os_version
 
   def on_voice_ping(self, session_id):
-    self.bot.on_voice_ping(session_id)
+    self.bot._dispatch(None, self.bot.on_voice_ping, session_id)
 
-  def on_voice_talk(self, from_id, sequence, data):
-    self.bot.on_voice_talk(self.get_actor(from_id), sequence, data)
-
-  def on_voice_whisper_chan(self, from_id, sequence, data):
-    pass
-
-  def on_voice_whisper_self(self, from_id, sequence, data):
-    pass
+  # One event per packet, whatever the number of frames.
+  def on_voice_frames(self, from_id, sequence, target, codec, frames):
+    if self.bot.jitter is not None:
+      self.bot._buffer_voice(from_id, sequence, target, codec, frames)
+    else:
+      self.bot._voice_frames(from_id, sequence, target, codec, frames)
 
   def on_pingback(self, ping_msec, msg):
     self.ping = ping_msec
@@ -79,9 +118,15 @@ class BotState(object):
         self.permissions = Permissions(msg.permissions)
       else:
         self.permissions.update(msg.permissions)
-    self.bot.connected()
+    if msg.session in self.users_by_session:
+      self.user = self.users_by_session[msg.session]
+    if self.resync is not None:
+      self.bot.reconnected(self.end_resync())
+    self.bot._dispatch(None, self.bot.connected)
 
   def on_channel_state(self, msg):
+    if self.resync is not None:
+      self.resync.seen_channel(msg.channel_id)
     if msg.channel_id not in self.channels_by_id:
       chan = Channel(self.bot, msg.channel_id)
       self.channels_by_id[msg.channel_id] = chan
@@ -108,9 +153,15 @@ class BotState(object):
 
   def on_user_state(self, msg):
     if msg.session not in self.users_by_session:
-      user = User(self.bot, msg.session)
+      user = None
+      if self.resync is not None:
+        # Sessions don't survive a reconnection; find the user we knew by
+        # other means, and keep using the same object.
+        user = self.resync.claim_user(msg)
+      if user is None:
+        user = User(self.bot, msg.session)
       self.users_by_session[msg.session] = user
-      if msg.user_id is not None:
+      if msg.HasField('user_id'):
         self.users_by_id[msg.user_id] = user
     else:
       user = self.users_by_session[msg.session]
@@ -118,14 +169,32 @@ class BotState(object):
     if self.user is None:
       self.user = user
 
+  def on_user_remove(self, msg):
+    user = self.users_by_session.pop(msg.session, None)
+    if user is None:
+      return
+    if user.channel is not None:
+      user.channel.remove_user(user)
+      user.channel = None
+    if user.id is not None and self.users_by_id.get(user.id) is user:
+      del self.users_by_id[user.id]
+    if self.bot.jitter is not None:
+      self.bot.jitter.remove(msg.session)
+    if self.bot.recorder is not None:
+      self.bot.recorder.close(msg.session)
+    if self.bot.mixer is not None:
+      self.bot.mixer.remove(msg.session)
+    if self.bot.activity is not None:
+      self.bot.activity.remove(msg.session)
+
   def on_text_message(self, msg):
-    self.bot.on_text_message(from_user = self.get_actor(msg.actor),
-                             to_users = [self.get_actor(x)
-                                 for x in msg.session],
-                             to_channels = [self.get_channel(x)
-                                 for x in msg.channel_id],
-                             tree_ids = msg.tree_id,
-                             message = "%s" % msg.message)
+    self.bot._dispatch(msg.actor, self.bot.on_text_message,
+                       from_user = self.get_actor(msg.actor),
+                       to_users = [self.get_actor(x) for x in msg.session],
+                       to_channels = [self.get_channel(x)
+                           for x in msg.channel_id],
+                       tree_ids = list(msg.tree_id),
+                       message = "%s" % msg.message)
 
   def on_crypt_setup(self, msg):
     pass
@@ -135,32 +204,282 @@ class BotState(object):
     self.users_by_session[msg.session].update_stats(msg)
 
   def on_unknown(self, type, msg):
-    LOGGER.warning("Unknown message received: type(%s), '%s'" % (type, msg))
+    # The type is enough; printing msg would parse it.
+    LOGGER.warning("Unknown message received: type(%s)" % type.__name__)
+
+# What changed on the server while a bot was disconnected, once it synced
+# again. Users and channels that are still there are the same objects as
+# before the disconnection.
+class ResyncDiff(object):
+  def __init__(self):
+    self.users_joined = []
+    self.users_left = []
+    # List of (user, previous channel).
+    self.users_moved = []
+    self.channels_added = []
+    self.channels_removed = []
+
+  def __nonzero__(self):
+    return bool(self.users_joined or self.users_left or self.users_moved or
+                self.channels_added or self.channels_removed)
+
+
+# Bookkeeping of BotState while it resyncs after a reconnection.
+class Resync(object):
+  def __init__(self, state):
+    self.state = state
+    self.known_channel_ids = set(state.channels_by_id)
+    self.stale_channels = set(self.known_channel_ids)
+    # Users we knew, not matched yet to a new session. Registered users are
+    # found by id, the others by name.
+    self.stale_by_id = {}
+    self.stale_by_name = {}
+    self.previous_channel = {}
+    self.claimed = []
+    for user in state.users_by_session.values():
+      if user.id is not None:
+        self.stale_by_id[user.id] = user
+      else:
+        self.stale_by_name[getattr(user, 'name', None)] = user
+      self.previous_channel[user] = user.channel
+      # Channels index users by session, which the server is about to reuse
+      # for other people.
+      if user.channel is not None:
+        user.channel.remove_user(user)
+        user.channel = None
+
+  # Flag again as stale everything seen since the reconnection.
+  def restart(self):
+    self.stale_channels = set(self.state.channels_by_id)
+    for user in self.state.users_by_session.values():
+      if user.channel is not None:
+        user.channel.remove_user(user)
+        user.channel = None
+      if user not in self.previous_channel:
+        # Someone we met during the failed attempt, simply forget them.
+        if self.state.users_by_id.get(user.id) is user:
+          del self.state.users_by_id[user.id]
+      elif user.id is not None:
+        self.stale_by_id[user.id] = user
+      else:
+        self.stale_by_name[getattr(user, 'name', None)] = user
+    self.claimed = []
+
+  def seen_channel(self, channel_id):
+    self.stale_channels.discard(channel_id)
+
+  # Returns the known User matching msg, rebound to its new session, or None
+  # if it's someone we didn't know.
+  def claim_user(self, msg):
+    user = None
+    if msg.HasField('user_id'):
+      user = self.stale_by_id.pop(msg.user_id, None)
+    if user is None and msg.name:
+      user = self.stale_by_name.pop(msg.name, None)
+    if user is None:
+      return None
+    user.session = msg.session
+    self.claimed.append(user)
+    return user
+
+  def finish(self):
+    state = self.state
+    diff = ResyncDiff()
+    claimed = set(self.claimed)
+    for user in state.users_by_session.values():
+      if user not in claimed:
+        diff.users_joined.append(user)
+      elif self.previous_channel[user] is not user.channel:
+        diff.users_moved.append((user, self.previous_channel[user]))
+    for user in self.stale_by_id.values() + self.stale_by_name.values():
+      if user.id is not None and state.users_by_id.get(user.id) is user:
+        del state.users_by_id[user.id]
+      diff.users_left.append(user)
+    for chan_id in self.stale_channels:
+      chan = state.channels_by_id.pop(chan_id)
+      if chan.parent is not None:
+        chan.parent.remove_child(chan)
+      if chan_id in self.known_channel_ids:
+        diff.channels_removed.append(chan)
+    diff.channels_added = [c for c in state.channels_by_id.values()
+                           if c.id not in self.known_channel_ids]
+    return diff
+
 
 # The root class of any bots. This provides more utility over connection and
 # keep the bot state. It also builds the BotState for the connection for you,
 # so you don't have to (ain't that nice).
 class Bot(object):
-  def __init__(self, version = "HansBot"):
+  # reconnect is a ReconnectPolicy to reconnect when the connection drops, or
+  # None to stay disconnected. It can also be set later on.
+  # executor is a SessionExecutor running the events (messages, voice,
+  # connected and on_resync), so a slow handler doesn't hold up the
+  # connection. Events from the same user still run one at a time, in order.
+  # Without one, events run on the thread serving the connection.
+  def __init__(self, version = "HansBot", reconnect = None, executor = None):
     self.version = version
     self.state = BotState(self)
     self.connection = None
+    self.reconnect = reconnect
+    self.executor = executor
+    # Timers of the bot, run by the loop of its connection.
+    self.timers = Scheduler()
+    # Rate limits of the text messages and state changes sent by the bot.
+    self.limiter = RateLimiter()
+    # CaptureWriter recording the frames of the next connections, if any.
+    self.capture = None
+    # JitterBuffers reordering the voice of each speaker before the voice
+    # events, if any. Set it before the voice starts.
+    self.jitter = None
+    self.__jitter_timer = None
+    # VoiceRecorder recording what the bot hears, if any. Closing it is up to
+    # whoever set it.
+    self.recorder = None
+    self.__recorder_timer = None
+    # VoiceMixer mixing the voice of all the speakers for on_voice_mix, if
+    # any.
+    self.mixer = None
+    self.__mixer_timer = None
+    # VoiceActivity counting who talks how much, and where, if any.
+    self.activity = None
+    # VoicePlayer playing, and sequence number of the next voice packet: it
+    # keeps growing from one playback to the next.
+    self.__player = None
+    self.__voice_sequence = 0
+    # How to connect again: (server, nickname, connection factory,
+    # call_later scheduling the reconnections or None).
+    self.__target = None
+    self.__attempts = 0
+    self.__reconnect_timer = None
+    # Set once the reconnection scheduled has been attempted, or cancelled.
+    self.__reconnect_attempted = None
+    # (message type, handler) subscribed to on every connection.
+    self.__subscriptions = []
+
+  # Connect to the server. The connection runs on a thread of its own, unless
+  # a mumble.Reactor is passed, in which case the reactor's thread serves it
+  # along with the other connections attached to it.
+  def start(self, server, nickname, reactor = None):
+    if reactor is None:
+      factory = lambda: Connection(server, nickname, delegate = self.state,
+                                   version = self.version,
+                                   timers = self.timers,
+                                   limiter = self.limiter,
+                                   capture = self.capture)
+    else:
+      factory = lambda: reactor.connect(server, nickname,
+                                        delegate = self.state,
+                                        version = self.version,
+                                        timers = self.timers,
+                                        limiter = self.limiter,
+                                        capture = self.capture)
+    self.__start(server, nickname, factory)
+
+  # Same as start(), but the connection is served by mumble.loop() with all
+  # the other bots sharing socket_map, instead of a thread of its own. So are
+  # the reconnections.
+  def start_async(self, server, nickname, socket_map = None):
+    factory = lambda: AsyncConnection(server, nickname, delegate = self.state,
+                                      version = self.version,
+                                      socket_map = socket_map,
+                                      timers = self.timers,
+                                      limiter = self.limiter,
+                                      capture = self.capture)
+    call_later = lambda delay, func: async_connection.call_later(socket_map,
+                                                                 delay, func)
+    self.__start(server, nickname, factory, call_later)
+
+  # Wait until the bot disconnects, or timeout seconds (forever by default).
+  # Reconnections don't count as disconnecting. For bots started with
+  # start_async(), call it from another thread than the one running
+  # mumble.loop().
+  def join(self, timeout = None):
+    deadline = None if timeout is None else time.time() + timeout
+    remaining = lambda: (None if deadline is None else
+                         max(0, deadline - time.time()))
+    connection = self.connection
+    while connection is not None:
+      connection.join(remaining())
+      while self.__reconnect_timer is not None:
+        attempted = self.__reconnect_attempted
+        attempted.wait(remaining())
+        if self.__reconnect_attempted is attempted:
+          # Timed out, or done reconnecting.
+          break
+      if self.connection is connection or remaining() == 0:
+        return
+      connection = self.connection
+
+  # Returns the seconds the message waits for the rate limit.
+  def send_message(self, user, message):
+    return self.connection.send_message(destination = user.session,
+                                        message = message)
+
+  def join_channel(self, channel_id):
+    return self.connection.join_channel(channel_id)
 
-  def start(self, server, nickname):
+  # Feed the bot with the messages of a capture file (see mumble.capture)
+  # instead of connecting to a server, as fast as possible or at speed times
+  # the real pace.
+  def replay(self, path, speed = None):
     if self.connection:
-      LOGGER.warning("Starting the bot twice. Will disconnect old bot.")
       self.stop()
-    self.connection = Connection(server, nickname, delegate = self.state,
-                                 version = self.version)
-
-  def join(self):
-    self.connection.join()
-
-  def send_message(self, user, message):
-    self.connection.send_message(destination = user.session, message = message)
+    self.connection = ReplayConnection(path, delegate = self.state,
+                                       timers = self.timers,
+                                       limiter = self.limiter)
+    return self.connection.run(speed)
+
+  # Talk: send the Opus packets of source (path or file object of an Ogg
+  # Opus file, or iterable of packets) to target at the pace of the audio,
+  # joining up to frames_per_packet of them in each voice packet. Stops what
+  # was playing. Returns the VoicePlayer, which can be stop()ped.
+  def play(self, source, target = 0, frames_per_packet = 1):
+    self.stop_playing()
+    self.__player = VoicePlayer(self.__send_voice, self.timers, source,
+                                target = target,
+                                frames_per_packet = frames_per_packet,
+                                sequence = self.__voice_sequence,
+                                on_done = self.__played)
+    return self.__player.start()
+
+  def stop_playing(self):
+    if self.__player is not None:
+      self.__player.stop()
+
+  # Call func(*args) in delay seconds, from the thread serving the
+  # connection, like the events. Returns a Timer that can be cancel()ed.
+  # Timers only run while connected; those due while reconnecting run once
+  # the bot is back.
+  def call_later(self, delay, func, *args):
+    return self.timers.call_later(delay, func, *args)
+
+  # Call func(*args) every interval seconds, until the returned Timer is
+  # cancelled.
+  def call_every(self, interval, func, *args):
+    return self.timers.call_every(interval, func, *args)
+
+  # Call handler(msg) for every message of msg_type (a mumble_pb2 class)
+  # received, after the bot handled it. Unlike Connection.subscribe(), it
+  # lasts across reconnections.
+  def subscribe(self, msg_type, handler):
+    self.__subscriptions.append((msg_type, handler))
+    if self.connection is not None:
+      self.connection.subscribe(msg_type, handler)
+
+  def unsubscribe(self, msg_type, handler):
+    if (msg_type, handler) in self.__subscriptions:
+      self.__subscriptions.remove((msg_type, handler))
+    if self.connection is not None:
+      self.connection.unsubscribe(msg_type, handler)
 
   def stop(self):
-    self.connection.stop()
+    self.__target = None
+    if self.__reconnect_timer is not None:
+      self.__reconnect_timer.cancel()
+      self.__reconnect_timer = None
+      self.__reconnect_attempted.set()
+    if self.connection is not None:
+      self.connection.stop()
     self.connection = None
 
   def rejected(self):
@@ -169,6 +488,155 @@ class Bot(object):
   def connected(self):
     pass
 
+  # Called by the state when the connection to the server is lost.
+  def disconnected(self):
+    if self.reconnect is None or self.__target is None:
+      return
+    self.state.begin_resync()
+    self.__schedule_reconnect()
+
+  # Called by the state with every new connection, before its first message.
+  def _connecting(self, connection):
+    self.connection = connection
+    for msg_type, handler in self.__subscriptions:
+      connection.subscribe(msg_type, handler)
+
+  # Called by the state once it synced again after a reconnection.
+  def reconnected(self, diff):
+    self.__attempts = 0
+    self._dispatch(None, self.on_resync, diff)
+
+  # Run the event handler func for the user with the given session, on the
+  # executor if there is one. The session orders the events.
+  def _dispatch(self, session, func, *args, **kwargs):
+    if self.executor is None:
+      func(*args, **kwargs)
+    elif kwargs:
+      self.executor.submit(session, lambda: func(*args, **kwargs))
+    else:
+      self.executor.submit(session, func, *args)
+
+  # Record, mix and count a voice packet as configured, and dispatch it.
+  def _voice_frames(self, session, sequence, target, codec, frames):
+    user = self.state.get_actor(session)
+    recorder = self.recorder
+    if recorder is not None:
+      recorder.record(session, sequence, codec, frames,
+                      name = user.name if user is not None else None)
+      if self.__recorder_timer is None:
+        self.__recorder_timer = self.call_every(recorder.flush_interval,
+                                                self.__flush_recording)
+    activity = self.activity
+    if activity is not None:
+      channel = user.channel if user is not None else None
+      activity.record(session, codec, frames,
+                      channel_id = channel.id if channel else None)
+    mixer = self.mixer
+    if mixer is not None:
+      mixer.put(session, sequence, codec, frames)
+      if self.__mixer_timer is None:
+        self.__mixer_timer = self.call_every(mixer.block_duration,
+                                             self.__mix_voice)
+    self._dispatch(session, self.on_voice_frames, user, sequence, target,
+                   codec, frames)
+
+  # Hold a voice packet in the jitter buffers. A timer releases them while
+  # some voice is buffered.
+  def _buffer_voice(self, session, sequence, target, codec, frames):
+    # An empty frame follows the last one of a transmission.
+    self.jitter.put(session, sequence, (target, codec, frames),
+                    last = bool(frames) and not len(frames[-1]))
+    if self.__jitter_timer is None:
+      self.__jitter_timer = self.call_every(self.jitter.interval,
+                                            self.__release_voice)
+
+  ##############################################################################
+  # Private.
+  def __send_voice(self, packet):
+    connection = self.connection
+    if connection is not None:
+      connection.send_voice(packet)
+
+  def __played(self, player):
+    self.__voice_sequence = player.sequence
+    if self.__player is player:
+      self.__player = None
+
+  # Flush the recorder of the moment, while there is one.
+  def __flush_recording(self):
+    recorder = self.recorder
+    timer = self.__recorder_timer
+    if recorder is None or timer.interval != recorder.flush_interval:
+      # Gone, or replaced by one flushed at another pace.
+      timer.cancel()
+      self.__recorder_timer = None
+    if recorder is not None:
+      recorder.flush()
+
+  # Mix a block for on_voice_mix, while there is voice to mix.
+  def __mix_voice(self):
+    mixer = self.mixer
+    if mixer is not None and mixer.pending():
+      self._dispatch(None, self.on_voice_mix, mixer.mix())
+    else:
+      self.__mixer_timer.cancel()
+      self.__mixer_timer = None
+
+  def __release_voice(self):
+    jitter = self.jitter
+    if jitter is not None:
+      for session, sequence, (target, codec, frames) in jitter.release():
+        self._voice_frames(session, sequence, target, codec, frames)
+    if jitter is None or not len(jitter):
+      self.__jitter_timer.cancel()
+      self.__jitter_timer = None
+
+  # call_later(delay, func) schedules the reconnections where the connection
+  # runs; None for a thread of their own.
+  def __start(self, server, nickname, factory, call_later = None):
+    if self.connection:
+      LOGGER.warning("Starting the bot twice. Will disconnect old bot.")
+      self.stop()
+    self.__target = (server, nickname, factory, call_later)
+    self.__attempts = 0
+    self.connection = factory()
+
+  def __schedule_reconnect(self):
+    if not self.reconnect.should_retry(self.__attempts):
+      LOGGER.error("Giving up reconnecting to %s after %d attempts." % (
+                   self.__target[0], self.__attempts))
+      self.__reconnect_timer = None
+      return
+    delay = self.reconnect.delay(self.__attempts)
+    self.__attempts += 1
+    LOGGER.info("Reconnecting to %s in %.1f seconds." % (self.__target[0],
+                                                         delay))
+    self.__reconnect_attempted = threading.Event()
+    call_later = self.__target[3]
+    if call_later is not None:
+      self.__reconnect_timer = call_later(delay, self.__reconnect)
+      return
+    timer = threading.Timer(delay, self.__reconnect)
+    timer.daemon = True
+    self.__reconnect_timer = timer
+    timer.start()
+
+  def __reconnect(self):
+    attempted = self.__reconnect_attempted
+    try:
+      if self.__target is None:
+        # Stopped in the meantime.
+        return
+      try:
+        self.connection = self.__target[2]()
+      except socket.error as e:
+        LOGGER.warning("Couldn't reconnect to %s: %s" % (self.__target[0], e))
+        self.__schedule_reconnect()
+        return
+      self.__reconnect_timer = None
+    finally:
+      attempted.set()
+
   def channels(self):
     return self.state.channels_by_id.values()
 
@@ -193,11 +661,15 @@ class Bot(object):
   def is_connected(self):
     return self.connection is not None
 
+  # Whether the bot lost its connection and waits to connect again.
+  def is_reconnecting(self):
+    return self.__reconnect_timer is not None
+
   ##############################################################################
   ### EVENTS FROM STATE
   def on_text_message(self, from_user, to_users, to_channels, tree_ids,
                       message):
-    if self.state.user.session in to_users:
+    if self.state.user in to_users:
       self.on_message_self(from_user = from_user, message = message)
     if to_users:
       self.on_message_users(from_user = from_user, to_users = to_users,
@@ -211,8 +683,24 @@ class Bot(object):
 
   def on_voice_ping(self, session_id):
     pass
+  # Called after reconnecting, once the state is synced with the server again.
+  # diff is the ResyncDiff of what changed while disconnected.
+  def on_resync(self, diff):
+    pass
+  # All the frames of a voice packet, as memoryviews of the packet (keep
+  # frame.tobytes() rather than the frame to hold on to the data). codec is
+  # one of the protocol.VOICE_* types. By default, calls on_voice_talk for
+  # each frame sent to the channel.
+  def on_voice_frames(self, from_user, sequence, target, codec, frames):
+    if target == 0:
+      for frame in frames:
+        self.on_voice_talk(from_user, sequence, frame)
   def on_voice_talk(self, from_user, sequence, data):
     pass
+  # A block of the voice of all the speakers mixed, as a NumPy array of int16
+  # samples, when the bot has a mixer.
+  def on_voice_mix(self, pcm):
+    pass
 
   ##############################################################################
   ### EVENTS
@@ -0,0 +1,134 @@
+# Capture of the frames exchanged with a server, and replay of a capture
+# through the connection and bot state, without any server.
+#
+# A capture file starts with MAGIC, followed by one record per frame:
+#   direction (1 byte), timestamp (double, seconds since the capture started),
+#   message type (2 bytes), length (4 bytes), body.
+# Voice received or sent over UDP is recorded as UDPTunnel frames.
+#
+# Record what a bot sees:
+#   bot.capture = mumble.CaptureWriter('session.cap')
+#   bot.start(server, nickname)
+# Then replay it, as fast as possible:
+#   bot.replay('session.cap')
+
+import struct
+import thread
+import time
+
+from connection import BaseConnection
+import protocol
+
+MAGIC = 'MBCAP\x01'
+# Direction of a frame.
+INBOUND = 0
+OUTBOUND = 1
+
+RECORD_STRUCT = struct.Struct('>BdHI')
+
+# Tee of the frames of one or more connections to a capture file.
+class CaptureWriter(object):
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.file.write(MAGIC)
+    self.mutex = thread.allocate_lock()
+    self.frames = 0
+    self.__started = time.time()
+    self.__last = 0.0
+
+  def write(self, direction, msg_type, body):
+    self.mutex.acquire()
+    try:
+      if self.file.closed:
+        return
+      # Never go back in time, even if the clock does.
+      self.__last = max(self.__last, time.time() - self.__started)
+      self.file.write(RECORD_STRUCT.pack(direction, self.__last, msg_type,
+                                         len(body)))
+      self.file.write(body)
+      self.frames += 1
+    finally:
+      self.mutex.release()
+
+  def inbound(self, msg_type, body):
+    self.write(INBOUND, msg_type, body)
+
+  # Record a serialized frame, header included.
+  def outbound(self, frame):
+    msg_type, length = protocol.HEADER_STRUCT.unpack_from(frame)
+    self.write(OUTBOUND, msg_type,
+               buffer(frame, protocol.HEADER_SIZE, length))
+
+  def close(self):
+    self.mutex.acquire()
+    try:
+      self.file.close()
+    finally:
+      self.mutex.release()
+
+
+# Iterate over the records of a capture file, as tuples of
+# (timestamp, direction, message type, body).
+def read_capture(path):
+  with open(path, 'rb') as fin:
+    if fin.read(len(MAGIC)) != MAGIC:
+      raise ValueError("%s is not a capture file." % path)
+    while True:
+      header = fin.read(RECORD_STRUCT.size)
+      if len(header) < RECORD_STRUCT.size:
+        return
+      direction, timestamp, msg_type, length = RECORD_STRUCT.unpack(header)
+      body = fin.read(length)
+      if len(body) < length:
+        # Truncated capture, the process was probably killed.
+        return
+      yield timestamp, direction, msg_type, body
+
+
+# Stands in for the server and its socket while replaying.
+class _ReplayServer(object):
+  def connect(self):
+    return self
+
+  def close(self):
+    pass
+
+  def __str__(self):
+    return "replay"
+
+
+# A connection fed by a capture file instead of a server. Inbound frames go
+# through the same parsing and handlers as live ones; whatever it sends is
+# dropped.
+class ReplayConnection(BaseConnection):
+  def __init__(self, path, delegate = None, timers = None, limiter = None):
+    BaseConnection.__init__(self, _ReplayServer(), "replay",
+                            delegate = delegate, udp = False, timers = timers,
+                            limiter = limiter)
+    self.path = path
+    self.frames = 0
+
+  # Replay the inbound frames of the capture. speed is a factor of the real
+  # time of the capture, or None to go as fast as possible. Returns the
+  # number of frames replayed.
+  def run(self, speed = None):
+    started = time.time()
+    for timestamp, direction, msg_type, body in read_capture(self.path):
+      if not self.keep_going:
+        break
+      if direction != INBOUND:
+        continue
+      if speed is not None:
+        delay = started + timestamp / speed - time.time()
+        if delay > 0:
+          time.sleep(delay)
+        self._run_timers()
+      self._handle_frame(msg_type, body)
+      self.frames += 1
+    return self.frames
+
+  def join(self, timeout = None):
+    pass
+
+  def _send(self, msg, priority = None):
+    pass
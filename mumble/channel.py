@@ -49,7 +49,14 @@ class Channel(object):
     if msg.description:
       self.description = msg.description
     elif msg.description_hash:
-      self.description = self.bot.connection.ask_description_for_channel(self.id)
+      # Channels kept across a reconnection may have that description already.
+      # No connection if the bot was stopped from another thread meanwhile.
+      connection = self.bot.connection
+      if connection is not None and (
+          msg.description_hash != getattr(self, 'description_hash', None) or
+          not hasattr(self, 'description')):
+        connection.ask_description_for_channel(self.id)
+      self.description_hash = msg.description_hash
 
     self.temp = msg.temporary
     self.position = msg.position
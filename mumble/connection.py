@@ -1,5 +1,7 @@
 from datetime import datetime
+import fcntl
 import logging
+import os
 import select
 import socket
 import ssl
@@ -8,29 +10,82 @@ import thread
 import threading
 import time
 
+import crypt_state
+from decoder import FrameDecoder
 import mumble_pb2
+from outbound import OutboundQueue, PRIORITY_HIGH, PRIORITY_NORMAL
 import protocol
+from ratelimit import RateLimiter
+from scheduler import Scheduler
+from udp import UdpTransport
 
 LOGGER = logging.getLogger(__name__)
 
-class Connection(threading.Thread):
+# Delegate method called with the frames of voice packets, by target.
+_VOICE_TARGETS = {
+  0: "on_voice_talk",
+  1: "on_voice_whisper_chan",
+  2: "on_voice_whisper_self",
+}
+
+# A pipe to wake up a loop blocked in select or poll, as (read fd, write fd).
+# Both ends are non-blocking: when the pipe is full, the loop has enough to
+# wake up for already.
+def wakeup_pipe():
+  fds = os.pipe()
+  for fd in fds:
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                                   os.O_NONBLOCK)
+  return fds
+
+# The protocol side of a connection: handshake, pings and dispatching of the
+# messages to the delegate. It does not own any way of driving its socket;
+# subclasses decide whether that happens on a thread of their own
+# (Connection) or on a loop shared with other connections (AsyncConnection).
+class BaseConnection(object):
+  # udp tells whether to send and receive voice over UDP, when possible.
+  # Voice is tunnelled through TCP otherwise.
+  # timers is the Scheduler run by the loop of this connection, and limiter
+  # the RateLimiter of text messages and state changes; a Bot passes its own,
+  # so they survive reconnections.
+  # capture is a CaptureWriter recording every frame sent and received.
   def __init__(self, server, nickname, password = None, version = "hBOT 0.1",
-                     delegate = None):
+                     delegate = None, udp = True, timers = None,
+                     limiter = None, capture = None):
     self.server = server
     self.delegate = delegate
     self.nickname = nickname
     self.password = password
     self.keep_going = True
-    self.next_ping = None
+    self.timers = timers if timers is not None else Scheduler()
+    self.timers.wake = self._wake
+    self.__ping_timer = None
+    self.limiter = limiter if limiter is not None else RateLimiter()
+    # (timer, message type, frame) of the messages held back by the rate
+    # limiter, until sent.
+    self.__deferred = []
+    self.capture = capture
     self.last_ping = None
     self.is_pinging = False
     self.mutex = thread.allocate_lock()
-
-    threading.Thread.__init__(self)
+    self.decoder = FrameDecoder()
+    self.outbound = OutboundQueue()
+    self.crypt = crypt_state.CryptState()
+    self.udp = None
+    self.use_udp = udp and crypt_state.AES is not None
+    # Voice packets received through the TCP tunnel.
+    self.tcp_packets = 0
+    # Handlers of each message type, built once. Tuples are replaced, never
+    # modified, so the loop can dispatch without locking.
+    self.__dispatch = self.__build_dispatch()
+    # Delegate methods by name, None for the ones it doesn't have.
+    self.__delegate_methods = {}
     self.socket = self.server.connect()
     self.name = version
     self.password = None
-    self.start()
+    # Before the loop starts, so the delegate knows about the connection
+    # before the first message.
+    self._call("on_connecting", self)
 
   def stop(self):
     self.keep_going = False
@@ -44,11 +99,75 @@ class Connection(threading.Thread):
       self.last_ping = int(time.time() * 1000.0)
     finally:
       self.mutex.release()
-    self._send(protocol.ping(int(self.last_ping)))
+    udp = self.udp
+    if udp is None:
+      self._send(protocol.ping(int(self.last_ping),
+                               tcp_packets = self.tcp_packets), PRIORITY_HIGH)
+      return
+    self._send(protocol.ping(int(self.last_ping),
+                             good = self.crypt.good, late = self.crypt.late,
+                             lost = self.crypt.lost,
+                             resync = self.crypt.resync,
+                             udp_packets = udp.packets_received,
+                             tcp_packets = self.tcp_packets,
+                             udp_ping_avg = udp.ping_avg,
+                             udp_ping_var = udp.ping_var), PRIORITY_HIGH)
+    udp.ping()
+
+  # Send a voice packet (header included), over UDP if the server answers
+  # there, through the TCP tunnel otherwise.
+  def send_voice(self, packet):
+    udp = self.udp
+    if udp is not None and udp.is_active() and udp.send(packet):
+      if self.capture is not None:
+        self.capture.outbound(protocol.udp_tunnel(packet))
+      return
+    self._send(protocol.udp_tunnel(packet), PRIORITY_HIGH)
 
+  # Text messages and state changes are rate limited, so the server doesn't
+  # drop them or kick us for flooding. They are queued until their turn comes,
+  # and these methods return the seconds they wait for it.
   def send_message(self, message, destination = None):
-    self._send(protocol.text_message(session = [destination],
-                                     message = message))
+    return self._send_limited(mumble_pb2.TextMessage,
+                              protocol.text_message(session = [destination],
+                                                    message = message))
+
+  def send_channel_message(self, message, channel_id):
+    return self._send_limited(mumble_pb2.TextMessage,
+                              protocol.text_message(channels = [channel_id],
+                                                    message = message))
+
+  def move_user_to_channel(self, session_id, channel_id):
+    return self._send_limited(mumble_pb2.UserState,
+                              protocol.user_state(session = session_id,
+                                                  channel_id = channel_id))
+
+  def join_channel(self, channel_id):
+    # Without a session, the server applies it to us.
+    return self._send_limited(mumble_pb2.UserState,
+                              protocol.user_state(channel_id = channel_id))
+
+  # Call handler(msg) for every message of msg_type (a mumble_pb2 class)
+  # received, after the connection and its delegate handled it. Handlers run
+  # on the thread serving the connection. They go with the connection; see
+  # Bot.subscribe() for the ones of a bot.
+  def subscribe(self, msg_type, handler):
+    self.mutex.acquire()
+    try:
+      self.__dispatch[msg_type] = (self.__dispatch.get(msg_type, ()) +
+                                   (handler,))
+    finally:
+      self.mutex.release()
+
+  def unsubscribe(self, msg_type, handler):
+    self.mutex.acquire()
+    try:
+      handlers = list(self.__dispatch.get(msg_type, ()))
+      if handler in handlers:
+        handlers.remove(handler)
+        self.__dispatch[msg_type] = tuple(handlers)
+    finally:
+      self.mutex.release()
 
   def ask_texture_for_user(self, session_id):
     self._send(protocol.request_blob([sessions_id], None, None))
@@ -61,64 +180,147 @@ class Connection(threading.Thread):
 
   ##############################################################################
   # Private.
-  def _send(self, msg):
-    self._send_blocking(msg)
+  # Queue msg to be written by the loop driving this connection.
+  def _send(self, msg, priority = PRIORITY_NORMAL):
+    if self.capture is not None:
+      self.capture.outbound(msg)
+    self.outbound.push(msg, priority)
+    self._wake()
+
+  # Queue msg, a message of type msg_type, once its rate limit allows it.
+  # Returns the seconds it waits for that.
+  def _send_limited(self, msg_type, msg):
+    now = time.time()
+    wait = self.limiter.reserve(msg_type, now)
+    if wait == 0:
+      self._send(msg)
+      return wait
+    LOGGER.debug("Rate limited, sending %s in %.2f seconds." % (
+                 msg_type.__name__, wait))
+    self.__defer(msg_type, msg, now + wait)
+    return wait
 
-  def _send_blocking(self, msg):
+  def __defer(self, msg_type, msg, when):
     self.mutex.acquire()
     try:
-      while len(msg) > 0:
-        sent = self.socket.send(msg)
-        if sent <= 0:
-          LOGGER.warning("Server socket error while trying to write.")
-          return False
-        msg = msg[sent:]
-    except:
-      return False
+      timer = self.timers.call_at(when, self.__send_deferred, msg)
+      self.__deferred.append((timer, msg_type, msg))
     finally:
       self.mutex.release()
-    return True
 
-  def _recv(self):
-    # Get the header first.
+  def __send_deferred(self, msg):
+    self.mutex.acquire()
     try:
-      header = ''
-      while len(header) < protocol.HEADER_SIZE:
-        received = self.socket.recv(protocol.HEADER_SIZE - len(header))
-        header += received
-        if len(received) == 0:
-          return None
-    except:
-      return None
-
-    size = protocol.packet_length(header)
-    msg = ""
-    while len(msg) < size:
-      received = self.socket.recv(size)
-      msg += received
-      if len(received) == 0:
-        LOGGER.warning("Server socket died while receiving.")
-        return None
-    return protocol.parse(header, msg)
+      # Identical messages may share their frame; they go in order.
+      for i, (_, _, deferred_msg) in enumerate(self.__deferred):
+        if deferred_msg is msg:
+          del self.__deferred[i]
+          break
+    finally:
+      self.mutex.release()
+    self._send(msg)
+
+  # Send the messages held by the limiter when the previous connection
+  # closed, when they were due: their turn was reserved already. Those naming
+  # a session are dropped, the server gives sessions anew on each connection.
+  def _send_held(self):
+    for when, msg_type, msg in self.limiter.take_held():
+      body = msg_type()
+      body.ParseFromString(msg[protocol.HEADER_SIZE:])
+      if ((msg_type is mumble_pb2.TextMessage and body.session) or
+          (msg_type is mumble_pb2.UserState and body.HasField('session'))):
+        LOGGER.warning("Dropped a %s to a session of the previous "
+                       "connection." % msg_type.__name__)
+        continue
+      self.__defer(msg_type, msg, when)
+
+  # Called after queuing data, to let the loop know it has something to
+  # write. Only needed by loops that can be blocked by another thread.
+  def _wake(self):
+    pass
+
+  # Close the socket. Messages still waiting for the rate limiter are kept
+  # by it for the next connection.
+  def _close(self):
+    if self.__ping_timer is not None:
+      self.__ping_timer.cancel()
+    self.mutex.acquire()
+    try:
+      deferred, self.__deferred = self.__deferred, []
+    finally:
+      self.mutex.release()
+    for timer, _, _ in deferred:
+      timer.cancel()
+    # The next connection sends them, once synced.
+    self.limiter.hold([(timer.when, msg_type, msg)
+                       for timer, msg_type, msg in deferred])
+    if self.udp is not None:
+      self.udp.close()
+    self.socket.close()
+
+  # Handle the voice packets received over UDP.
+  def _handle_udp_read(self):
+    capture = self.capture
+    for packet in self.udp.receive():
+      if capture is not None:
+        capture.inbound(protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.UDPTunnel],
+                        packet)
+      self._on_voice(packet)
+    if self.udp.needs_resync():
+      # Ask the server for a new nonce; it answers with a CryptSetup.
+      self.crypt.resync += 1
+      self._send(protocol.crypt_setup())
+
+  # Read everything available on the socket and handle all the complete
+  # messages received. Returns False if the server closed the connection.
+  def _handle_read(self):
+    alive = self.decoder.read_from(self.socket)
+    capture = self.capture
+    for msg_type, body in self.decoder.frames():
+      if not self.keep_going:
+        # Stopped by a handler, or by another thread: the rest is for no one.
+        break
+      if capture is not None:
+        capture.inbound(msg_type, body)
+      self._handle_frame(msg_type, body)
+    if not alive:
+      LOGGER.warning("Server socket died while receiving.")
+    return alive
+
+  # The delegate method named 'attr', or None. Looked up once.
+  def _delegate_method(self, attr):
+    try:
+      return self.__delegate_methods[attr]
+    except KeyError:
+      func = getattr(self.delegate, attr, None) if self.delegate else None
+      self.__delegate_methods[attr] = func
+      return func
 
   # Call a delegate method named 'attr' with the args in kwargs.
   def _call(self, attr, *kargs):
-    if self.delegate:
-      func = getattr(self.delegate, attr, None)
-      if func:
-        func(*kargs)
-
-  # Call a delegate method named 'attr' for all messages in the
-  # voice packet.
-  def _call_voice(self, attr, session, sequence, msg):
-    pos = 0
-    while ord(msg[pos]) & 0b10000000 != 0:
-      sz = ord(msg[pos]) & 0b01111111
-      self._call(attr, session, sequence, msg[pos:pos + sz])
-      pos += sz
-    else:
-      sz = ord(msg[pos])
-      self._call(attr, session, sequence, msg[pos:pos + sz])
+    func = self._delegate_method(attr)
+    if func:
+      func(*kargs)
+
+  # Call the delegate with the frames of a voice packet: once with all of
+  # them, to on_voice_frames, then once per frame, to the method named 'attr'.
+  # Frames are memoryviews of the packet.
+  def _call_voice(self, attr, type, target, session, sequence, packet,
+                  offset):
+    func = self._delegate_method(attr)
+    batch = self._delegate_method("on_voice_frames")
+    if not func and not batch:
+      return
+    try:
+      frames = list(protocol.iter_voice_frames(packet, offset, type))
+    except ValueError as e:
+      LOGGER.warning("Dropping malformed voice packet: %s" % e)
+      return
+    if batch:
+      batch(session, sequence, target, type, frames)
+    if func:
+      for frame in frames:
+        func(session, sequence, frame)
 
   ##############################################################################
   # The different message handlers. These delegate for handling it.
@@ -131,26 +333,29 @@ class Connection(threading.Thread):
     self._call("on_version", msg)
 
   def _on_udp_tunnel(self, msg):
+    self.tcp_packets += 1
+    self._on_voice(msg.packet)
+
+  # A voice packet, from the TCP tunnel or from UDP.
+  def _on_voice(self, packet):
     if not self.delegate:
       return
     # This is voice data.
-    type, target, session, sequence, length = (
-        protocol.parse_voice_header(msg.packet))
-    if type == 1:
+    try:
+      type, target, session, sequence, length = (
+          protocol.parse_voice_header(packet))
+    except ValueError as e:
+      LOGGER.warning("Dropping malformed voice packet: %s" % e)
+      return
+    if type == protocol.VOICE_PING:
       # Session is the timestamp.
       self._call("on_voice_ping", session)
-    else:
-      # For each frame, send the frame as is.
-      if target == 0:
-        self._call_voice("on_voice_talk", session, sequence,
-                         msg.packet[length:])
-      elif target == 1:
-        self._call_voice("on_voice_whisper_chan", session, sequence,
-                         msg.packet[length:])
-      elif target == 2:
-        self._call_voice("on_voice_whisper_self", session, sequence,
-                         msg.packet[length:])
+      return
+    attr = _VOICE_TARGETS.get(target)
+    if attr is None:
       # We can safely ignore the other targets, they are client -> server.
+      return
+    self._call_voice(attr, type, target, session, sequence, packet, length)
 
   def _on_authenticate(self, msg):
     LOGGER.error("Server should NEVER send Authenticate packets.")
@@ -167,7 +372,7 @@ class Connection(threading.Thread):
             % (msg.timestamp, self.last_ping))
       # Force a ping every 10 seconds (more than enough).
       rtt = time.time() * 1000.0 - msg.timestamp
-      self.next_ping = time.time() + 10
+      self.__ping_timer = self.timers.call_later(10, self.ping)
     finally:
       self.mutex.release()
     self._call("on_pingback", rtt, msg)
@@ -180,6 +385,7 @@ class Connection(threading.Thread):
 
   def _on_server_sync(self, msg):
     self._call("on_server_sync", msg)
+    self._send_held()
 
   def _on_channel_state(self, msg):
     self._call("on_channel_state", msg)
@@ -187,10 +393,26 @@ class Connection(threading.Thread):
   def _on_user_state(self, msg):
     self._call("on_user_state", msg)
 
+  def _on_user_remove(self, msg):
+    self._call("on_user_remove", msg)
+
   def _on_text_message(self, msg):
     self._call("on_text_message", msg)
 
   def _on_crypt_setup(self, msg):
+    if msg.key and msg.client_nonce and msg.server_nonce:
+      # We encrypt with the client nonce, the server with its own.
+      if self.use_udp:
+        self.crypt.set_key(msg.key, msg.client_nonce, msg.server_nonce)
+        if self.udp is None:
+          self.udp = UdpTransport(self.socket.getpeername()[:2], self.crypt)
+    elif msg.server_nonce:
+      # The server resynchronizes our decryption.
+      self.crypt.set_decrypt_iv(msg.server_nonce)
+    elif self.crypt.is_valid():
+      # The server lost track of our encryption.
+      self._send(protocol.crypt_setup(
+          client_nonce = bytes(self.crypt.encrypt_iv)))
     self._call("on_crypt_setup", msg)
     # Start pinging.
     self.ping()
@@ -198,46 +420,121 @@ class Connection(threading.Thread):
   def _on_user_stats(self, msg):
     self._call("on_user_stats", msg)
 
-  def _on_unknown(self, msg):
-    self._call("on_unknown", type(msg), msg)
+  # Handle a frame received. Its body is only parsed if a handler reads it:
+  # frames of a type without handlers, e.g. the UserState churn of a busy
+  # server when the delegate doesn't track users, are never parsed.
+  def _handle_frame(self, msg_type, body):
+    msg_class = protocol.TYPE_MESSAGE_LOOKUP.get(msg_type)
+    if msg_class is None:
+      LOGGER.warning("Unknown message type %d received." % msg_type)
+      return
+    handlers = self.__dispatch.get(msg_class)
+    if handlers is None:
+      if self._delegate_method("on_unknown") is not None:
+        self._call("on_unknown", msg_class,
+                   protocol.parse_lazy(msg_type, body))
+      return
+    msg = protocol.parse_lazy(msg_type, body)
+    for handler in handlers:
+      handler(msg)
+
+  # The handlers of each message type, before any subscription.
+  def __build_dispatch(self):
+    return {
+      mumble_pb2.Version: (self._on_version,),
+      mumble_pb2.UDPTunnel: (self._on_udp_tunnel,),
+      mumble_pb2.Authenticate: (self._on_authenticate,),
+      mumble_pb2.Ping: (self._on_ping,),
+      mumble_pb2.Reject: (self._on_reject,),
+      mumble_pb2.ServerConfig: (self._on_server_config,),
+      mumble_pb2.ServerSync: (self._on_server_sync,),
+      # mumble_pb2.ChannelRemove: (self._on_channel_remove,),
+      mumble_pb2.ChannelState: (self._on_channel_state,),
+      mumble_pb2.UserRemove: (self._on_user_remove,),
+      mumble_pb2.UserState: (self._on_user_state,),
+      # mumble_pb2.BanList: (self._on_ban_list,),
+      mumble_pb2.TextMessage: (self._on_text_message,),
+      # mumble_pb2.PermissionDenied: (self._on_permission_denied,),
+      # mumble_pb2.ACL: (self._on_acl,),
+      # mumble_pb2.QueryUsers: (self._on_query_users,),
+      mumble_pb2.CryptSetup: (self._on_crypt_setup,),
+      # mumble_pb2.ContextActionModify: (self._on_context_action_modify,),
+      # mumble_pb2.ContextAction: (self._on_context_action,),
+      # mumble_pb2.UserList: (self._on_user_list,),
+      # mumble_pb2.VoiceTarget: (self._on_voice_target,),
+      # mumble_pb2.PermissionQuery: (self._on_permission_query,),
+      # mumble_pb2.CodecVersion: (self._on_codec_version,),
+      mumble_pb2.UserStats: (self._on_user_stats,),
+      # mumble_pb2.SuggestConfig: (self._on_suggest_config,),
+      # mumble_pb2.RequestBlob: (self._on_request_blob,),
+    }
+
+  # Seconds until the loop must wake up for the next timer, or None if it can
+  # wait for incoming data indefinitely. While a ping is in flight, the
+  # pingback itself wakes us up.
+  def _timeout(self, now):
+    return self.timers.timeout(now)
+
+  # Run the timers due, pings included. The next ping is only scheduled on
+  # ping backs.
+  def _run_timers(self):
+    self.timers.run_due(time.time())
 
-  def _switch(self, msg):
-    if msg == None:
+
+# A connection running on its own thread, polling its socket.
+class Connection(BaseConnection, threading.Thread):
+  def __init__(self, server, nickname, password = None, version = "hBOT 0.1",
+                     delegate = None, udp = True, timers = None,
+                     limiter = None, capture = None):
+    # The Thread must be initialized first, it owns the name property.
+    threading.Thread.__init__(self)
+    # Other threads write on this pipe to wake up the loop when they queue
+    # data to send, add a timer or stop the connection. Once it's closed, its
+    # fds may be reused by anything, so writes check under the mutex.
+    self.__wakeup_r, self.__wakeup_w = wakeup_pipe()
+    self.__wakeup_mutex = thread.allocate_lock()
+    self.__wakeup_closed = False
+    try:
+      BaseConnection.__init__(self, server, nickname, password = password,
+                              version = version, delegate = delegate,
+                              udp = udp, timers = timers,
+                              limiter = limiter, capture = capture)
+    except:
+      self.__close_wakeup()
+      raise
+    self.start()
+
+  def stop(self):
+    BaseConnection.stop(self)
+    self._wake()
+
+  def _wake(self):
+    if threading.current_thread() is self:
       return
-    { mumble_pb2.Version: self._on_version,
-      mumble_pb2.UDPTunnel: self._on_udp_tunnel,
-      mumble_pb2.Authenticate: self._on_authenticate,
-      mumble_pb2.Ping: self._on_ping,
-      mumble_pb2.Reject: self._on_reject,
-      mumble_pb2.ServerConfig: self._on_server_config,
-      mumble_pb2.ServerSync: self._on_server_sync,
-      # mumble_pb2.ChannelRemove: self._on_channel_remove,
-      mumble_pb2.ChannelState: self._on_channel_state,
-      # mumble_pb2.UserRemove: self._on_user_remove,
-      mumble_pb2.UserState: self._on_user_state,
-      # mumble_pb2.BanList: self._on_ban_list,
-      mumble_pb2.TextMessage: self._on_text_message,
-      # mumble_pb2.PermissionDenied: self._on_permission_denied,
-      # mumble_pb2.ACL: self._on_acl,
-      # mumble_pb2.QueryUsers: self._on_query_users,
-      mumble_pb2.CryptSetup: self._on_crypt_setup,
-      # mumble_pb2.ContextActionModify: self._on_context_action_modify,
-      # mumble_pb2.ContextAction: self._on_context_action,
-      # mumble_pb2.UserList: self._on_user_list,
-      # mumble_pb2.VoiceTarget: self._on_voice_target,
-      # mumble_pb2.PermissionQuery: self._on_permission_query,
-      # mumble_pb2.CodecVersion: self._on_codec_version,
-      mumble_pb2.UserStats: self._on_user_stats,
-      # mumble_pb2.SuggestConfig: self._on_suggest_config,
-      # mumble_pb2.RequestBlob: self._on_request_blob,
-    }.get(type(msg), self._on_unknown)(msg)
+    self.__wakeup_mutex.acquire()
+    try:
+      if self.__wakeup_closed:
+        # The loop is gone already.
+        return
+      try:
+        os.write(self.__wakeup_w, 'w')
+      except OSError:
+        # Full.
+        pass
+    finally:
+      self.__wakeup_mutex.release()
 
   def _loop(self):
     fd = self.socket.fileno()
+    wakeup = self.__wakeup_r
     while self.keep_going:
-      # Read...
+      # Read, and write if there is anything queued...
+      rlist = [fd, wakeup]
+      if self.udp is not None:
+        rlist.append(self.udp.fileno())
       try:
-        r, _, err = select.select([fd], [], [fd], 0.3)
+        r, w, err = select.select(rlist, [fd] if self.outbound else [],
+                                  [fd], self._timeout(time.time()))
       except socket.error as msg:
         self._call("on_socket_exception", msg)
         self.stop()
@@ -249,15 +546,47 @@ class Connection(threading.Thread):
           return False
       for n in r:
         if n == fd:
-          self._switch(self._recv())
-      # Send a ping when needed.
-      # We only refresh next_ping on ping backs. This is to make
-      # sure that if the ping is lost on the way we resend it every
-      # seconds.
-      if self.next_ping and time.time() >= self.next_ping:
-        self.ping()
+          try:
+            alive = self._handle_read()
+          except socket.error as msg:
+            self._call("on_socket_exception", msg)
+            self.stop()
+            return False
+          if not alive:
+            self._call("on_socket_error")
+            self.stop()
+            return False
+        elif n == wakeup:
+          os.read(wakeup, 4096)
+        else:
+          try:
+            self._handle_udp_read()
+          except socket.error as msg:
+            LOGGER.warning("UDP voice failed, using TCP only: %s" % msg)
+            self.udp.close()
+            self.udp = None
+      self._run_timers()
+      # Flush right away what was queued while handling messages, without
+      # waiting for the socket to be reported writable.
+      if self.outbound:
+        try:
+          self.outbound.flush(self.socket)
+        except socket.error as msg:
+          self._call("on_socket_exception", msg)
+          self.stop()
+          return False
     return True
 
   def run(self):
     self._loop()
-    self.socket.close()
+    self._close()
+    self.__close_wakeup()
+
+  def __close_wakeup(self):
+    self.__wakeup_mutex.acquire()
+    try:
+      self.__wakeup_closed = True
+      os.close(self.__wakeup_r)
+      os.close(self.__wakeup_w)
+    finally:
+      self.__wakeup_mutex.release()
@@ -0,0 +1,225 @@
+# OCB2-AES128, the authenticated encryption of Mumble's UDP voice packets.
+# This mirrors CryptState from the Mumble sources, including the way the
+# decrypt IV follows the packets received out of order, and the counters of
+# good/late/lost packets the client reports in its Ping messages.
+#
+# AES itself comes from PyCrypto (or PyCryptodome). Without it, CryptState
+# can't be used and voice stays tunnelled through TCP.
+
+import struct
+
+try:
+  from Crypto.Cipher import AES
+except ImportError:
+  AES = None
+
+AES_BLOCK_SIZE = 16
+# Bytes added to each packet: the IV byte and 3 bytes of tag.
+HEADER_SIZE = 4
+
+_MASK = (1 << 128) - 1
+_BLOCK = struct.Struct(">QQ")
+
+def _to_int(block):
+  hi, lo = _BLOCK.unpack(block)
+  return (hi << 64) | lo
+
+def _to_block(value):
+  return _BLOCK.pack(value >> 64, value & 0xFFFFFFFFFFFFFFFF)
+
+# Multiplication by 2 in GF(2^128).
+def _times2(value):
+  return ((value << 1) & _MASK) ^ (0x87 if value >> 127 else 0)
+
+def _increment(iv, start):
+  for i in range(start, AES_BLOCK_SIZE):
+    iv[i] = (iv[i] + 1) & 0xFF
+    if iv[i]:
+      break
+
+def _decrement(iv, start):
+  for i in range(start, AES_BLOCK_SIZE):
+    iv[i] = (iv[i] - 1) & 0xFF
+    if iv[i] != 0xFF:
+      break
+
+
+class CryptState(object):
+  def __init__(self):
+    self.key = None
+    self.encrypt_iv = bytearray(AES_BLOCK_SIZE)
+    self.decrypt_iv = bytearray(AES_BLOCK_SIZE)
+    # Second byte of the IV last used with each first byte; to reject
+    # replayed packets.
+    self.decrypt_history = bytearray(256)
+    self.good = 0
+    self.late = 0
+    self.lost = 0
+    self.resync = 0
+    self.__encrypt_block = None
+    self.__decrypt_block = None
+
+  def is_valid(self):
+    return self.key is not None
+
+  # Set the key and both IVs. A client encrypts with the client nonce and
+  # decrypts with the server nonce; a server the other way around.
+  def set_key(self, key, encrypt_iv, decrypt_iv):
+    if AES is None:
+      raise RuntimeError("PyCrypto is needed for UDP voice encryption.")
+    cipher = AES.new(bytes(key), AES.MODE_ECB)
+    self.__encrypt_block = cipher.encrypt
+    self.__decrypt_block = cipher.decrypt
+    self.key = bytes(key)
+    self.encrypt_iv = bytearray(encrypt_iv)
+    self.decrypt_iv = bytearray(decrypt_iv)
+    self.decrypt_history = bytearray(256)
+
+  # Resynchronize the decrypt IV, as sent by the other end.
+  def set_decrypt_iv(self, iv):
+    self.decrypt_iv = bytearray(iv)
+
+  # Returns plain encrypted into a packet, header included.
+  def encrypt(self, plain):
+    _increment(self.encrypt_iv, 0)
+    encrypted, tag = self.__ocb_encrypt(bytes(plain), bytes(self.encrypt_iv))
+    return chr(self.encrypt_iv[0]) + tag[:3] + encrypted
+
+  # Returns the plain data of an encrypted packet, or None if the packet is
+  # invalid, forged or a replay.
+  def decrypt(self, packet):
+    if len(packet) < HEADER_SIZE:
+      return None
+    packet = bytes(packet)
+    saved_iv = bytearray(self.decrypt_iv)
+    iv = self.decrypt_iv
+    iv_byte = ord(packet[0])
+    restore = False
+    late = 0
+    lost = 0
+
+    if ((iv[0] + 1) & 0xFF) == iv_byte:
+      # In order, as expected.
+      if iv_byte > iv[0]:
+        iv[0] = iv_byte
+      elif iv_byte < iv[0]:
+        iv[0] = iv_byte
+        _increment(iv, 1)
+      else:
+        return None
+    else:
+      # Out of order, or a repeat.
+      diff = iv_byte - iv[0]
+      if diff > 128:
+        diff -= 256
+      elif diff < -128:
+        diff += 256
+      if iv_byte < iv[0] and -30 < diff < 0:
+        # Late packet, no wraparound.
+        late, lost = 1, -1
+        iv[0] = iv_byte
+        restore = True
+      elif iv_byte > iv[0] and -30 < diff < 0:
+        # Late packet, from before a wraparound.
+        late, lost = 1, -1
+        iv[0] = iv_byte
+        _decrement(iv, 1)
+        restore = True
+      elif iv_byte > iv[0] and diff > 0:
+        # Lost a few packets.
+        lost = iv_byte - iv[0] - 1
+        iv[0] = iv_byte
+      elif iv_byte < iv[0] and diff > 0:
+        # Lost a few packets, and wrapped around.
+        lost = 256 - iv[0] + iv_byte - 1
+        iv[0] = iv_byte
+        _increment(iv, 1)
+      else:
+        return None
+      if self.decrypt_history[iv[0]] == iv[1]:
+        # Replay.
+        self.decrypt_iv = saved_iv
+        return None
+
+    plain, tag = self.__ocb_decrypt(packet[HEADER_SIZE:], bytes(iv))
+    if plain is None or tag[:3] != packet[1:HEADER_SIZE]:
+      self.decrypt_iv = saved_iv
+      return None
+    self.decrypt_history[iv[0]] = iv[1]
+    if restore:
+      self.decrypt_iv = saved_iv
+
+    self.good += 1
+    self.late = max(0, self.late + late)
+    self.lost = max(0, self.lost + lost)
+    return plain
+
+  ##############################################################################
+  # Private.
+  def __ocb_encrypt(self, plain, nonce):
+    encrypt_block = self.__encrypt_block
+    delta = _to_int(encrypt_block(nonce))
+    checksum = 0
+    encrypted = []
+    pos = 0
+    remaining = len(plain)
+    while remaining > AES_BLOCK_SIZE:
+      block = _to_int(plain[pos:pos + AES_BLOCK_SIZE])
+      # Counter-cryptanalysis of section 9 of https://eprint.iacr.org/2019/311
+      # An attack needs the second to last block to be all zeros but for its
+      # last byte. Digital silence does that; flip a bit, the audio won't mind.
+      flip = (remaining - AES_BLOCK_SIZE <= AES_BLOCK_SIZE and
+              block >> 8 == 0)
+      delta = _times2(delta)
+      tmp = delta ^ block
+      if flip:
+        tmp ^= 1 << 120
+      encrypted.append(_to_block(
+          delta ^ _to_int(encrypt_block(_to_block(tmp)))))
+      checksum ^= block
+      if flip:
+        checksum ^= 1 << 120
+      pos += AES_BLOCK_SIZE
+      remaining -= AES_BLOCK_SIZE
+
+    delta = _times2(delta)
+    pad = encrypt_block(_to_block(delta ^ (remaining * 8)))
+    tmp = _to_int(plain[pos:] + pad[remaining:])
+    checksum ^= tmp
+    encrypted.append(_to_block(_to_int(pad) ^ tmp)[:remaining])
+
+    delta ^= _times2(delta)
+    tag = encrypt_block(_to_block(delta ^ checksum))
+    return ''.join(encrypted), tag
+
+  def __ocb_decrypt(self, encrypted, nonce):
+    encrypt_block = self.__encrypt_block
+    decrypt_block = self.__decrypt_block
+    delta = _to_int(encrypt_block(nonce))
+    checksum = 0
+    plain = []
+    pos = 0
+    remaining = len(encrypted)
+    while remaining > AES_BLOCK_SIZE:
+      delta = _times2(delta)
+      block = delta ^ _to_int(decrypt_block(_to_block(
+          delta ^ _to_int(encrypted[pos:pos + AES_BLOCK_SIZE]))))
+      plain.append(_to_block(block))
+      checksum ^= block
+      pos += AES_BLOCK_SIZE
+      remaining -= AES_BLOCK_SIZE
+
+    delta = _times2(delta)
+    pad = _to_int(encrypt_block(_to_block(delta ^ (remaining * 8))))
+    tmp = pad ^ _to_int(encrypted[pos:] +
+                        '\0' * (AES_BLOCK_SIZE - remaining))
+    checksum ^= tmp
+    plain.append(_to_block(tmp)[:remaining])
+    # Counter-cryptanalysis, see __ocb_encrypt(): the last block of an attack
+    # decrypts to delta, but for its last byte.
+    if tmp >> 8 == delta >> 8:
+      return None, None
+
+    delta ^= _times2(delta)
+    tag = encrypt_block(_to_block(delta ^ checksum))
+    return ''.join(plain), tag
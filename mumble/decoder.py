@@ -0,0 +1,72 @@
+import errno
+import socket
+import ssl
+
+import protocol
+
+# Errors meaning a non-blocking socket has nothing more to give for now.
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Incremental decoder for the stream of framed messages sent by the server.
+# Data is read in large chunks into a single reusable buffer, and every
+# complete frame it holds is sliced out at once, so a burst of small packets
+# (e.g. the ChannelState/UserState flood when joining) costs one read instead
+# of several per packet.
+class FrameDecoder(object):
+  def __init__(self, chunk_size = 65536):
+    self.buffer = bytearray()
+    self.__chunk = bytearray(chunk_size)
+    self.__chunk_view = memoryview(self.__chunk)
+
+  # Append raw stream data to the buffer.
+  def feed(self, data):
+    self.buffer += data
+
+  # Read everything available on the non-blocking socket sock. Returns False
+  # when the other end closed the connection.
+  def read_from(self, sock):
+    chunk_size = len(self.__chunk)
+    while True:
+      try:
+        received = sock.recv_into(self.__chunk)
+      except ssl.SSLError as e:
+        if e.errno == ssl.SSL_ERROR_WANT_READ:
+          return True
+        raise
+      except socket.error as e:
+        if e.errno in _WOULD_BLOCK:
+          return True
+        raise
+      if received == 0:
+        return False
+      self.buffer += self.__chunk_view[:received]
+      # A short read means the kernel is drained; the TLS layer may still have
+      # decrypted data of its own though.
+      if received < chunk_size and not _pending(sock):
+        return True
+
+  # Returns the list of (message type, body) for every complete frame in the
+  # buffer, and drops them from it. Incomplete frames are kept for later.
+  def frames(self):
+    buf = self.buffer
+    end = len(buf)
+    view = memoryview(buf)
+    frames = []
+    pos = 0
+    while end - pos >= protocol.HEADER_SIZE:
+      msg_type, length = protocol.HEADER_STRUCT.unpack_from(buf, pos)
+      start = pos + protocol.HEADER_SIZE
+      if end - start < length:
+        break
+      pos = start + length
+      frames.append((msg_type, view[start:pos].tobytes()))
+    # The view must be gone before the buffer can be resized.
+    del view
+    if pos:
+      del buf[:pos]
+    return frames
+
+
+def _pending(sock):
+  pending = getattr(sock, 'pending', None)
+  return pending is not None and pending() > 0
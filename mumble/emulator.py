@@ -0,0 +1,487 @@
+#!/bin/python
+#
+# Stand-in for a Mumble server, to exercise bots without a real murmur: it
+# serves the handshake, a synthetic channel tree and simulated users that
+# join, leave, move, talk and send text messages at configurable rates.
+# Bots connect to it like to any server, over loopback:
+#
+#   emulator = Emulator(users = 200, channels = 30)
+#   emulator.start()
+#   bot.start(emulator.server(), "-Bot-")
+#
+# Or from a shell:
+#   python -m mumble.emulator [--tls] [-u USERS] [-c CHANNELS] [-p PORT]
+#
+# It only knows what bots need: there are no permissions, ACLs or UDP, voice
+# is tunnelled through TCP and relayed to the channel of the speaker, and text
+# messages from bots are simply delivered.
+
+from optparse import OptionParser
+
+import logging
+import os
+import random
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import thread
+import threading
+import time
+
+from decoder import FrameDecoder
+from jitter import SEQUENCE_DURATION
+import mumble_pb2
+import protocol
+from server import Server
+
+LOGGER = logging.getLogger(__name__)
+
+# Voice frames of simulated users: 20 ms each, a second per talk spurt.
+FRAME_INTERVAL = 0.02
+FRAMES_PER_SPURT = 50
+_OPUS_TOC = 31 << 3
+
+_TYPE_UDP_TUNNEL = protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.UDPTunnel]
+_TYPE_PING = protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.Ping]
+_TYPE_AUTHENTICATE = protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.Authenticate]
+_TYPE_TEXT_MESSAGE = protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.TextMessage]
+_TYPE_USER_STATE = protocol.MESSAGE_TYPE_LOOKUP[mumble_pb2.UserState]
+
+def _message(msg_class, **fields):
+  msg = msg_class()
+  for name, value in fields.items():
+    if isinstance(value, list):
+      getattr(msg, name).extend(value)
+    else:
+      setattr(msg, name, value)
+  return protocol.serialize_(msg)
+
+# Opus voice packet from session, made of one frame.
+def _voice_packet(session, sequence, frame, last):
+  size = len(frame) | (0x2000 if last else 0)
+  return (chr(protocol.VOICE_OPUS << 5) + protocol.encode_varint(session) +
+          protocol.encode_varint(sequence) + protocol.encode_varint(size) +
+          frame)
+
+# Generate a self-signed certificate with the openssl command. Returns the
+# paths of the certificate and its key.
+def make_self_signed_cert(directory):
+  certfile = os.path.join(directory, 'cert.pem')
+  keyfile = os.path.join(directory, 'key.pem')
+  with open(os.devnull, 'w') as devnull:
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                           '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                           '-keyout', keyfile, '-out', certfile],
+                          stdout = devnull, stderr = devnull)
+  return certfile, keyfile
+
+
+# A user of the emulated server, simulated or connected for real.
+class _User(object):
+  def __init__(self, session, name, channel_id):
+    self.session = session
+    self.name = name
+    self.channel_id = channel_id
+    # Frames left to send in the current talk spurt, for simulated users.
+    self.talking = 0
+    self.sequence = 0
+
+  # Like murmur, channel_id is left out for the root channel.
+  def state(self):
+    if self.channel_id == 0:
+      return _message(mumble_pb2.UserState, session = self.session,
+                      name = self.name)
+    return _message(mumble_pb2.UserState, session = self.session,
+                    name = self.name, channel_id = self.channel_id)
+
+
+# A client connected to the emulator, served by a thread of its own.
+class _Client(_User):
+  def __init__(self, emulator, sock, session):
+    _User.__init__(self, session, None, 0)
+    self.emulator = emulator
+    self.socket = sock
+    self.mutex = thread.allocate_lock()
+    self.authenticated = False
+    self.alive = True
+
+  def send(self, data):
+    self.mutex.acquire()
+    try:
+      if not self.alive:
+        return
+      try:
+        self.socket.sendall(data)
+      except (socket.error, ssl.SSLError):
+        self.alive = False
+    finally:
+      self.mutex.release()
+
+  def run(self):
+    decoder = FrameDecoder()
+    try:
+      if self.emulator.ssl_context is not None:
+        self.socket = self.emulator.ssl_context.wrap_socket(
+            self.socket, server_side = True)
+      self.send(_message(mumble_pb2.Version, version = 66050,
+                         release = "emulator", os = "emulator"))
+      while self.alive and self.emulator.keep_going:
+        alive = decoder.read_from(self.socket)
+        for msg_type, body in decoder.frames():
+          self.emulator._handle(self, msg_type, body)
+        if not alive:
+          break
+    except (socket.error, ssl.SSLError) as e:
+      LOGGER.debug("Client %d: %s" % (self.session, e))
+    self.alive = False
+    self.emulator._disconnected(self)
+    try:
+      self.socket.close()
+    except socket.error:
+      pass
+
+
+class Emulator(object):
+  def __init__(self, host = '127.0.0.1', port = 0, tls = False,
+                     certfile = None, keyfile = None, channels = 10,
+                     users = 50, join_rate = 0.5, leave_rate = 0.5,
+                     move_rate = 1.0, talk_rate = 1.0, text_rate = 1.0,
+                     texts = ("Hello there.",), seed = None):
+    """
+    Arguments: host, port Where to listen; port 0 picks a free one.
+               tls Whether to use TLS. Without certfile/keyfile, a
+                   self-signed certificate is made with openssl.
+               channels Number of channels, root excluded.
+               users Number of simulated users at the start.
+               join_rate, leave_rate, move_rate Simulated users joining,
+                                                leaving and changing channel,
+                                                per second.
+               talk_rate Talk spurts started per second.
+               text_rate Text messages sent per second, to the channel of the
+                         sender or to a connected client.
+               texts Text messages to pick from.
+               seed Seed of the simulation, for reproducible runs.
+    """
+    self.host = host
+    self.tls = tls
+    self.rates = {
+      'join': join_rate,
+      'leave': leave_rate,
+      'move': move_rate,
+      'talk': talk_rate,
+      'text': text_rate,
+    }
+    self.texts = list(texts)
+    self.random = random.Random(seed)
+    self.keep_going = True
+    self.mutex = thread.allocate_lock()
+    # Messages received from clients, by type.
+    self.received = {}
+    self.__tempdir = None
+    self.ssl_context = None
+    if tls:
+      if certfile is None:
+        self.__tempdir = tempfile.mkdtemp()
+        certfile, keyfile = make_self_signed_cert(self.__tempdir)
+      self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+      self.ssl_context.load_cert_chain(certfile, keyfile)
+    self.__listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.__listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.__listener.bind((host, port))
+    self.__listener.listen(128)
+    self.port = self.__listener.getsockname()[1]
+    self.__sessions = iter(xrange(1, 1 << 31)).next
+    self.__channels = {0: None}
+    for channel_id in range(1, channels + 1):
+      self.__channels[channel_id] = self.random.randrange(channel_id)
+    self.__users = {}
+    self.__clients = {}
+    for i in range(users):
+      self.__add_simulated_user()
+    self.__budget = dict((kind, 0.0) for kind in self.rates)
+    self.__threads = []
+
+  # A Server to connect bots to the emulator.
+  def server(self):
+    return Server(self.host, self.port, tls = self.tls)
+
+  def start(self):
+    for target, name in ((self.__accept, "Emulator Listener"),
+                         (self.__simulate, "Emulator Simulation")):
+      worker = threading.Thread(target = target, name = name)
+      worker.daemon = True
+      worker.start()
+      self.__threads.append(worker)
+
+  def stop(self):
+    self.keep_going = False
+    try:
+      self.__listener.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+    self.__listener.close()
+    self.mutex.acquire()
+    try:
+      clients = self.__clients.values()
+    finally:
+      self.mutex.release()
+    for client in clients:
+      client.alive = False
+      try:
+        client.socket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+    for worker in self.__threads:
+      worker.join(1)
+    if self.__tempdir is not None:
+      shutil.rmtree(self.__tempdir, ignore_errors = True)
+
+  def users(self):
+    return len(self.__users)
+
+  def clients(self):
+    return len(self.__clients)
+
+  ##############################################################################
+  # Called by the threads of the clients.
+  def _handle(self, client, msg_type, body):
+    self.mutex.acquire()
+    try:
+      self.received[msg_type] = self.received.get(msg_type, 0) + 1
+    finally:
+      self.mutex.release()
+    if msg_type == _TYPE_PING:
+      msg = mumble_pb2.Ping()
+      msg.ParseFromString(body)
+      client.send(_message(mumble_pb2.Ping, timestamp = msg.timestamp))
+    elif msg_type == _TYPE_AUTHENTICATE:
+      msg = mumble_pb2.Authenticate()
+      msg.ParseFromString(body)
+      self.__authenticate(client, msg.username)
+    elif msg_type == _TYPE_USER_STATE and client.authenticated:
+      msg = mumble_pb2.UserState()
+      msg.ParseFromString(body)
+      session = msg.session if msg.HasField('session') else client.session
+      if msg.HasField('channel_id') and msg.channel_id in self.__channels:
+        self.__move(session, msg.channel_id, actor = client.session)
+    elif msg_type == _TYPE_TEXT_MESSAGE and client.authenticated:
+      msg = mumble_pb2.TextMessage()
+      msg.ParseFromString(body)
+      msg.actor = client.session
+      data = protocol.serialize_(msg)
+      for session in msg.session:
+        target = self.__clients.get(session)
+        if target is not None:
+          target.send(data)
+      for target in self.__clients.values():
+        if target.channel_id in msg.channel_id and target is not client:
+          target.send(data)
+
+    elif msg_type == _TYPE_UDP_TUNNEL and client.authenticated and body:
+      # Voice: relay it to the channel, with the session of the speaker
+      # after the header byte, like murmur.
+      if protocol.voice_type(body) == protocol.VOICE_PING:
+        client.send(protocol.udp_tunnel(body))
+        return
+      packet = body[0] + protocol.encode_varint(client.session) + body[1:]
+      self.__broadcast(protocol.udp_tunnel(packet), exclude = client,
+                       channel_id = client.channel_id)
+
+  def _disconnected(self, client):
+    self.mutex.acquire()
+    try:
+      if self.__clients.pop(client.session, None) is None:
+        return
+      self.__users.pop(client.session, None)
+    finally:
+      self.mutex.release()
+    if client.authenticated:
+      self.__broadcast(_message(mumble_pb2.UserRemove,
+                                session = client.session))
+
+  ##############################################################################
+  # Private.
+  def __accept(self):
+    while self.keep_going:
+      try:
+        sock, address = self.__listener.accept()
+      except socket.error:
+        if self.keep_going:
+          LOGGER.exception("Emulator stopped accepting clients.")
+        return
+      sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+      self.mutex.acquire()
+      try:
+        client = _Client(self, sock, self.__sessions())
+        self.__clients[client.session] = client
+      finally:
+        self.mutex.release()
+      worker = threading.Thread(target = client.run,
+                                name = "Emulator Client %d" % client.session)
+      worker.daemon = True
+      worker.start()
+
+  def __authenticate(self, client, username):
+    client.name = username
+    messages = [_message(mumble_pb2.CryptSetup,
+                         key = os.urandom(16), client_nonce = os.urandom(16),
+                         server_nonce = os.urandom(16))]
+    # Parents first.
+    for channel_id in sorted(self.__channels):
+      parent = self.__channels[channel_id]
+      messages.append(_message(mumble_pb2.ChannelState,
+                               channel_id = channel_id,
+                               parent = channel_id if parent is None else parent,
+                               name = "Channel %d" % channel_id))
+    self.mutex.acquire()
+    try:
+      users = self.__users.values()
+      self.__users[client.session] = client
+      client.authenticated = True
+    finally:
+      self.mutex.release()
+    messages.extend(user.state() for user in users)
+    messages.append(client.state())
+    messages.append(_message(mumble_pb2.ServerConfig,
+                             welcome_text = "Emulated server",
+                             allow_html = True))
+    messages.append(_message(mumble_pb2.ServerSync, session = client.session,
+                             max_bandwidth = 72000,
+                             welcome_text = "Emulated server",
+                             permissions = 0xf07ff))
+    client.send(''.join(messages))
+    self.__broadcast(client.state(), exclude = client)
+
+  def __broadcast(self, data, exclude = None, channel_id = None):
+    self.mutex.acquire()
+    try:
+      clients = self.__clients.values()
+    finally:
+      self.mutex.release()
+    for client in clients:
+      if client is exclude or not client.authenticated:
+        continue
+      if channel_id is not None and client.channel_id != channel_id:
+        continue
+      client.send(data)
+
+  def __add_simulated_user(self):
+    session = self.__sessions()
+    user = _User(session, "User%d" % session,
+                 self.random.choice(self.__channels.keys()))
+    self.__users[session] = user
+    return user
+
+  def __simulated_users(self):
+    return [u for u in self.__users.values() if not isinstance(u, _Client)]
+
+  def __move(self, session, channel_id, actor = None):
+    user = self.__users.get(session)
+    if user is None:
+      return
+    user.channel_id = channel_id
+    fields = {'session': session, 'channel_id': channel_id}
+    if actor is not None:
+      fields['actor'] = actor
+    self.__broadcast(_message(mumble_pb2.UserState, **fields))
+
+  def __event(self, kind):
+    users = self.__simulated_users()
+    if kind == 'join':
+      self.mutex.acquire()
+      try:
+        user = self.__add_simulated_user()
+      finally:
+        self.mutex.release()
+      self.__broadcast(user.state())
+      return
+    if not users:
+      return
+    user = self.random.choice(users)
+    if kind == 'leave':
+      self.mutex.acquire()
+      try:
+        del self.__users[user.session]
+      finally:
+        self.mutex.release()
+      self.__broadcast(_message(mumble_pb2.UserRemove,
+                                session = user.session))
+    elif kind == 'move':
+      self.__move(user.session, self.random.choice(self.__channels.keys()))
+    elif kind == 'talk':
+      user.talking = FRAMES_PER_SPURT
+    elif kind == 'text':
+      clients = [c for c in self.__clients.values() if c.authenticated]
+      message = self.random.choice(self.texts)
+      if clients and self.random.random() < 0.5:
+        target = self.random.choice(clients)
+        target.send(_message(mumble_pb2.TextMessage, actor = user.session,
+                             session = [target.session], message = message))
+      else:
+        self.__broadcast(_message(mumble_pb2.TextMessage,
+                                  actor = user.session,
+                                  channel_id = [user.channel_id],
+                                  message = message),
+                         channel_id = user.channel_id)
+
+  def __talk(self):
+    for user in self.__simulated_users():
+      if not user.talking:
+        continue
+      user.talking -= 1
+      user.sequence += int(round(FRAME_INTERVAL / SEQUENCE_DURATION))
+      # An Opus TOC byte (CELT, fullband, 20 ms, mono), then noise.
+      frame = chr(_OPUS_TOC) + os.urandom(self.random.randint(20, 60))
+      packet = _voice_packet(user.session, user.sequence, frame,
+                             last = user.talking == 0)
+      self.__broadcast(protocol.udp_tunnel(packet),
+                       channel_id = user.channel_id)
+
+  def __simulate(self):
+    last = time.time()
+    while self.keep_going:
+      time.sleep(FRAME_INTERVAL)
+      now = time.time()
+      elapsed, last = now - last, now
+      for kind, rate in self.rates.items():
+        self.__budget[kind] += rate * elapsed
+        while self.__budget[kind] >= 1.0:
+          self.__budget[kind] -= 1.0
+          self.__event(kind)
+      self.__talk()
+
+
+def main(argv):
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("-H", "--host", default = "127.0.0.1",
+                    help = "Address to listen on.")
+  parser.add_option("-p", "--port", type = "int", default = 64738,
+                    help = "Port to listen on.")
+  parser.add_option("--tls", action = "store_true", default = False,
+                    help = "Use TLS, with a self-signed certificate.")
+  parser.add_option("-c", "--channels", type = "int", default = 10,
+                    help = "Number of channels.")
+  parser.add_option("-u", "--users", type = "int", default = 50,
+                    help = "Number of simulated users.")
+  parser.add_option("-s", "--seed", type = "int", default = None,
+                    help = "Seed of the simulation.")
+  options, args = parser.parse_args(argv[1:])
+  logging.basicConfig(level = logging.INFO)
+  emulator = Emulator(options.host, options.port, tls = options.tls,
+                      channels = options.channels, users = options.users,
+                      seed = options.seed)
+  emulator.start()
+  LOGGER.info("Emulating a server on %s:%d." % (options.host, emulator.port))
+  try:
+    while True:
+      time.sleep(10)
+      LOGGER.info("%d users, %d clients." % (emulator.users(),
+                                             emulator.clients()))
+  except KeyboardInterrupt:
+    emulator.stop()
+
+if __name__ == '__main__':
+  main(sys.argv)
@@ -0,0 +1,136 @@
+import collections
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+# What submit() does when max_pending tasks are already waiting.
+OVERFLOW_BLOCK = 'block'  # Wait for room, slowing down the connection.
+OVERFLOW_DROP = 'drop'    # Drop the new task.
+
+# Runs tasks on a bounded pool of threads, in order for each key: tasks
+# submitted with the same key (the session of the user who sent the message,
+# for bots) never run concurrently, and run in the order they were submitted.
+# Tasks of different keys run in parallel.
+class SessionExecutor(object):
+  def __init__(self, workers = 4, max_pending = 1024,
+                     overflow = OVERFLOW_BLOCK):
+    """
+    Arguments: workers Number of threads running the tasks.
+               max_pending Tasks that can wait to be run, at most.
+               overflow OVERFLOW_BLOCK or OVERFLOW_DROP, what to do with new
+                        tasks when max_pending are waiting.
+    """
+    if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP):
+      raise ValueError("Unknown overflow policy: %r" % overflow)
+    self.max_pending = max_pending
+    self.overflow = overflow
+    self.keep_going = True
+    self.__cond = threading.Condition()
+    # Pending tasks by key, and the keys ready to run, in turn. A key with
+    # pending tasks is either ready or running, never both.
+    self.__queues = {}
+    self.__ready = collections.deque()
+    self.__pending = 0
+    # Metrics.
+    self.submitted = 0
+    self.completed = 0
+    self.dropped = 0
+    self.failed = 0
+    self.max_depth = 0
+    self.busy = 0
+    self.__threads = []
+    for i in range(workers):
+      worker = threading.Thread(target = self.__work,
+                                name = "Mumble Executor %d" % i)
+      worker.daemon = True
+      worker.start()
+      self.__threads.append(worker)
+
+  # Run func(*args) after the tasks already submitted for key. Returns False
+  # if the task was dropped.
+  def submit(self, key, func, *args):
+    self.__cond.acquire()
+    try:
+      while self.keep_going and self.__pending >= self.max_pending:
+        if self.overflow == OVERFLOW_DROP:
+          self.dropped += 1
+          LOGGER.warning("Executor full, dropping %r." % func)
+          return False
+        self.__cond.wait()
+      if not self.keep_going:
+        return False
+      queue = self.__queues.get(key)
+      if queue is None:
+        queue = self.__queues[key] = collections.deque()
+        self.__ready.append(key)
+      queue.append((func, args))
+      self.__pending += 1
+      self.submitted += 1
+      self.max_depth = max(self.max_depth, self.__pending)
+      self.__cond.notify_all()
+      return True
+    finally:
+      self.__cond.release()
+
+  # Number of tasks waiting to be run.
+  def depth(self):
+    return self.__pending
+
+  # Depth of the queue of each key with tasks waiting.
+  def depths(self):
+    self.__cond.acquire()
+    try:
+      return dict((key, len(queue)) for key, queue in self.__queues.items()
+                  if queue)
+    finally:
+      self.__cond.release()
+
+  # Stop the workers once they are done with the tasks already submitted.
+  def shutdown(self, wait = True):
+    self.__cond.acquire()
+    try:
+      self.keep_going = False
+      self.__cond.notify_all()
+    finally:
+      self.__cond.release()
+    if wait:
+      for worker in self.__threads:
+        if worker is not threading.current_thread():
+          worker.join()
+
+  ##############################################################################
+  # Private.
+  def __work(self):
+    while True:
+      self.__cond.acquire()
+      try:
+        while not self.__ready and (self.keep_going or self.__pending):
+          self.__cond.wait()
+        if not self.__ready:
+          return
+        key = self.__ready.popleft()
+        func, args = self.__queues[key].popleft()
+        self.__pending -= 1
+        self.busy += 1
+        # There is room for a blocked submit().
+        self.__cond.notify_all()
+      finally:
+        self.__cond.release()
+      try:
+        func(*args)
+      except Exception:
+        self.failed += 1
+        LOGGER.exception("Error in %r." % func)
+      self.__cond.acquire()
+      try:
+        self.busy -= 1
+        self.completed += 1
+        if self.__queues[key]:
+          # Back of the line, so busy keys don't starve the others.
+          self.__ready.append(key)
+          self.__cond.notify_all()
+        else:
+          del self.__queues[key]
+      finally:
+        self.__cond.release()
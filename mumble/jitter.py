@@ -0,0 +1,243 @@
+import math
+import thread
+import time
+
+# Seconds of audio per unit of the sequence numbers of voice packets:
+# clients count 10 ms frames.
+SEQUENCE_DURATION = 0.01
+
+# Counters of a JitterBuffer.
+class JitterStats(object):
+  def __init__(self):
+    self.received = 0
+    self.released = 0
+    # Packets never received, seen from the gaps in the sequence numbers.
+    self.lost = 0
+    # Packets received after their turn to be played, dropped.
+    self.late = 0
+    self.duplicates = 0
+    # Packets too far ahead of the playout to fit in the buffer.
+    self.overflows = 0
+    # Interarrival jitter in seconds, estimated as in RFC 3550.
+    self.jitter = 0.0
+
+  def __repr__(self):
+    return ("JitterStats(received=%d, released=%d, lost=%d, late=%d, "
+            "duplicates=%d, overflows=%d, jitter=%.1fms)" % (
+            self.received, self.released, self.lost, self.late,
+            self.duplicates, self.overflows, self.jitter * 1000))
+
+
+# Voice packets of one speaker, released in sequence order, delay seconds
+# after the first packet of each transmission would have been. The packets
+# are held in a ring of size slots indexed by sequence number, so the buffer
+# never holds more than size sequence numbers ahead of the playout.
+# A transmission ends with its last packet (the one with the terminator), or
+# when the next packet is too far ahead, in time or sequence, to be part of
+# it; the silence until the next one isn't counted as lost.
+class JitterBuffer(object):
+  def __init__(self, delay = 0.06, size = 64):
+    """
+    Arguments: delay Seconds the packets wait, to absorb the jitter.
+               size Slots of the ring, in sequence numbers (10 ms each).
+    """
+    self.delay = delay
+    self.size = size
+    self.stats = JitterStats()
+    self.last_arrival = None
+    self.__ring = [None] * size
+    self.__pending = 0
+    # Sequence number and time at which the transmission started playing.
+    self.__base_sequence = None
+    self.__base_time = None
+    # Next sequence number to release, and highest one received.
+    self.__next = None
+    self.__highest = None
+    self.__last_released = None
+    # Whether the last packet released ended its transmission.
+    self.__ended = False
+    # Sequence number of the last packet of the transmission, once received.
+    self.__end = None
+    # Smallest step between two packets released in a row: the sequence
+    # numbers a packet spans.
+    self.__step = None
+    self.__transit = None
+
+  # Buffer item, the packet with the given sequence number, received at now.
+  # last tells whether it ends the transmission.
+  def put(self, sequence, item, now, last = False):
+    stats = self.stats
+    stats.received += 1
+    if self.__next is not None and not self.__pending and (
+        (self.__end is not None and sequence > self.__end) or
+        sequence >= self.__next + self.size or
+        now - self.last_arrival > self.delay + self.size * SEQUENCE_DURATION):
+      # A new transmission, whatever its numbering.
+      self.reset()
+    self.last_arrival = now
+    self.__update_jitter(sequence, now)
+    if self.__next is None:
+      self.__base_sequence = self.__next = self.__highest = sequence
+      self.__base_time = now + self.delay
+    elif (sequence < self.__next and self.__last_released is None and
+          self.__highest - sequence < self.size):
+      # Reordered before anything was played: start the transmission here.
+      self.__base_sequence = self.__next = sequence
+    if sequence < self.__next:
+      if sequence == self.__last_released:
+        stats.duplicates += 1
+      else:
+        stats.late += 1
+      return
+    if sequence >= self.__next + self.size:
+      # Can't wait for the packets in between without growing.
+      stats.overflows += 1
+      return
+    index = sequence % self.size
+    slot = self.__ring[index]
+    if slot is not None:
+      stats.duplicates += 1
+      return
+    self.__ring[index] = (sequence, item, last)
+    self.__pending += 1
+    self.__highest = max(self.__highest, sequence)
+    if last:
+      self.__end = sequence
+
+  # The packets due at now, in order, as a list of (sequence, item).
+  def release(self, now):
+    if not self.__pending:
+      return []
+    # Last sequence number due; the epsilon absorbs the rounding errors of
+    # times that are multiples of SEQUENCE_DURATION.
+    due = self.__base_sequence + int(math.floor(
+        (now - self.__base_time) / SEQUENCE_DURATION + 1e-6))
+    released = []
+    ring = self.__ring
+    size = self.size
+    sequence = self.__next
+    while self.__pending and sequence <= due:
+      index = sequence % size
+      slot = ring[index]
+      if slot is not None:
+        ring[index] = None
+        self.__pending -= 1
+        self.__count_gap(sequence, slot[2])
+        released.append(slot[:2])
+      sequence += 1
+    self.__next = sequence
+    self.stats.released += len(released)
+    return released
+
+  # Packets waiting in the buffer.
+  def __len__(self):
+    return self.__pending
+
+  # Forget the transmission; the next packet starts a new one. The packets
+  # still in the buffer are dropped.
+  def reset(self):
+    self.__ring = [None] * self.size
+    self.__pending = 0
+    self.__base_sequence = self.__base_time = None
+    self.__next = self.__highest = self.__last_released = None
+    self.__ended = False
+    self.__end = None
+    self.__step = None
+    self.__transit = None
+
+  ##############################################################################
+  # Private.
+  def __update_jitter(self, sequence, now):
+    transit = now - sequence * SEQUENCE_DURATION
+    if self.__transit is not None:
+      self.stats.jitter += (abs(transit - self.__transit) -
+                            self.stats.jitter) / 16
+    self.__transit = transit
+
+  def __count_gap(self, sequence, ends):
+    last = self.__last_released
+    ended, self.__ended = self.__ended, ends
+    self.__last_released = sequence
+    if last is None or ended:
+      # The first packet, or the first after the end of a transmission.
+      return
+    step = sequence - last
+    if self.__step is None or step < self.__step:
+      self.__step = step
+    elif step > self.__step:
+      self.stats.lost += step // self.__step - 1
+
+
+# A JitterBuffer per speaking session, released together on a fixed cadence
+# by calling release() every interval seconds. The buffer of a speaker is
+# dropped once they've been silent for expire seconds.
+class JitterBuffers(object):
+  def __init__(self, delay = 0.06, interval = 0.02, size = 64,
+                     expire = 60.0):
+    """
+    Arguments: delay Seconds the packets wait, to absorb the jitter.
+               interval Seconds between two release() calls.
+               size Slots of the ring of each speaker, in sequence numbers.
+               expire Seconds of silence after which a speaker is forgotten.
+    """
+    self.delay = delay
+    self.interval = interval
+    self.size = size
+    self.expire = expire
+    self.mutex = thread.allocate_lock()
+    self.__buffers = {}
+
+  def put(self, session, sequence, item, now = None, last = False):
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      buf = self.__buffers.get(session)
+      if buf is None:
+        buf = self.__buffers[session] = JitterBuffer(self.delay, self.size)
+      buf.put(sequence, item, now, last)
+    finally:
+      self.mutex.release()
+
+  # The packets of all the speakers due at now, as a list of
+  # (session, sequence, item), in order for each session.
+  def release(self, now = None):
+    if now is None:
+      now = time.time()
+    released = []
+    self.mutex.acquire()
+    try:
+      for session, buf in self.__buffers.items():
+        if buf:
+          for sequence, item in buf.release(now):
+            released.append((session, sequence, item))
+        elif now - buf.last_arrival > self.expire:
+          del self.__buffers[session]
+    finally:
+      self.mutex.release()
+    return released
+
+  # Forget a speaker, e.g. once they left.
+  def remove(self, session):
+    self.mutex.acquire()
+    try:
+      self.__buffers.pop(session, None)
+    finally:
+      self.mutex.release()
+
+  # The JitterStats of each speaker, by session.
+  def stats(self):
+    self.mutex.acquire()
+    try:
+      return dict((session, buf.stats)
+                  for session, buf in self.__buffers.items())
+    finally:
+      self.mutex.release()
+
+  # Packets waiting in all the buffers.
+  def __len__(self):
+    self.mutex.acquire()
+    try:
+      return sum(len(buf) for buf in self.__buffers.values())
+    finally:
+      self.mutex.release()
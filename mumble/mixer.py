@@ -0,0 +1,310 @@
+# Mixing of the voice of all the speakers into a single stream of PCM: 16-bit
+# mono samples at 48 kHz, in blocks of 20 ms.
+#
+#   bot.mixer = mumble.VoiceMixer()
+#   bot.start(server, nickname)
+#   ...
+#   def on_voice_mix(self, pcm):  # In the bot, every 20 ms while voice comes.
+#     ...
+#
+# This needs NumPy, and libopus (found by ctypes) to decode Opus frames.
+# Without libopus, PCM can still be mixed with put_pcm().
+
+import ctypes
+import ctypes.util
+import logging
+import thread
+import time
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from jitter import SEQUENCE_DURATION
+from recorder import SAMPLE_RATE
+import protocol
+
+LOGGER = logging.getLogger(__name__)
+
+_SAMPLES_PER_SEQUENCE = int(SAMPLE_RATE * SEQUENCE_DURATION)
+# The most audio an Opus packet can hold, in samples (120 ms).
+_MAX_PACKET_SAMPLES = 5760
+
+_libopus = None
+_opus_searched = False
+
+# Load libopus from path, or wherever the system keeps it. Returns whether it
+# could be loaded.
+def load_opus(path = None):
+  global _libopus, _opus_searched
+  _opus_searched = True
+  path = path or ctypes.util.find_library('opus')
+  if path is None:
+    return False
+  try:
+    lib = ctypes.CDLL(path)
+  except OSError as e:
+    LOGGER.warning("Couldn't load libopus from %s: %s" % (path, e))
+    return False
+  lib.opus_decoder_create.restype = ctypes.c_void_p
+  lib.opus_decoder_create.argtypes = [ctypes.c_int32, ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int)]
+  lib.opus_decode.restype = ctypes.c_int
+  lib.opus_decode.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int32,
+                              ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+  lib.opus_decoder_destroy.restype = None
+  lib.opus_decoder_destroy.argtypes = [ctypes.c_void_p]
+  _libopus = lib
+  return True
+
+# Whether Opus frames can be decoded. libopus is looked for the first time
+# it's needed.
+def opus_available():
+  if not _opus_searched:
+    load_opus()
+  return _libopus is not None
+
+
+# Stateful Opus decoder of one speaker, to mono 48 kHz PCM.
+class OpusDecoder(object):
+  def __init__(self):
+    if not opus_available():
+      raise RuntimeError("libopus is not available.")
+    error = ctypes.c_int()
+    self.__decoder = _libopus.opus_decoder_create(SAMPLE_RATE, 1,
+                                                  ctypes.byref(error))
+    if error.value:
+      raise RuntimeError("Couldn't create an Opus decoder: %d" % error.value)
+    self.__pcm = numpy.empty(_MAX_PACKET_SAMPLES, numpy.int16)
+    self.__pcm_pointer = self.__pcm.ctypes.data
+
+  # The samples of packet, or samples of concealment for lost packets if
+  # packet is None. The array is reused by the next call.
+  def decode(self, packet, samples = _MAX_PACKET_SAMPLES):
+    if packet is None:
+      count = _libopus.opus_decode(self.__decoder, None, 0,
+                                   self.__pcm_pointer, samples, 0)
+    else:
+      count = _libopus.opus_decode(self.__decoder, packet, len(packet),
+                                   self.__pcm_pointer, _MAX_PACKET_SAMPLES, 0)
+    if count < 0:
+      raise ValueError("Opus decoding failed: %d" % count)
+    return self.__pcm[:count]
+
+  def __del__(self):
+    decoder = getattr(self, '_OpusDecoder__decoder', None)
+    if decoder and _libopus is not None:
+      _libopus.opus_decoder_destroy(decoder)
+
+
+# What the mixer knows of a speaker.
+class _Speaker(object):
+  def __init__(self, slot):
+    self.slot = slot
+    self.decoder = None
+    self.next_sequence = None
+    self.last_arrival = None
+
+
+# Mixes the voice of up to max_speakers speakers. The PCM of every speaker
+# goes to its row of a ring of samples shared by all of them, read at once:
+# mix() takes the next block of every row in one array operation, applies
+# the gain of each speaker, and clips the sum to 16 bits.
+class VoiceMixer(object):
+  def __init__(self, block_duration = 0.02, delay = 0.06, max_speakers = 32,
+                     buffer_duration = 1.0, max_concealment = 0.1,
+                     expire = 60.0):
+    """
+    Arguments: block_duration Seconds of audio per block mixed.
+               delay Seconds of audio buffered when a speaker starts, to
+                     absorb the jitter.
+               max_speakers Speakers mixed at once, others are ignored.
+               buffer_duration Seconds of audio buffered per speaker, at most.
+               max_concealment Lost audio replaced by concealment, in
+                               seconds. Longer gaps are left out.
+               expire Seconds of silence after which a speaker gives their
+                      place to others.
+    """
+    if numpy is None:
+      raise RuntimeError("VoiceMixer needs NumPy.")
+    self.block_duration = block_duration
+    self.block = int(block_duration * SAMPLE_RATE)
+    self.delay = delay
+    self.max_speakers = max_speakers
+    self.max_concealment = max_concealment
+    self.expire = expire
+    self.mutex = thread.allocate_lock()
+    # Frames dropped: other codecs, undecodable, or speakers in excess.
+    self.skipped = 0
+    # Samples dropped because the buffer of their speaker was full.
+    self.overflows = 0
+    # Whole blocks, so a block never wraps around the ring.
+    blocks = max(1, int(buffer_duration / block_duration))
+    self.capacity = blocks * self.block
+    self.__ring = numpy.zeros((max_speakers, self.capacity), numpy.int16)
+    self.__gains = numpy.zeros(max_speakers, numpy.float32)
+    # Absolute sample positions: where mix() reads, and where each speaker
+    # writes next.
+    self.__read = 0
+    self.__write = numpy.zeros(max_speakers, numpy.int64)
+    self.__speakers = {}
+    self.__free = range(max_speakers - 1, -1, -1)
+    self.__custom_gains = {}
+    self.__warned = False
+
+  # Decode and buffer the frames of a voice packet of session.
+  def put(self, session, sequence, codec, frames, now = None):
+    if codec != protocol.VOICE_OPUS or not opus_available():
+      if codec == protocol.VOICE_OPUS and not self.__warned:
+        LOGGER.warning("libopus is not available, Opus voice isn't mixed.")
+        self.__warned = True
+      self.skipped += len(frames)
+      return
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      speaker = self.__speaker(session, now)
+      if speaker is None:
+        self.skipped += len(frames)
+        return
+      if speaker.decoder is None:
+        speaker.decoder = OpusDecoder()
+      for frame in frames:
+        if not len(frame):
+          speaker.next_sequence = None
+          continue
+        self.__conceal(speaker, sequence)
+        try:
+          pcm = speaker.decoder.decode(frame.tobytes()
+                                       if isinstance(frame, memoryview)
+                                       else frame)
+        except ValueError:
+          self.skipped += 1
+          continue
+        self.__append(speaker.slot, pcm)
+        sequence += len(pcm) // _SAMPLES_PER_SEQUENCE
+        speaker.next_sequence = sequence
+    finally:
+      self.mutex.release()
+
+  # Buffer PCM of session (16-bit mono 48 kHz samples, any sequence NumPy
+  # takes), decoded by other means.
+  def put_pcm(self, session, pcm, now = None):
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      speaker = self.__speaker(session, now)
+      if speaker is None:
+        self.skipped += 1
+        return
+      self.__append(speaker.slot, numpy.asarray(pcm, numpy.int16))
+    finally:
+      self.mutex.release()
+
+  # The next block of the mix, as a NumPy array of int16. Speakers without
+  # audio for it count as silent.
+  def mix(self):
+    self.mutex.acquire()
+    try:
+      start = self.__read % self.capacity
+      end = start + self.block
+      rows = self.__ring[:, start:end]
+      mixed = numpy.dot(self.__gains, rows)
+      rows.fill(0)
+      self.__read += self.block
+    finally:
+      self.mutex.release()
+    numpy.rint(mixed, out = mixed)
+    numpy.clip(mixed, -32768, 32767, out = mixed)
+    return mixed.astype(numpy.int16)
+
+  # Whether some audio waits to be mixed.
+  def pending(self):
+    self.mutex.acquire()
+    try:
+      return bool((self.__write > self.__read).any())
+    finally:
+      self.mutex.release()
+
+  # Gain of the voice of session, 1.0 by default.
+  def set_gain(self, session, gain):
+    self.mutex.acquire()
+    try:
+      self.__custom_gains[session] = gain
+      speaker = self.__speakers.get(session)
+      if speaker is not None:
+        self.__gains[speaker.slot] = gain
+    finally:
+      self.mutex.release()
+
+  # Forget a speaker, e.g. once they left.
+  def remove(self, session):
+    self.mutex.acquire()
+    try:
+      self.__custom_gains.pop(session, None)
+      speaker = self.__speakers.pop(session, None)
+      if speaker is not None:
+        self.__release(speaker)
+    finally:
+      self.mutex.release()
+
+  ##############################################################################
+  # Private.
+  def __speaker(self, session, now):
+    speaker = self.__speakers.get(session)
+    if speaker is None:
+      if not self.__free:
+        self.__expire(now)
+      if not self.__free:
+        return None
+      speaker = self.__speakers[session] = _Speaker(self.__free.pop())
+      self.__gains[speaker.slot] = self.__custom_gains.get(session, 1.0)
+    speaker.last_arrival = now
+    return speaker
+
+  def __expire(self, now):
+    for session, speaker in self.__speakers.items():
+      if now - speaker.last_arrival > self.expire:
+        del self.__speakers[session]
+        self.__release(speaker)
+
+  def __release(self, speaker):
+    slot = speaker.slot
+    self.__ring[slot].fill(0)
+    self.__gains[slot] = 0
+    self.__write[slot] = 0
+    self.__free.append(slot)
+
+  # Conceal the packets lost before sequence, if not too many.
+  def __conceal(self, speaker, sequence):
+    if speaker.next_sequence is None:
+      return
+    gap = sequence - speaker.next_sequence
+    if 0 < gap * SEQUENCE_DURATION <= self.max_concealment:
+      samples = gap * _SAMPLES_PER_SEQUENCE
+      while samples > 0:
+        pcm = speaker.decoder.decode(None, min(samples, _MAX_PACKET_SAMPLES))
+        if not len(pcm):
+          break
+        self.__append(speaker.slot, pcm)
+        samples -= len(pcm)
+
+  def __append(self, slot, pcm):
+    position = int(self.__write[slot])
+    if position <= self.__read:
+      # Starting, or drained: buffer again.
+      position = self.__read + int(self.delay * SAMPLE_RATE)
+    count = min(len(pcm), self.__read + self.capacity - position)
+    if count < len(pcm):
+      self.overflows += len(pcm) - max(count, 0)
+    if count <= 0:
+      return
+    row = self.__ring[slot]
+    start = position % self.capacity
+    first = min(count, self.capacity - start)
+    row[start:start + first] = pcm[:first]
+    row[:count - first] = pcm[first:count]
+    self.__write[slot] = position + count
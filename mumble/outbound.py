@@ -0,0 +1,98 @@
+import collections
+import errno
+import socket
+import ssl
+import thread
+
+# Lanes of the outbound queue, served in this order.
+PRIORITY_HIGH = 0    # Pings and voice, which are time sensitive.
+PRIORITY_NORMAL = 1  # Everything else (text, state changes, requests...).
+
+# Errors meaning a non-blocking socket can't take more data for now.
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Queue of serialized frames waiting to be written to the server. Any thread
+# can push frames; only the loop driving the connection flushes them, once the
+# socket is writable. Many small frames are coalesced into a single write, so
+# they go out in a single TLS record.
+class OutboundQueue(object):
+  def __init__(self, max_write = 16384):
+    self.max_write = max_write
+    self.bytes_pending = 0
+    self.mutex = thread.allocate_lock()
+    self.__lanes = (collections.deque(), collections.deque())
+    # Data of a write that didn't go through entirely. It must be written
+    # again, as is, before anything else.
+    self.__partial = None
+
+  def __len__(self):
+    return self.depth()
+
+  # Number of frames waiting to be written.
+  def depth(self):
+    self.mutex.acquire()
+    try:
+      count = len(self.__lanes[0]) + len(self.__lanes[1])
+      if self.__partial is not None:
+        count += 1
+      return count
+    finally:
+      self.mutex.release()
+
+  def push(self, frame, priority = PRIORITY_NORMAL):
+    self.mutex.acquire()
+    try:
+      self.__lanes[priority].append(frame)
+      self.bytes_pending += len(frame)
+    finally:
+      self.mutex.release()
+
+  # Write as much as the non-blocking socket sock accepts. Returns True when
+  # the queue is empty afterward.
+  def flush(self, sock):
+    while True:
+      data = self.__next_write()
+      if data is None:
+        return True
+      try:
+        sent = sock.send(data)
+      except ssl.SSLError as e:
+        if e.errno not in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+          raise
+        sent = 0
+      except socket.error as e:
+        if e.errno not in _WOULD_BLOCK:
+          raise
+        sent = 0
+      self.mutex.acquire()
+      try:
+        self.bytes_pending -= sent
+        if sent < len(data):
+          self.__partial = data[sent:]
+          return False
+      finally:
+        self.mutex.release()
+
+  # Pop the next chunk of data to write, coalescing as many frames as fit in
+  # max_write, high priority first.
+  def __next_write(self):
+    self.mutex.acquire()
+    try:
+      if self.__partial is not None:
+        data, self.__partial = self.__partial, None
+        return data
+      chunk = []
+      size = 0
+      for lane in self.__lanes:
+        while lane and (not chunk or size + len(lane[0]) <= self.max_write):
+          frame = lane.popleft()
+          chunk.append(frame)
+          size += len(frame)
+        if lane:
+          # Lower priority frames wait for the next write.
+          break
+      if not chunk:
+        return None
+      return ''.join(chunk)
+    finally:
+      self.mutex.release()
@@ -0,0 +1,211 @@
+# Sending voice: Opus packets, from an Ogg Opus file or any iterable of
+# packets, sent at the pace of the audio they hold.
+#
+#   bot.play('greeting.opus')
+#
+# The packets are sent as they are, nothing is decoded or encoded again.
+# They must be of a rate the server accepts (mono, 48 kHz).
+
+import logging
+import struct
+import time
+
+from recorder import SAMPLE_RATE, opus_samples
+import protocol
+
+LOGGER = logging.getLogger(__name__)
+
+# Ogg page header, up to the number of segments (see recorder).
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+# The most audio an Opus packet can hold, in samples (120 ms).
+_MAX_PACKET_SAMPLES = 5760
+
+# How far behind or ahead of its schedule a player can get, in seconds,
+# before it starts again from now, e.g. after the clock was changed.
+_MAX_LAG = 0.5
+_MAX_LEAD = 1.0
+
+# Iterate over the audio packets of an Ogg Opus file (a path or a file
+# object), reading it page by page. The OpusHead and OpusTags headers are
+# checked and skipped.
+def read_ogg_opus(source):
+  fin = open(source, 'rb') if isinstance(source, basestring) else source
+  try:
+    packet = []
+    headers = 0
+    while True:
+      header = fin.read(_PAGE_HEADER.size)
+      if len(header) < _PAGE_HEADER.size:
+        return
+      capture, _, _, _, _, _, _, segments = _PAGE_HEADER.unpack(header)
+      if capture != 'OggS':
+        raise ValueError("Not an Ogg stream.")
+      lacing = fin.read(segments)
+      body = fin.read(sum(bytearray(lacing)))
+      pos = 0
+      for size in bytearray(lacing):
+        packet.append(body[pos:pos + size])
+        pos += size
+        if size == 255:
+          # The packet goes on in the next segment, maybe on the next page.
+          continue
+        data = ''.join(packet)
+        packet = []
+        if headers == 0 and not data.startswith('OpusHead'):
+          raise ValueError("Not an Ogg Opus stream.")
+        if headers < 2:
+          headers += 1
+          continue
+        yield data
+  finally:
+    if fin is not source:
+      fin.close()
+
+# Frame length in the format of Opus packets of several frames.
+def _frame_length(length):
+  if length < 252:
+    return chr(length)
+  first = 252 + ((length - 252) & 0b11)
+  return chr(first) + chr((length - first) >> 2)
+
+# Join Opus packets of one frame each, of the same mode, into one packet of
+# several frames (RFC 6716, 3.2.5), without decoding them. Returns None if
+# they can't be joined.
+def join_opus_packets(packets):
+  if len(packets) == 1:
+    return packets[0]
+  toc = packets[0][0]
+  for packet in packets:
+    if packet[0] != toc or ord(packet[0]) & 0b11 or len(packet) > 1276:
+      return None
+  frames = [packet[1:] for packet in packets]
+  # Code 3, variable bitrate: the length of every frame but the last.
+  return (chr(ord(toc) | 0b11) + chr(0x80 | len(frames)) +
+          ''.join(_frame_length(len(frame)) for frame in frames[:-1]) +
+          ''.join(frames))
+
+
+# Sends the packets of source as the voice of a connection, each when the
+# previous one has played. The schedule is kept from the start of the
+# playback, so it doesn't drift with the delays of the timers.
+class VoicePlayer(object):
+  def __init__(self, send, timers, source, target = 0,
+                     frames_per_packet = 1, sequence = 0, on_done = None):
+    """
+    Arguments: send Function sending a voice packet, e.g.
+                    Connection.send_voice.
+               timers Scheduler running the player.
+               source Path or file object of an Ogg Opus file, or iterable
+                      of Opus packets.
+               target Voice target, 0 to talk to the channel.
+               frames_per_packet Opus packets joined in each voice packet,
+                                 when they can be.
+               sequence Sequence number of the first packet, in 10 ms units.
+               on_done Called with the player once it's done or stopped.
+    """
+    if isinstance(source, basestring) or hasattr(source, 'read'):
+      source = read_ogg_opus(source)
+    self.send = send
+    self.timers = timers
+    self.target = target
+    self.frames_per_packet = frames_per_packet
+    self.sequence = sequence
+    self.on_done = on_done
+    self.packets = 0
+    self.done = False
+    self.__source = iter(source)
+    self.__ahead = []
+    self.__start = None
+    self.__samples = 0
+    self.__timer = None
+
+  def start(self):
+    self.__start = time.time()
+    self.__timer = self.timers.call_at(self.__start, self.__play)
+    return self
+
+  def stop(self):
+    if self.__timer is not None:
+      self.__timer.cancel()
+    self.__end()
+
+  ##############################################################################
+  # Private.
+  def __play(self):
+    if self.done:
+      return
+    try:
+      packet, samples = self.__next_packet()
+      last = packet is not None and not self.__fill(1)
+    except Exception:
+      LOGGER.exception("Error reading the voice to play.")
+      self.__end()
+      return
+    if packet is None:
+      self.__end()
+      return
+    self.send(protocol.opus_voice(self.sequence, packet, last = last,
+                                  target = self.target))
+    self.packets += 1
+    self.sequence += samples * 100 // SAMPLE_RATE
+    self.__samples += samples
+    if last:
+      self.__finish()
+      return
+    now = time.time()
+    due = self.__start + float(self.__samples) / SAMPLE_RATE
+    if due < now - _MAX_LAG or due > now + _MAX_LEAD:
+      LOGGER.warning("Voice playback off schedule by %.2fs, resyncing." %
+                     (due - now))
+      self.__start = now - float(self.__samples) / SAMPLE_RATE
+      due = now
+    self.__timer = self.timers.call_at(due, self.__play)
+
+  # Read packets ahead of playback, until count are waiting. Returns False
+  # at the end of the source.
+  def __fill(self, count):
+    while len(self.__ahead) < count:
+      try:
+        packet = next(self.__source)
+      except StopIteration:
+        return bool(self.__ahead)
+      if packet:
+        self.__ahead.append((packet, opus_samples(packet)))
+    return True
+
+  # The next voice packet to send and its samples, or (None, 0).
+  def __next_packet(self):
+    if not self.__fill(self.frames_per_packet):
+      return None, 0
+    count = len(self.__ahead)
+    # As many as fit in a packet and can be joined.
+    while count > 1:
+      batch = self.__ahead[:count]
+      samples = sum(s for _, s in batch)
+      if samples <= _MAX_PACKET_SAMPLES:
+        packet = join_opus_packets([p for p, _ in batch])
+        if packet is not None:
+          del self.__ahead[:count]
+          return packet, samples
+      count -= 1
+    return self.__ahead.pop(0)
+
+  # Finish before the last packet was sent: end the transmission with an
+  # empty packet, so the receivers don't wait for more.
+  def __end(self):
+    if self.done:
+      return
+    if self.packets:
+      self.send(protocol.opus_voice(self.sequence, '', last = True,
+                                    target = self.target))
+      self.sequence += 1
+    self.__finish()
+
+  def __finish(self):
+    if self.done:
+      return
+    self.done = True
+    self.__timer = None
+    if self.on_done is not None:
+      self.on_done(self)
@@ -9,9 +9,16 @@ import struct
 
 import mumble_pb2
 
+try:
+  from google.protobuf.internal import api_implementation
+  _PURE_PYTHON_PROTOBUF = api_implementation.Type() == 'python'
+except ImportError:
+  _PURE_PYTHON_PROTOBUF = True
+
 
 HEADER_FORMAT = ">HI"
 HEADER_SIZE = 6
+HEADER_STRUCT = struct.Struct(HEADER_FORMAT)
 MESSAGE_TYPE_LOOKUP = {
     mumble_pb2.Version: 0,
     mumble_pb2.UDPTunnel: 1,
@@ -36,10 +43,13 @@ MESSAGE_TYPE_LOOKUP = {
     mumble_pb2.PermissionQuery: 20,
     mumble_pb2.CodecVersion: 21,
     mumble_pb2.UserStats: 22,
-    mumble_pb2.SuggestConfig: 23,
-    mumble_pb2.RequestBlob: 24
+    mumble_pb2.RequestBlob: 23,
+    mumble_pb2.ServerConfig: 24,
+    mumble_pb2.SuggestConfig: 25
 }
 TYPE_MESSAGE_LOOKUP = dict((v,k) for k, v in MESSAGE_TYPE_LOOKUP.iteritems())
+_TYPE_PING = MESSAGE_TYPE_LOOKUP[mumble_pb2.Ping]
+_TYPE_USER_STATS = MESSAGE_TYPE_LOOKUP[mumble_pb2.UserStats]
 
 def serialize_(msg):
   sz = msg.SerializeToString()
@@ -47,8 +57,73 @@ def serialize_(msg):
           + sz)
 
 
+# Frame cache.
+# Frames that never change are kept once serialized, by the arguments of
+# their builder. Frames sent over and over with a few integers changing
+# (pings, stats requests) are encoded directly in the protobuf wire format,
+# without building a message; anything these fast paths don't expect (e.g.
+# values out of range) goes through protobuf as usual.
+_FRAME_CACHE = {}
+_FRAME_CACHE_SIZE = 1024
+
+def _cached(key, build, *kargs):
+  frame = _FRAME_CACHE.get(key)
+  if frame is None:
+    if len(_FRAME_CACHE) >= _FRAME_CACHE_SIZE:
+      _FRAME_CACHE.clear()
+    frame = _FRAME_CACHE[key] = build(*kargs)
+  return frame
+
+_UINT32_MAX = 0xFFFFFFFF
+_UINT64_MAX = 0xFFFFFFFFFFFFFFFF
+_FLOAT_STRUCT = struct.Struct("<f")
+
+# Protobuf varint: base 128, least significant group first.
+def _pb_varint(value):
+  if value < 0x80:
+    return chr(value)
+  out = []
+  while value >= 0x80:
+    out.append(chr((value & 0x7F) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+  return ''.join(out)
+
+def _frame(msg_type, body):
+  return HEADER_STRUCT.pack(msg_type, len(body)) + body
+
+# Tags of the fields of Ping.
+_PING_TAGS = tuple(chr(number << 3) for number in range(8)) + tuple(
+    chr(number << 3 | 5) for number in range(8, 12))
+
+# Body of a Ping from the (tag, value) of its unsigned integer fields after
+# the timestamp, and of its float fields. None if a value doesn't fit.
+def _ping_body(timestamp, uints, floats):
+  body = ''
+  try:
+    if timestamp:
+      if not 0 < timestamp <= _UINT64_MAX:
+        return None
+      body = '\x08' + _pb_varint(timestamp)
+    for tag, value in uints:
+      if value:
+        if not 0 < value <= _UINT32_MAX:
+          return None
+        body += tag + _pb_varint(value)
+  except TypeError:
+    # Not an integer.
+    return None
+  for tag, value in floats:
+    if value:
+      body += tag + _FLOAT_STRUCT.pack(value)
+  return body
+
+
 # Protobuf Builders.
 def version(os = platform.system(), name = ""):
+  return _cached(('version', os, name), _version, os, name)
+
+def _version(os, name):
   msg = mumble_pb2.Version()
   msg.release = "1.2.2"
   msg.version = 66050
@@ -58,6 +133,12 @@ def version(os = platform.system(), name = ""):
 
 def authenticate(username, password = None, tokens = None, celt_versions = None,
                  opus = False):
+  if tokens or celt_versions:
+    return _authenticate(username, password, tokens, celt_versions, opus)
+  return _cached(('authenticate', username, password, opus), _authenticate,
+                 username, password, tokens, celt_versions, opus)
+
+def _authenticate(username, password, tokens, celt_versions, opus):
   msg = mumble_pb2.Authenticate()
   msg.username = username
   if password: msg.password = password
@@ -66,11 +147,48 @@ def authenticate(username, password = None, tokens = None, celt_versions = None,
   if opus: msg.opus = msg.opus
   return serialize_(msg)
 
-def ping(timestamp = None):
+def ping(timestamp = None, good = None, late = None, lost = None,
+         resync = None, udp_packets = None, tcp_packets = None,
+         udp_ping_avg = None, udp_ping_var = None, tcp_ping_avg = None,
+         tcp_ping_var = None):
+  # The C++ implementation of protobuf builds a Ping faster than this.
+  body = None
+  if _PURE_PYTHON_PROTOBUF:
+    tags = _PING_TAGS
+    body = _ping_body(timestamp,
+                      ((tags[2], good), (tags[3], late), (tags[4], lost),
+                       (tags[5], resync), (tags[6], udp_packets),
+                       (tags[7], tcp_packets)),
+                      ((tags[8], udp_ping_avg), (tags[9], udp_ping_var),
+                       (tags[10], tcp_ping_avg), (tags[11], tcp_ping_var)))
+  if body is not None:
+    return _frame(_TYPE_PING, body)
   msg = mumble_pb2.Ping()
   if timestamp: msg.timestamp = timestamp
+  if good: msg.good = good
+  if late: msg.late = late
+  if lost: msg.lost = lost
+  if resync: msg.resync = resync
+  if udp_packets: msg.udp_packets = udp_packets
+  if tcp_packets: msg.tcp_packets = tcp_packets
+  if udp_ping_avg: msg.udp_ping_avg = udp_ping_avg
+  if udp_ping_var: msg.udp_ping_var = udp_ping_var
+  if tcp_ping_avg: msg.tcp_ping_avg = tcp_ping_avg
+  if tcp_ping_var: msg.tcp_ping_var = tcp_ping_var
+  return serialize_(msg)
+
+def crypt_setup(key = None, client_nonce = None, server_nonce = None):
+  msg = mumble_pb2.CryptSetup()
+  if key: msg.key = key
+  if client_nonce: msg.client_nonce = client_nonce
+  if server_nonce: msg.server_nonce = server_nonce
   return serialize_(msg)
 
+# UDPTunnel are not encapsulated in protobufs, the voice packet is the body.
+def udp_tunnel(packet):
+  return (struct.pack(HEADER_FORMAT, MESSAGE_TYPE_LOOKUP[mumble_pb2.UDPTunnel],
+                      len(packet)) + packet)
+
 def text_message(actor = None, session = None, channels = None, tree = None,
                  message = None):
   msg = mumble_pb2.TextMessage()
@@ -81,6 +199,17 @@ def text_message(actor = None, session = None, channels = None, tree = None,
   if message: msg.message = message
   return serialize_(msg)
 
+def user_state(session = None, channel_id = None, self_mute = None,
+               self_deaf = None, comment = None):
+  msg = mumble_pb2.UserState()
+  if session: msg.session = session
+  # The root channel is 0.
+  if channel_id is not None: msg.channel_id = channel_id
+  if self_mute is not None: msg.self_mute = self_mute
+  if self_deaf is not None: msg.self_deaf = self_deaf
+  if comment is not None: msg.comment = comment
+  return serialize_(msg)
+
 def request_blob(texture = None, comment = None, description = None):
   msg = mumble_pb2.RequestBlob()
   if texture: msg.session_texture.extend(texture)
@@ -89,6 +218,9 @@ def request_blob(texture = None, comment = None, description = None):
   return serialize_(msg)
 
 def user_stats(session):
+  if isinstance(session, (int, long)) and 0 <= session <= _UINT32_MAX:
+    # Field 1, even when 0.
+    return _frame(_TYPE_USER_STATS, '\x08' + _pb_varint(session))
   msg = mumble_pb2.UserStats()
   msg.session = session
   return serialize_(msg)
@@ -99,6 +231,9 @@ def packet_length(header):
 
 def parse(header, msg):
   msgType, length = struct.unpack(HEADER_FORMAT, header)
+  return parse_body(msgType, msg)
+
+def parse_body(msgType, msg):
   msgClass = TYPE_MESSAGE_LOOKUP[msgType]
   message = msgClass()
   # UDPTunnel are not encapsulated in protobufs, but are just streamed
@@ -109,50 +244,224 @@ def parse(header, msg):
     message.ParseFromString(msg)
   return message
 
-# Decode the session from the varint format
-# (see http://mumble.sourceforge.net/Protocol)
-def _decode_varint(msg):
-  b0 = ord(msg[0])
-  if   b0 & 0b10000000 == 0:
-    # 7 bits
-    return (b0 & 0b01111111, 1)
-  elif b0 & 0b01000000 == 0:
-    # 6 bits + 1 byte
-    return ((b0 & 0b00111111 << 8) | ord(msg[1]), 2)
-  elif b0 & 0b00100000 == 0:
-    # 5 bits + 2 bytes
-    return ((b0 & 0b00011111 << 16) | (ord(msg[1]) << 8) | ord(msg[2]), 3)
-  elif b0 & 0b00010000 == 0:
-    # 4 bits + 3 bytes
-    return ((b0 & 0b00001111 << 24) | (ord(msg[1]) << 16) | (ord(msg[2]) << 8) |
-            ord(msg[3]), 4)
-  elif b0 & 0b00001100 == 0:
-    # 4 bytes
-    return ((ord(msg[1]) << 16) | (ord(msg[2]) << 16) | (ord(msg[3]) << 8) |
-            (ord(msg[4])), 5)
-  elif b0 & 0b00001100 == 1:
-    # 8 bytes
-    return ((ord(msg[1]) << 56) | (ord(msg[2]) << 48) | (ord(msg[3]) << 40) |
-            (ord(msg[4]) << 32) | (ord(msg[5]) << 24) | (ord(msg[6]) << 16) |
-            (ord(msg[7]) <<  8) |  ord(msg[8]), 9)
-  elif b0 & 0b00001100 == 2:
+# A message whose body is only parsed the first time one of its fields is
+# read, so handlers that look at the type, or don't look at all, cost no
+# parsing. msg_class is the mumble_pb2 class it stands for.
+class LazyMessage(object):
+  __slots__ = ('msg_class', 'body', '_message')
+
+  def __init__(self, msg_class, body):
+    self.msg_class = msg_class
+    self.body = body
+    self._message = None
+
+  # The parsed message. Handlers running on several threads may parse it
+  # more than once, never twice in the same thread.
+  def decode(self):
+    message = self._message
+    if message is None:
+      message = self.msg_class()
+      message.ParseFromString(self.body)
+      self._message = message
+    return message
+
+  def __getattr__(self, name):
+    return getattr(self.decode(), name)
+
+  def __str__(self):
+    return str(self.decode())
+
+  def __repr__(self):
+    return "<Lazy %s>" % self.msg_class.__name__
+
+def parse_lazy(msgType, msg):
+  if msgType == 1:
+    # Nothing to parse.
+    return parse_body(msgType, msg)
+  return LazyMessage(TYPE_MESSAGE_LOOKUP[msgType], msg)
+
+# Voice packets. Their type is the codec of their frames, or a ping.
+VOICE_CELT_ALPHA = 0
+VOICE_PING = 1
+VOICE_SPEEX = 2
+VOICE_CELT_BETA = 3
+VOICE_OPUS = 4
+
+# Opus frame header: a varint holding the size of the frame, and whether it
+# ends the transmission.
+_OPUS_SIZE_MASK = 0x1FFF
+_OPUS_TERMINATOR = 0x2000
+
+# Voice ping packet, echoed back by the server over UDP.
+def voice_ping(timestamp):
+  return chr(VOICE_PING << 5) + encode_varint(timestamp)
+
+# Varints of voice packets (see http://mumble.sourceforge.net/Protocol). The
+# leading bits of the first byte tell the size:
+#   0xxxxxxx                      7 bits
+#   10xxxxxx + 1 byte             14 bits
+#   110xxxxx + 2 bytes            21 bits
+#   1110xxxx + 3 bytes            28 bits
+#   111100__ + 4 bytes            32 bits
+#   111101__ + 8 bytes            64 bits
+#   111110__ + varint             negative: ~varint
+#   111111xx                      negative 2 bits: ~xx
+_UINT64_MAX = 0xFFFFFFFFFFFFFFFF
+_UINT16_STRUCT = struct.Struct('>H')
+_UINT32_STRUCT = struct.Struct('>I')
+_UINT64_STRUCT = struct.Struct('>Q')
+
+def encode_varint(value):
+  if value < 0:
+    value = ~value
+    if value <= 0b11:
+      # Negative 2 bits
+      return chr(0b11111100 | value)
     # Negative varint
-    val, length = _decode_varint(msg[1:])
-    return (-val, length + 1)
-  elif b0 & 0b00001100 == 2:
-    # Negative 2 bits
-    return (-(b0 & 0b00000011), 1)
+    return chr(0b11111000) + encode_varint(value)
+  if value < 0x80:
+    return chr(value)
+  elif value < 0x4000:
+    return _UINT16_STRUCT.pack(0x8000 | value)
+  elif value < 0x200000:
+    return chr(0xC0 | (value >> 16)) + _UINT16_STRUCT.pack(value & 0xFFFF)
+  elif value < 0x10000000:
+    return _UINT32_STRUCT.pack(0xE0000000 | value)
+  elif value < 0x100000000:
+    return chr(0xF0) + _UINT32_STRUCT.pack(value)
+  elif value <= _UINT64_MAX:
+    return chr(0xF4) + _UINT64_STRUCT.pack(value)
+  raise ValueError("Value out of range: %d" % value)
+
+# How to decode a varint, by its first byte: (high, size), high being the
+# bits of the value held by the first byte, in place. Varints of one byte
+# are decoded by the lookup alone. A size of 0 is a negative varint.
+def _varint_decoding(b0):
+  if b0 < 0x80:
+    return (b0, 1)
+  if b0 < 0xC0:
+    return ((b0 & 0x3F) << 8, 2)
+  if b0 < 0xE0:
+    return ((b0 & 0x1F) << 16, 3)
+  if b0 < 0xF0:
+    return ((b0 & 0x0F) << 24, 4)
+  if b0 < 0xF4:
+    return (0, 5)
+  if b0 < 0xF8:
+    return (0, 9)
+  if b0 < 0xFC:
+    return (0, 0)
+  # Negative 2 bits
+  return (~(b0 & 0b11), 1)
+
+# Tables keyed by a byte both as a character (strings, buffers and
+# memoryviews) and as an integer (bytearrays).
+_VARINT_DECODING = {}
+_BYTE_VALUES = {}
+for _b in range(256):
+  _VARINT_DECODING[_b] = _VARINT_DECODING[chr(_b)] = _varint_decoding(_b)
+  _BYTE_VALUES[_b] = _BYTE_VALUES[chr(_b)] = _b
+del _b
+
+# Decode the varint at offset in data (a string, buffer, bytearray or
+# memoryview). Returns the value and the size of the varint.
+def decode_varint(data, offset = 0):
+  try:
+    decoding = _VARINT_DECODING[data[offset]]
+    high, size = decoding
+    if size == 1:
+      return decoding
+    elif size == 2:
+      return high | _BYTE_VALUES[data[offset + 1]], 2
+    elif size == 3:
+      return high | _UINT16_STRUCT.unpack_from(data, offset + 1)[0], 3
+    elif size == 4:
+      return (high | _BYTE_VALUES[data[offset + 1]] << 16 |
+              _UINT16_STRUCT.unpack_from(data, offset + 2)[0], 4)
+    elif size == 5:
+      return _UINT32_STRUCT.unpack_from(data, offset + 1)[0], 5
+    elif size == 9:
+      return _UINT64_STRUCT.unpack_from(data, offset + 1)[0], 9
+  except (IndexError, struct.error):
+    raise ValueError("Truncated varint at %d." % offset)
+  # Negative varint
+  value, size = decode_varint(data, offset + 1)
+  return ~value, size + 1
+
+# Type and target of a voice packet, by its first byte.
+_VOICE_HEADERS = {}
+for _h in range(256):
+  _VOICE_HEADERS[_h] = _VOICE_HEADERS[chr(_h)] = (_h >> 5, _h & 0b00011111)
+del _h
 
+# Voice packet of one Opus packet, as sent by clients: without session. last
+# tells whether it ends the transmission.
+def opus_voice(sequence, packet, last = False, target = 0):
+  size = len(packet) | (_OPUS_TERMINATOR if last else 0)
+  return (chr(VOICE_OPUS << 5 | target) + encode_varint(sequence) +
+          encode_varint(size) + packet)
+
+# Voice packet of the given type, as sent by clients, holding frames as
+# iter_voice_frames gives them: an empty frame last ends the transmission.
+def voice_packet(type, sequence, frames, target = 0):
+  if type == VOICE_OPUS:
+    return opus_voice(sequence, frames[0], last = len(frames) > 1,
+                      target = target)
+  parts = [chr(type << 5 | target), encode_varint(sequence)]
+  last = len(frames) - 1
+  for i, frame in enumerate(frames):
+    parts.append(chr(len(frame) | (0 if i == last else 0b10000000)))
+    parts.append(frame)
+  return ''.join(parts)
+
+def voice_type(packet):
+  return _VOICE_HEADERS[packet[0]][0]
+
+# Split the header of a voice packet. Returns (type, target, session,
+# sequence, header_length), the frames starting at header_length. Pings have
+# no session and no sequence, only a timestamp, returned as the session.
+# Raises ValueError if the packet is truncated.
 def parse_voice_header(msg):
-  h = ord(msg[0])
-  type = (h & 0b11100000) >> 5
-  target = (h & 0b00011111)
-  (session, session_length) = _decode_varint(msg[1:])
-  if (session_length + 1 >= len(msg)):
-    # Means there's no sequence number.
+  try:
+    type, target = _VOICE_HEADERS[msg[0]]
+  except IndexError:
+    raise ValueError("Empty voice packet.")
+  session, session_length = decode_varint(msg, 1)
+  header_length = 1 + session_length
+  if type == VOICE_PING:
     sequence = 0
-    sequence_length = 0
   else:
-    (sequence, sequence_length) = _decode_varint(msg[session_length:])
-  header_length = session_length + sequence_length
+    sequence, sequence_length = decode_varint(msg, header_length)
+    header_length += sequence_length
   return (type, target, session, sequence, header_length)
+
+# Iterate over the frames of a voice packet of the given type, starting at
+# offset (the header_length of parse_voice_header), as memoryviews of the
+# packet: no voice data is copied. CELT and Speex packets hold frames of up
+# to 127 bytes, each after a byte with its size and whether another frame
+# follows. Opus packets hold one frame, after a varint with its size and the
+# terminator bit; an empty frame follows the last frame of a transmission,
+# as with CELT. Raises ValueError on truncated frames.
+def iter_voice_frames(packet, offset, type):
+  view = memoryview(packet)
+  end = len(view)
+  if type == VOICE_OPUS:
+    header, size = decode_varint(view, offset)
+    offset += size
+    size = header & _OPUS_SIZE_MASK
+    if offset + size > end:
+      raise ValueError("Truncated Opus frame.")
+    yield view[offset:offset + size]
+    if size and header & _OPUS_TERMINATOR:
+      yield view[end:]
+  elif type in (VOICE_CELT_ALPHA, VOICE_SPEEX, VOICE_CELT_BETA):
+    more = True
+    while more and offset < end:
+      header = _BYTE_VALUES[view[offset]]
+      more = header & 0b10000000
+      size = header & 0b01111111
+      offset += 1
+      if offset + size > end:
+        raise ValueError("Truncated voice frame.")
+      yield view[offset:offset + size]
+      offset += size
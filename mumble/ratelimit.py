@@ -0,0 +1,107 @@
+import thread
+import time
+
+# Murmur's defaults for messagelimit and messageburst: one message per second
+# on average, bursts of five. Servers don't tell their clients the limits
+# they use, so these apply unless the bot is configured otherwise.
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 5
+
+# Token bucket holding up to burst tokens, refilled at rate tokens per second.
+# Tokens are reserved rather than taken: when the bucket is empty, a
+# reservation still succeeds, but tells how long to wait before using it, so
+# callers can queue instead of dropping.
+class TokenBucket(object):
+  def __init__(self, rate = DEFAULT_RATE, burst = DEFAULT_BURST):
+    self.rate = float(rate)
+    self.burst = burst
+    self.tokens = float(burst)
+    self.__updated = None
+
+  # Reserve a token at time now. Returns the seconds to wait before it can be
+  # used, 0 if it's available right away.
+  def reserve(self, now):
+    if self.__updated is not None:
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.__updated) * self.rate)
+    self.__updated = now
+    self.tokens -= 1
+    if self.tokens >= 0:
+      return 0.0
+    return -self.tokens / self.rate
+
+
+# Buckets of a connection, one per message type, so a flood of text messages
+# doesn't hold back a channel move. Reports how long messages waited.
+class RateLimiter(object):
+  def __init__(self, rate = DEFAULT_RATE, burst = DEFAULT_BURST,
+                     limits = None):
+    """
+    Arguments: rate Messages per second allowed for each message type.
+               burst Messages of a type that can be sent at once.
+               limits Dictionary of (rate, burst) by message type (the
+                      mumble_pb2 class), overriding the above.
+    """
+    self.rate = rate
+    self.burst = burst
+    self.limits = dict(limits or {})
+    self.mutex = thread.allocate_lock()
+    self.__buckets = {}
+    # Messages that had to wait, and for how long in total/at most.
+    self.delayed = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+    # (time due, message type, frame) of the messages a connection closed
+    # before sending, for the next one to send.
+    self.__held = []
+
+  # Change the default limits, e.g. to the messagelimit and messageburst of
+  # a server known to differ from Murmur's defaults. Limits set by message
+  # type are left as is.
+  def configure(self, rate, burst):
+    self.mutex.acquire()
+    try:
+      self.rate = rate
+      self.burst = burst
+      for msg_type, bucket in self.__buckets.items():
+        if msg_type not in self.limits:
+          bucket.rate, bucket.burst = float(rate), burst
+    finally:
+      self.mutex.release()
+
+  # Reserve the sending of a message of msg_type. Returns the seconds to wait
+  # before sending it.
+  def reserve(self, msg_type, now = None):
+    now = now or time.time()
+    self.mutex.acquire()
+    try:
+      bucket = self.__buckets.get(msg_type)
+      if bucket is None:
+        rate, burst = self.limits.get(msg_type, (self.rate, self.burst))
+        bucket = self.__buckets[msg_type] = TokenBucket(rate, burst)
+      wait = bucket.reserve(now)
+      if wait > 0:
+        self.delayed += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+      return wait
+    finally:
+      self.mutex.release()
+
+  # Keep messages, as (time due, message type, frame), for the next
+  # connection.
+  def hold(self, messages):
+    self.mutex.acquire()
+    try:
+      self.__held.extend(messages)
+    finally:
+      self.mutex.release()
+
+  # Returns the messages held, and forgets them.
+  def take_held(self):
+    self.mutex.acquire()
+    try:
+      held, self.__held = self.__held, []
+      return held
+    finally:
+      self.mutex.release()
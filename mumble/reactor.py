@@ -0,0 +1,334 @@
+import errno
+import heapq
+import logging
+import os
+import select
+import socket
+import thread
+import threading
+import time
+
+from connection import BaseConnection, wakeup_pipe
+
+LOGGER = logging.getLogger(__name__)
+
+# Thin layer over epoll, or poll where epoll isn't available.
+class _Poller(object):
+  def __init__(self):
+    if hasattr(select, 'epoll'):
+      self.__poll = select.epoll()
+      self.READ = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+      self.WRITE = select.EPOLLOUT
+      self.__ms = False
+    else:
+      self.__poll = select.poll()
+      self.READ = select.POLLIN | select.POLLERR | select.POLLHUP
+      self.WRITE = select.POLLOUT
+      self.__ms = True
+
+  def register(self, fd, mask):
+    self.__poll.register(fd, mask)
+
+  def modify(self, fd, mask):
+    self.__poll.modify(fd, mask)
+
+  def unregister(self, fd):
+    self.__poll.unregister(fd)
+
+  # Returns a list of (fd, events). timeout is in seconds, None to block.
+  def poll(self, timeout):
+    if self.__ms:
+      return self.__poll.poll(None if timeout is None else timeout * 1000.0)
+    return self.__poll.poll(-1 if timeout is None else timeout)
+
+
+# A connection attached to a Reactor instead of running a thread of its own.
+class ReactorConnection(BaseConnection):
+  def __init__(self, reactor, server, nickname, password = None,
+                     version = "hBOT 0.1", delegate = None, udp = True,
+                     timers = None, limiter = None, capture = None):
+    self.reactor = reactor
+    self.fd = None
+    BaseConnection.__init__(self, server, nickname, password = password,
+                            version = version, delegate = delegate, udp = udp,
+                            timers = timers, limiter = limiter,
+                            capture = capture)
+    # Kept, as the socket forgets it once closed.
+    self.fd = self.socket.fileno()
+    self.__done = threading.Event()
+    reactor.add(self)
+
+  def stop(self):
+    BaseConnection.stop(self)
+    self.reactor.remove(self)
+
+  # Wait until the connection is closed.
+  def join(self, timeout = None):
+    self.__done.wait(timeout)
+
+  def _wake(self):
+    # Until it is added, the reactor has nothing to wake up for.
+    if self.fd is not None:
+      self.reactor.wake(self)
+
+  # Called by the reactor once the connection is detached and closed.
+  def _closed(self):
+    self.__done.set()
+
+
+# Serve any number of connections from a single I/O thread, multiplexing
+# their sockets with epoll. The next timer due of each connection (pings
+# included) is kept in one heap, so the thread only wakes up for data or for
+# the next timer due.
+#
+# Use it by passing it to Bot.start():
+#   reactor = mumble.Reactor()
+#   for bot in bots:
+#     bot.start(server, nickname, reactor = reactor)
+class Reactor(threading.Thread):
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.name = "Mumble Reactor"
+    self.daemon = True
+    self.keep_going = True
+    self.mutex = thread.allocate_lock()
+    self.__poller = _Poller()
+    self.__connections = {}
+    # Connections waiting to be added/removed, or with data queued by another
+    # thread. They are handled by the reactor thread on its next iteration.
+    self.__added = []
+    self.__removed = []
+    self.__dirty = set()
+    # Connections also polled for writing.
+    self.__writing = set()
+    # UDP voice sockets, by fd, and the fd of each connection's.
+    self.__udp = {}
+    self.__udp_fds = {}
+    # Heap of (time, fd) for the next timer of each connection, and the time
+    # currently scheduled for each fd. Entries not matching the latter are
+    # stale.
+    self.__timers = []
+    self.__scheduled = {}
+    # Once closed, its fds may be reused by anything, so writes check under
+    # the mutex.
+    self.__wakeup_r, self.__wakeup_w = wakeup_pipe()
+    self.__wakeup_closed = False
+    self.__poller.register(self.__wakeup_r, self.__poller.READ)
+    self.start()
+
+  # Create a connection served by this reactor.
+  def connect(self, server, nickname, password = None, version = "hBOT 0.1",
+                    delegate = None, udp = True, timers = None,
+                    limiter = None, capture = None):
+    return ReactorConnection(self, server, nickname, password = password,
+                             version = version, delegate = delegate, udp = udp,
+                             timers = timers, limiter = limiter,
+                             capture = capture)
+
+  def add(self, conn):
+    self.mutex.acquire()
+    try:
+      self.__added.append(conn)
+    finally:
+      self.mutex.release()
+    self.__wake_thread()
+
+  def remove(self, conn):
+    self.mutex.acquire()
+    try:
+      self.__removed.append(conn)
+    finally:
+      self.mutex.release()
+    self.__wake_thread()
+
+  # Let the reactor know conn has data queued to be written.
+  def wake(self, conn):
+    if threading.current_thread() is self:
+      # Flushed at the end of the current iteration anyway.
+      self.__dirty.add(conn.fd)
+      return
+    self.mutex.acquire()
+    try:
+      self.__dirty.add(conn.fd)
+    finally:
+      self.mutex.release()
+    self.__wake_thread()
+
+  def stop(self):
+    self.keep_going = False
+    self.__wake_thread()
+
+  def __len__(self):
+    return len(self.__connections)
+
+  ##############################################################################
+  # Private.
+  def __wake_thread(self):
+    self.mutex.acquire()
+    try:
+      if self.__wakeup_closed:
+        return
+      try:
+        os.write(self.__wakeup_w, 'w')
+      except OSError:
+        # Full.
+        pass
+    finally:
+      self.mutex.release()
+
+  def __apply_changes(self):
+    self.mutex.acquire()
+    try:
+      added, self.__added = self.__added, []
+      removed, self.__removed = self.__removed, []
+    finally:
+      self.mutex.release()
+    for conn in added:
+      fd = conn.fd
+      self.__connections[fd] = conn
+      self.__poller.register(fd, self.__poller.READ)
+      self.__dirty.add(fd)
+    for conn in removed:
+      self.__detach(conn)
+
+  def __detach(self, conn):
+    fd = conn.fd
+    if self.__connections.pop(fd, None) is None:
+      return
+    self.__poller.unregister(fd)
+    self.__scheduled.pop(fd, None)
+    self.__dirty.discard(fd)
+    self.__writing.discard(fd)
+    udp_fd = self.__udp_fds.pop(fd, None)
+    if udp_fd is not None:
+      self.__poller.unregister(udp_fd)
+      del self.__udp[udp_fd]
+    conn.keep_going = False
+    conn._close()
+    conn._closed()
+
+  def __schedule(self, fd, conn):
+    due = conn.timers.next_due()
+    if self.__scheduled.get(fd) != due:
+      self.__scheduled[fd] = due
+      if due is not None:
+        heapq.heappush(self.__timers, (due, fd))
+
+  # Seconds until the next timer is due, or None.
+  def __timeout(self, now):
+    while self.__timers:
+      due, fd = self.__timers[0]
+      if self.__scheduled.get(fd) == due:
+        return max(0, due - now)
+      heapq.heappop(self.__timers)
+    return None
+
+  def __run_timers(self, now):
+    while self.__timers and self.__timers[0][0] <= now:
+      due, fd = heapq.heappop(self.__timers)
+      if self.__scheduled.get(fd) != due:
+        continue
+      del self.__scheduled[fd]
+      conn = self.__connections.get(fd)
+      if conn is None:
+        continue
+      conn._run_timers()
+      # Rescheduled once flushed.
+      self.__dirty.add(fd)
+
+  def __read(self, fd, conn):
+    try:
+      alive = conn._handle_read()
+    except socket.error as msg:
+      conn._call("on_socket_exception", msg)
+      self.__detach(conn)
+      return
+    except Exception:
+      # Only this connection goes down, as it would on a thread of its own.
+      LOGGER.exception("Error while handling the connection to %s." %
+                       conn.server)
+      conn._call("on_socket_exception", None)
+      self.__detach(conn)
+      return
+    if not alive:
+      conn._call("on_socket_error")
+      self.__detach(conn)
+      return
+    self.__dirty.add(fd)
+    # The CryptSetup may just have set up UDP voice.
+    if conn.udp is not None and fd not in self.__udp_fds:
+      udp_fd = conn.udp.fileno()
+      self.__udp_fds[fd] = udp_fd
+      self.__udp[udp_fd] = conn
+      self.__poller.register(udp_fd, self.__poller.READ)
+
+  def __read_udp(self, udp_fd, conn):
+    try:
+      conn._handle_udp_read()
+    except socket.error as msg:
+      LOGGER.warning("UDP voice failed, using TCP only: %s" % msg)
+      self.__poller.unregister(udp_fd)
+      del self.__udp[udp_fd]
+      conn.udp.close()
+      conn.udp = None
+    self.__dirty.add(conn.fd)
+
+  def __flush(self, fd, conn):
+    try:
+      done = conn.outbound.flush(conn.socket)
+    except socket.error as msg:
+      conn._call("on_socket_exception", msg)
+      self.__detach(conn)
+      return
+    if done and fd in self.__writing:
+      self.__writing.remove(fd)
+      self.__poller.modify(fd, self.__poller.READ)
+    elif not done and fd not in self.__writing:
+      self.__writing.add(fd)
+      self.__poller.modify(fd, self.__poller.READ | self.__poller.WRITE)
+
+  def run(self):
+    while self.keep_going:
+      self.__apply_changes()
+      try:
+        events = self.__poller.poll(self.__timeout(time.time()))
+      except (IOError, OSError, select.error) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for fd, event in events:
+        if fd == self.__wakeup_r:
+          os.read(fd, 4096)
+          continue
+        if fd in self.__udp:
+          self.__read_udp(fd, self.__udp[fd])
+          continue
+        conn = self.__connections.get(fd)
+        if conn is None:
+          continue
+        if event & self.__poller.READ:
+          self.__read(fd, conn)
+        if event & self.__poller.WRITE:
+          self.__dirty.add(fd)
+      self.__run_timers(time.time())
+      self.mutex.acquire()
+      try:
+        dirty, self.__dirty = self.__dirty, set()
+      finally:
+        self.mutex.release()
+      for fd in dirty:
+        conn = self.__connections.get(fd)
+        if conn is None:
+          continue
+        self.__flush(fd, conn)
+        if fd in self.__connections:
+          self.__schedule(fd, conn)
+    for conn in self.__connections.values():
+      self.__detach(conn)
+    self.mutex.acquire()
+    try:
+      self.__wakeup_closed = True
+      os.close(self.__wakeup_r)
+      os.close(self.__wakeup_w)
+    finally:
+      self.mutex.release()
@@ -0,0 +1,28 @@
+import random
+
+# How a Bot retries connecting once it lost its server: exponential backoff,
+# with some randomness so a fleet of bots doesn't come back all at once.
+class ReconnectPolicy(object):
+  def __init__(self, base_delay = 1.0, max_delay = 60.0, factor = 2.0,
+                     jitter = 0.5, max_attempts = None):
+    """
+    Arguments: base_delay Seconds to wait before the first attempt.
+               max_delay Upper bound of the delay between two attempts.
+               factor Growth of the delay after each failed attempt.
+               jitter Fraction of the delay that is randomized, in [0, 1].
+               max_attempts Give up after that many attempts, or None to
+                            retry forever.
+    """
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.factor = factor
+    self.jitter = jitter
+    self.max_attempts = max_attempts
+
+  def should_retry(self, attempt):
+    return self.max_attempts is None or attempt < self.max_attempts
+
+  # Seconds to wait before the given attempt (starting at 0).
+  def delay(self, attempt):
+    delay = min(self.max_delay, self.base_delay * (self.factor ** attempt))
+    return delay * random.uniform(1.0 - self.jitter, 1.0)
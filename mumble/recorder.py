@@ -0,0 +1,308 @@
+# Recording of the voice of each speaker to an Ogg Opus file, as received:
+# the Opus packets are not decoded nor encoded again.
+#
+#   bot.recorder = mumble.VoiceRecorder('recordings')
+#   bot.start(server, nickname)
+#
+# Each transmission goes to the file of its speaker, opened when they first
+# talk and closed when they leave or stay silent for expire seconds. Silences
+# and lost packets are filled with empty Opus packets, so the files keep the
+# timing of the sequence numbers.
+
+import logging
+import os
+import random
+import re
+import struct
+import thread
+import time
+import zlib
+
+from jitter import SEQUENCE_DURATION
+import protocol
+
+LOGGER = logging.getLogger(__name__)
+
+# Opus always runs at 48 kHz, as far as granule positions are concerned.
+SAMPLE_RATE = 48000
+_SAMPLES_PER_SEQUENCE = int(SAMPLE_RATE * SEQUENCE_DURATION)
+
+# Samples players drop at the start of the stream, the usual 6.5 ms of
+# encoder lookahead (RFC 7845, 5.1): they hide the decoder warming up on
+# packets taken in the middle of a stream. Granule positions count them, as
+# samples decoded.
+PRE_SKIP = 312
+
+# Seconds of silence after which a speaker may number their packets from
+# scratch; a packet going back in time before that is late.
+RESTART_SILENCE = 1.0
+
+# Ogg page header: capture pattern, version, flags, granule position, serial
+# number, page sequence number, CRC and number of segments.
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+_BOS = 0x02
+_EOS = 0x04
+_MAX_SEGMENTS = 255
+
+# Ogg checksums are CRC-32 with the bits in the other order than zlib's: run
+# zlib on the bytes with their bits reversed, and reverse the result.
+_REVERSED_BITS = ''.join(chr(int('{0:08b}'.format(b)[::-1], 2))
+                         for b in range(256))
+_UINT32_BE = struct.Struct('>I')
+_UINT32_LE = struct.Struct('<I')
+
+def ogg_crc(data):
+  crc = (zlib.crc32(data.translate(_REVERSED_BITS), -1) ^ -1) & 0xFFFFFFFF
+  return _UINT32_LE.unpack(_UINT32_BE.pack(crc).translate(_REVERSED_BITS))[0]
+
+# Samples of a frame at 48 kHz for each configuration of the TOC byte
+# (RFC 6716, 3.1): SILK, hybrid then CELT modes.
+_FRAME_SAMPLES = ([480, 960, 1920, 2880] * 3 + [480, 960] * 2 +
+                  [120, 240, 480, 960] * 4)
+
+# Samples of an Opus packet at 48 kHz, from its TOC byte and frame count.
+def opus_samples(packet):
+  toc = ord(packet[0])
+  code = toc & 0b11
+  if code == 0:
+    count = 1
+  elif code != 3:
+    count = 2
+  else:
+    count = ord(packet[1]) & 0b00111111
+  return _FRAME_SAMPLES[toc >> 3] * count
+
+# TOC-only Opus packets: a single empty frame, which decoders play as
+# silence. CELT 20 ms and 10 ms, mono.
+_SILENCE_20MS = 31 << 3
+_SILENCE_10MS = 30 << 3
+_STEREO = 0b100
+
+def _opus_head(channels):
+  # Version, channels, pre-skip, input sample rate, gain, mapping family.
+  return 'OpusHead' + struct.pack('<BBHIhB', 1, channels, PRE_SKIP,
+                                  SAMPLE_RATE, 0, 0)
+
+def _opus_tags(vendor, comments):
+  tags = ['OpusTags', struct.pack('<I', len(vendor)), vendor,
+          struct.pack('<I', len(comments))]
+  for comment in comments:
+    comment = comment.encode('utf-8')
+    tags.append(struct.pack('<I', len(comment)))
+    tags.append(comment)
+  return ''.join(tags)
+
+
+# An Ogg Opus stream written to a file: packets are laid out in pages of
+# page_duration seconds of audio at most, written to the file as they fill.
+# The granule position is the number of samples of the packets written, so
+# players play PRE_SKIP less than that.
+class OggOpusWriter(object):
+  def __init__(self, path, channels = 1, comments = (),
+                     page_duration = 1.0, buffering = 65536):
+    self.path = path
+    self.file = open(path, 'wb', buffering)
+    self.channels = channels
+    self.granule = 0
+    self.page_samples = int(page_duration * SAMPLE_RATE)
+    self.__serial = random.randint(0, 0xFFFFFFFF)
+    self.__sequence = 0
+    self.__packets = []
+    self.__segments = 0
+    self.__page_start = 0
+    self.__write_page([_opus_head(channels)], 0, _BOS)
+    self.__write_page([_opus_tags("mumble-bots", comments)], 0, 0)
+
+  # Append a packet holding samples samples (48 kHz).
+  def write(self, packet, samples):
+    segments = len(packet) // 255 + 1
+    if self.__segments + segments > _MAX_SEGMENTS:
+      self.__flush_page()
+    self.__packets.append(packet)
+    self.__segments += segments
+    self.granule += samples
+    if self.granule - self.__page_start >= self.page_samples:
+      self.__flush_page()
+
+  # Write the packets of the page being filled, then the file buffer.
+  def flush(self):
+    self.__flush_page()
+    self.file.flush()
+
+  def close(self):
+    if self.file.closed:
+      return
+    # The last granule position can't be less than the pre-skip.
+    silence = chr(_SILENCE_10MS | (_STEREO if self.channels == 2 else 0))
+    while self.granule < PRE_SKIP:
+      self.__packets.append(silence)
+      self.granule += _SAMPLES_PER_SEQUENCE
+    self.__write_page(self.__packets, self.granule, _EOS)
+    self.__packets = []
+    self.file.close()
+
+  ##############################################################################
+  # Private.
+  def __flush_page(self):
+    if self.__packets:
+      self.__write_page(self.__packets, self.granule, 0)
+      self.__packets = []
+    self.__segments = 0
+    self.__page_start = self.granule
+
+  def __write_page(self, packets, granule, flags):
+    lacing = []
+    for packet in packets:
+      size = len(packet)
+      lacing.append('\xff' * (size // 255) + chr(size % 255))
+    lacing = ''.join(lacing)
+    page = (_PAGE_HEADER.pack('OggS', 0, flags, granule, self.__serial,
+                              self.__sequence, 0, len(lacing)) +
+            lacing + ''.join(packets))
+    crc = _UINT32_LE.pack(ogg_crc(page))
+    # The CRC goes at offset 22, computed with zeros in its place.
+    self.file.write(page[:22] + crc + page[26:])
+    self.__sequence += 1
+
+
+# What is recorded of a speaker.
+class _Track(object):
+  def __init__(self, writer, stereo):
+    self.writer = writer
+    self.stereo = stereo
+    # Sequence number expected for the next packet.
+    self.next_sequence = None
+    self.last_arrival = None
+
+
+# Records the Opus voice of each speaker to an Ogg Opus file of its own in
+# directory, flushed every flush_interval seconds. Frames of other codecs
+# are ignored.
+class VoiceRecorder(object):
+  def __init__(self, directory, flush_interval = 5.0, page_duration = 1.0,
+                     max_silence = 10.0, expire = 60.0):
+    """
+    Arguments: directory Where to write the files, created if needed.
+               flush_interval Seconds between two flush(), when driven by a
+                              bot.
+               page_duration Seconds of audio per Ogg page, at most.
+               max_silence Silences longer than that, in seconds, are
+                           shortened to it in the files.
+               expire Seconds of silence after which the file of a speaker
+                      is closed.
+    """
+    self.directory = directory
+    self.flush_interval = flush_interval
+    self.page_duration = page_duration
+    self.max_silence = max_silence
+    self.expire = expire
+    self.mutex = thread.allocate_lock()
+    self.packets = 0
+    self.skipped = 0
+    self.__tracks = {}
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  # Record the frames of a voice packet of session, whose name is used in the
+  # name of its file.
+  def record(self, session, sequence, codec, frames, name = None, now = None):
+    if codec != protocol.VOICE_OPUS:
+      self.skipped += 1
+      return
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      for frame in frames:
+        if not len(frame):
+          # End of the transmission.
+          continue
+        track = self.__tracks.get(session)
+        if track is None:
+          track = self.__open(session, name, frame, now)
+        if isinstance(frame, memoryview):
+          frame = frame.tobytes()
+        self.__write(track, sequence, frame, now)
+    finally:
+      self.mutex.release()
+
+  # Write what is buffered to the files, and close those of the speakers
+  # silent for expire seconds.
+  def flush(self, now = None):
+    if now is None:
+      now = time.time()
+    self.mutex.acquire()
+    try:
+      for session, track in self.__tracks.items():
+        if now - track.last_arrival > self.expire:
+          track.writer.close()
+          del self.__tracks[session]
+        else:
+          track.writer.flush()
+    finally:
+      self.mutex.release()
+
+  # Close the file of session, or all of them.
+  def close(self, session = None):
+    self.mutex.acquire()
+    try:
+      if session is None:
+        sessions = self.__tracks.keys()
+      else:
+        sessions = [session] if session in self.__tracks else []
+      for session in sessions:
+        self.__tracks.pop(session).writer.close()
+    finally:
+      self.mutex.release()
+
+  # Paths of the files being written, by session.
+  def paths(self):
+    self.mutex.acquire()
+    try:
+      return dict((session, track.writer.path)
+                  for session, track in self.__tracks.items())
+    finally:
+      self.mutex.release()
+
+  ##############################################################################
+  # Private.
+  def __open(self, session, name, frame, now):
+    label = re.sub(r'[^\w.-]+', '_', name or "") or "session"
+    path = os.path.join(self.directory, "%s-%s-%d.opus" % (
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), label, session))
+    stereo = bool(ord(frame[0]) & _STEREO)
+    comments = ["TITLE=%s" % (name or session)]
+    writer = OggOpusWriter(path, channels = 2 if stereo else 1,
+                           comments = comments,
+                           page_duration = self.page_duration)
+    LOGGER.info("Recording %s to %s." % (name or session, path))
+    return self.__tracks.setdefault(session, _Track(writer, stereo))
+
+  def __write(self, track, sequence, packet, now):
+    try:
+      samples = opus_samples(packet)
+    except IndexError:
+      self.skipped += 1
+      return
+    if track.next_sequence is not None:
+      gap = sequence - track.next_sequence
+      if gap < 0:
+        if now - track.last_arrival < RESTART_SILENCE:
+          # Late or duplicated: its place in the file is gone.
+          return
+        # The numbering restarted; go by the clock.
+        gap = int((now - track.last_arrival) / SEQUENCE_DURATION)
+      self.__fill(track, min(gap, int(self.max_silence / SEQUENCE_DURATION)))
+    track.writer.write(packet, samples)
+    track.next_sequence = sequence + samples // _SAMPLES_PER_SEQUENCE
+    track.last_arrival = now
+    self.packets += 1
+
+  # Write gap sequence numbers of silence.
+  def __fill(self, track, gap):
+    stereo = _STEREO if track.stereo else 0
+    silence_20ms = chr(_SILENCE_20MS | stereo)
+    for _ in xrange(gap // 2):
+      track.writer.write(silence_20ms, 2 * _SAMPLES_PER_SEQUENCE)
+    if gap % 2:
+      track.writer.write(chr(_SILENCE_10MS | stereo), _SAMPLES_PER_SEQUENCE)
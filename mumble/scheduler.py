@@ -0,0 +1,112 @@
+import heapq
+import itertools
+import logging
+import thread
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# A function scheduled on a Scheduler. Keep it to cancel() it.
+class Timer(object):
+  def __init__(self, when, interval, func, args):
+    self.when = when
+    # Seconds between two calls for repeating timers, None otherwise.
+    self.interval = interval
+    self.func = func
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+
+# Heap of timers, run by the loop driving a connection: the loop blocks in
+# select/poll until timeout() says the next timer is due, then calls
+# run_due(). Any thread can add timers; wake is called when a new timer is
+# due before all the others, so a loop blocked on the previous timeout can
+# recompute it.
+class Scheduler(object):
+  def __init__(self, wake = None):
+    self.wake = wake
+    self.mutex = thread.allocate_lock()
+    # Heap of (when, sequence, Timer). The sequence keeps timers due at the
+    # same time in the order they were added.
+    self.__heap = []
+    self.__sequence = itertools.count()
+
+  def call_at(self, when, func, *args):
+    return self.__add(Timer(when, None, func, args))
+
+  # Call func(*args) in delay seconds.
+  def call_later(self, delay, func, *args):
+    return self.__add(Timer(time.time() + delay, None, func, args))
+
+  # Call func(*args) every interval seconds, the first time in interval
+  # seconds, until the timer is cancelled.
+  def call_every(self, interval, func, *args):
+    return self.__add(Timer(time.time() + interval, interval, func, args))
+
+  # Time at which the next timer is due, or None.
+  def next_due(self):
+    self.mutex.acquire()
+    try:
+      while self.__heap and self.__heap[0][2].cancelled:
+        heapq.heappop(self.__heap)
+      if not self.__heap:
+        return None
+      return self.__heap[0][0]
+    finally:
+      self.mutex.release()
+
+  # Seconds until the next timer is due, or None if there is none.
+  def timeout(self, now):
+    due = self.next_due()
+    if due is None:
+      return None
+    return max(0, due - now)
+
+  # Run all the timers due at now. A timer raising an exception is logged,
+  # and doesn't prevent the others from running.
+  def run_due(self, now):
+    while True:
+      self.mutex.acquire()
+      try:
+        if not self.__heap or self.__heap[0][0] > now:
+          return
+        when, _, timer = heapq.heappop(self.__heap)
+        if timer.cancelled:
+          continue
+        if timer.interval is not None:
+          # Keep the pace of the original schedule, but don't run late
+          # calls in a burst.
+          timer.when = when + timer.interval
+          if timer.when <= now:
+            timer.when = now + timer.interval
+          heapq.heappush(self.__heap,
+                         (timer.when, next(self.__sequence), timer))
+      finally:
+        self.mutex.release()
+      try:
+        timer.func(*timer.args)
+      except Exception:
+        LOGGER.exception("Error in timer %r." % timer.func)
+
+  def __len__(self):
+    self.mutex.acquire()
+    try:
+      return len([t for _, _, t in self.__heap if not t.cancelled])
+    finally:
+      self.mutex.release()
+
+  ##############################################################################
+  # Private.
+  def __add(self, timer):
+    self.mutex.acquire()
+    try:
+      first = not self.__heap or timer.when < self.__heap[0][0]
+      heapq.heappush(self.__heap, (timer.when, next(self.__sequence), timer))
+    finally:
+      self.mutex.release()
+    if first and self.wake is not None:
+      self.wake()
+    return timer
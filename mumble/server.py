@@ -5,28 +5,66 @@ import logging
 import socket
 import ssl
 import struct
+import thread
 
 LOGGER = logging.getLogger(__name__)
 
 # Keep a server's information in a nice tidy place.
-# This is hardly more than that.
+# It also owns the TLS context used for all the connections to it, so the
+# certificate and protocol settings are only set up once. Share a Server
+# between bots connecting to the same place.
 class Server(object):
-  def __init__(self, hostname = '', port = 64738):
+  def __init__(self, hostname = '', port = 64738, certfile = None,
+                     keyfile = None, tls = True):
+    """
+    Arguments: hostname, port Where the server is.
+               certfile, keyfile Client certificate (PEM) to authenticate
+                                 with, for registered bots. keyfile can be
+                                 omitted if certfile contains the key.
+               tls False to talk in the clear, only useful with the
+                   emulator of mumble.emulator.
+    """
     self.hostname = hostname
     self.port = int(port)
+    self.tls = tls
+    self.certfile = certfile
+    self.keyfile = keyfile
+    # Number of TLS handshakes done.
+    self.handshakes = 0
+    self.mutex = thread.allocate_lock()
+    self.__context = None
 
   def __str__(self):
     return "%s:%d" % (self.hostname, self.port)
 
+  def ssl_context(self):
+    self.mutex.acquire()
+    try:
+      if self.__context is None:
+        self.__context = self.__create_context()
+      return self.__context
+    finally:
+      self.mutex.release()
+
   def connect(self):
-    sc = ssl.wrap_socket(socket.socket(type = socket.SOCK_STREAM),
-                                       ssl_version = ssl.PROTOCOL_TLSv1)
+    sc = socket.socket(type = socket.SOCK_STREAM)
     sc.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
     try:
       sc.connect((self.hostname, self.port))
     except socket.error as e:
       LOGGER.error("Couldn't connect to server")
+      sc.close()
       raise e
+    if not self.tls:
+      sc.setblocking(0)
+      return sc
+
+    sc = self.ssl_context().wrap_socket(sc, server_hostname = self.hostname)
+    self.mutex.acquire()
+    try:
+      self.handshakes += 1
+    finally:
+      self.mutex.release()
 
     sc.setblocking(0)
     return sc
@@ -49,3 +87,16 @@ class Server(object):
     ping = (datetime.datetime.now().microsecond - r[4]) / 1000.0
     if ping < 0: ping = ping + 1000
     return (version, r[5], r[6], r[7], ping)
+
+  ##############################################################################
+  # Private.
+  def __create_context(self):
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT',
+                                     ssl.PROTOCOL_SSLv23))
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    # Mumble servers mostly use self-signed certificates.
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if self.certfile is not None:
+      context.load_cert_chain(self.certfile, self.keyfile)
+    return context
@@ -0,0 +1,233 @@
+#!/bin/python
+#
+# Spread a fleet of bots across worker processes, so their handlers don't all
+# compete for the single core a process gets from the GIL.
+#
+# The manifest is a JSON list with one entry per bot:
+#   [
+#     {"bot": "bots.afkmove.AfkMoveBot", "server": "example.com:64738",
+#      "nickname": "-AFK-"},
+#     {"bot": "mumble.AdvanceBot", "server": "example.com:64738",
+#      "nickname": "-Admin-", "config": "admin.cfg"},
+#     ...
+#   ]
+# "bot" is the full path of the Bot class, importable from where the
+# supervisor runs (e.g. the top of this repository). The class is called with
+# no arguments, or with config_path if the entry has a "config", as
+# AdvanceBot and its subclasses take. Bots reconnect with the default
+# ReconnectPolicy when they lose their server, unless they come with a policy
+# of their own or the entry has "reconnect": false.
+#
+# Usage:
+#   python -m mumble.supervisor [-w WORKERS] manifest.json
+
+from optparse import OptionParser
+
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import sys
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+def load_manifest(path):
+  with open(path, 'r') as fin:
+    return json.load(fin)
+
+def _import_bot_class(path):
+  module_name, class_name = path.rsplit('.', 1)
+  module = __import__(module_name, fromlist = [class_name])
+  return getattr(module, class_name)
+
+def _make_bot(entry):
+  import mumble
+  cls = _import_bot_class(entry['bot'])
+  if entry.get('config') is not None:
+    bot = cls(config_path = entry['config'])
+  else:
+    bot = cls()
+  if bot.reconnect is None and entry.get('reconnect', True):
+    bot.reconnect = mumble.ReconnectPolicy()
+  return bot
+
+# Whether bot is connected, or about to connect again.
+def _is_running(bot):
+  connection = bot.connection
+  return ((connection is not None and connection.keep_going) or
+          bot.is_reconnecting())
+
+def _cpu_time():
+  times = os.times()
+  return times[0] + times[1]
+
+# Body of a worker process. Run all the bots in entries on one reactor and
+# report the load of the process to reports every report_interval seconds,
+# until every bot is gone. Exits with 1 if some of them lost their connection
+# for good instead of being stopped, so the worker is restarted.
+def _worker_main(worker_id, entries, reports, report_interval):
+  import mumble
+  reactor = mumble.Reactor()
+  bots = []
+  for entry in entries:
+    bot = _make_bot(entry)
+    bot.start(mumble.Server(*entry['server'].split(':')), entry['nickname'],
+              reactor = reactor)
+    bots.append(bot)
+
+  last_cpu, last_time = _cpu_time(), time.time()
+  while True:
+    alive = [b for b in bots if _is_running(b)]
+    deadline = last_time + report_interval
+    for bot in alive:
+      bot.join(max(0, deadline - time.time()))
+    if not alive:
+      time.sleep(max(0, deadline - time.time()))
+    cpu, now = _cpu_time(), time.time()
+    reports.put((worker_id, {
+      'pid': os.getpid(),
+      'bots': len(alive),
+      'connections': len(reactor),
+      'cpu': (cpu - last_cpu) / max(now - last_time, 1e-6),
+    }))
+    last_cpu, last_time = cpu, now
+    if not alive:
+      break
+  reactor.stop()
+  # Stopped bots forget their connection, those that lost it keep it.
+  if any(b.connection is not None for b in bots):
+    LOGGER.error("Worker %d lost all its connections." % worker_id)
+    sys.exit(1)
+
+
+# Runs the bots of a manifest on a pool of worker processes, restarting the
+# workers that crash.
+class Supervisor(object):
+  def __init__(self, manifest, workers = None, report_interval = 10.0,
+                     restart_delay = 5.0, max_restart_delay = 300.0,
+                     max_restarts = None):
+    """
+    Arguments: manifest List of bot entries (see load_manifest()).
+               workers Number of worker processes, one per CPU by default.
+               report_interval Seconds between two load reports of a worker.
+               restart_delay Seconds to wait before restarting a worker. It
+                             doubles each time the worker crashes again
+                             before its first report, e.g. setting up its
+                             bots.
+               max_restart_delay Upper bound of the delay before a restart.
+               max_restarts Give up on a worker after that many restarts, or
+                            None to always restart it.
+    """
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+    workers = max(1, min(workers, len(manifest)))
+    self.report_interval = report_interval
+    self.restart_delay = restart_delay
+    self.max_restart_delay = max_restart_delay
+    self.max_restarts = max_restarts
+    self.shards = [manifest[i::workers] for i in range(workers)]
+    self.processes = [None] * workers
+    self.restarts = [0] * workers
+    # Last load report of each worker.
+    self.load = [None] * workers
+    self.keep_going = True
+    self.__reports = multiprocessing.Queue()
+    self.__crashed_at = {}
+    # Crashes of each worker since its last report.
+    self.__failures = [0] * workers
+
+  def start(self):
+    for worker_id in range(len(self.shards)):
+      self.__spawn(worker_id)
+
+  def stop(self):
+    self.keep_going = False
+    for process in self.processes:
+      if process is not None and process.is_alive():
+        process.terminate()
+
+  # Supervise the workers until all of them are done, or stop() is called.
+  def run(self):
+    self.start()
+    while self.keep_going and any(self.processes):
+      self.__read_reports(timeout = 1.0)
+      for worker_id, process in enumerate(self.processes):
+        if process is None or process.is_alive():
+          continue
+        self.__reap(worker_id, process)
+    self.stop()
+
+  ##############################################################################
+  # Private.
+  def __spawn(self, worker_id):
+    process = multiprocessing.Process(
+        target = _worker_main,
+        name = 'mumble-worker-%d' % worker_id,
+        args = (worker_id, self.shards[worker_id], self.__reports,
+                self.report_interval))
+    process.daemon = True
+    process.start()
+    self.processes[worker_id] = process
+    LOGGER.info("Worker %d (pid %d) started with %d bots." % (
+                worker_id, process.pid, len(self.shards[worker_id])))
+
+  def __reap(self, worker_id, process):
+    if process.exitcode == 0:
+      LOGGER.info("Worker %d done." % worker_id)
+      self.processes[worker_id] = None
+      return
+    now = time.time()
+    crashed_at = self.__crashed_at.setdefault(worker_id, now)
+    delay = min(self.max_restart_delay,
+                self.restart_delay * 2 ** self.__failures[worker_id])
+    if now - crashed_at < delay:
+      return
+    del self.__crashed_at[worker_id]
+    if (self.max_restarts is not None and
+        self.restarts[worker_id] >= self.max_restarts):
+      LOGGER.error("Worker %d crashed (exit code %d), giving up." % (
+                   worker_id, process.exitcode))
+      self.processes[worker_id] = None
+      return
+    LOGGER.warning("Worker %d crashed (exit code %d), restarting." % (
+                   worker_id, process.exitcode))
+    self.restarts[worker_id] += 1
+    self.__failures[worker_id] += 1
+    self.__spawn(worker_id)
+
+  def __read_reports(self, timeout):
+    try:
+      report = self.__reports.get(timeout = timeout)
+      while True:
+        worker_id, load = report
+        self.load[worker_id] = load
+        # It got its bots going.
+        self.__failures[worker_id] = 0
+        LOGGER.info("Worker %d: %d bots, %.1f%% CPU." % (
+                    worker_id, load['bots'], load['cpu'] * 100.0))
+        report = self.__reports.get_nowait()
+    except Queue.Empty:
+      pass
+
+
+def main(argv):
+  parser = OptionParser(usage = "%prog [options] manifest.json")
+  parser.add_option("-w", "--workers", type = "int", default = None,
+                    help = "Number of worker processes (default: CPU count).")
+  parser.add_option("-i", "--report-interval", type = "float", default = 10.0,
+                    help = "Seconds between load reports of the workers.")
+  options, args = parser.parse_args(argv[1:])
+  if len(args) != 1:
+    parser.error("Expected the path of one manifest.")
+  logging.basicConfig(level = logging.INFO)
+  supervisor = Supervisor(load_manifest(args[0]), workers = options.workers,
+                          report_interval = options.report_interval)
+  try:
+    supervisor.run()
+  except KeyboardInterrupt:
+    supervisor.stop()
+
+if __name__ == '__main__':
+  main(sys.argv)
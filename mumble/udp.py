@@ -0,0 +1,134 @@
+import errno
+import logging
+import socket
+import thread
+import time
+
+import protocol
+
+LOGGER = logging.getLogger(__name__)
+
+# Voice goes back to the TCP tunnel when the server didn't answer a UDP ping
+# for that many seconds.
+UDP_TIMEOUT = 25.0
+# Ask the server to resynchronize the crypto when nothing could be decrypted
+# for that many seconds, while packets still arrive.
+RESYNC_TIMEOUT = 5.0
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+# Voice transport over UDP, encrypted with the CryptState set up by the
+# server's CryptSetup message. It is only trusted once the server answers its
+# pings; until then, and whenever it stops answering, the connection keeps
+# using the TCP tunnel.
+class UdpTransport(object):
+  def __init__(self, address, crypt):
+    """
+    Arguments: address (host, port) of the server.
+               crypt The CryptState keyed for this connection.
+    """
+    self.address = address
+    self.crypt = crypt
+    self.mutex = thread.allocate_lock()
+    family = socket.getaddrinfo(address[0], address[1], 0,
+                                socket.SOCK_DGRAM)[0][0]
+    self.socket = socket.socket(family, socket.SOCK_DGRAM)
+    self.socket.setblocking(0)
+    self.__started = time.time()
+    # Counters, reported to the server in TCP pings.
+    self.packets_received = 0
+    self.ping_avg = 0.0
+    self.ping_var = 0.0
+    self.__pings_answered = 0
+    self.__last_ping_sent = None
+    self.__last_pong = None
+    self.__last_good = None
+    self.__last_failure = None
+    self.__last_resync = None
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def close(self):
+    self.socket.close()
+
+  # Whether the server answers over UDP, so voice can use it.
+  def is_active(self, now = None):
+    if self.__last_pong is None:
+      return False
+    return (now or time.time()) - self.__last_pong < UDP_TIMEOUT
+
+  # Encrypt and send a voice packet.
+  def send(self, packet):
+    self.mutex.acquire()
+    try:
+      data = self.crypt.encrypt(packet)
+    finally:
+      self.mutex.release()
+    try:
+      self.socket.sendto(data, self.address)
+    except socket.error as e:
+      if e.errno not in _WOULD_BLOCK:
+        LOGGER.warning("Couldn't send UDP voice: %s" % e)
+      return False
+    return True
+
+  def ping(self):
+    now = time.time()
+    self.__last_ping_sent = now
+    # The server echoes the timestamp as is; milliseconds since we started
+    # keep it short.
+    self.send(protocol.voice_ping(int((now - self.__started) * 1000.0)))
+
+  # Read all pending datagrams. Returns the list of decrypted voice packets;
+  # ping answers are handled here and returned too.
+  def receive(self):
+    packets = []
+    while True:
+      try:
+        data, address = self.socket.recvfrom(2048)
+      except socket.error as e:
+        if e.errno in _WOULD_BLOCK:
+          break
+        raise
+      self.mutex.acquire()
+      try:
+        plain = self.crypt.decrypt(data)
+      finally:
+        self.mutex.release()
+      if plain is None:
+        self.__last_failure = time.time()
+        continue
+      self.packets_received += 1
+      self.__last_good = time.time()
+      if protocol.voice_type(plain) == protocol.VOICE_PING:
+        self.__on_pong()
+      packets.append(plain)
+    return packets
+
+  # Whether the crypto seems out of sync with the server, and we should ask
+  # it for a new server nonce. Only says so once per RESYNC_TIMEOUT.
+  def needs_resync(self, now = None):
+    now = now or time.time()
+    if self.__last_failure is None or now - self.__last_failure > 1.0:
+      return False
+    last_good = max(self.__last_good or 0, self.__last_resync or 0)
+    if now - last_good < RESYNC_TIMEOUT:
+      return False
+    self.__last_resync = now
+    return True
+
+  ##############################################################################
+  # Private.
+  def __on_pong(self):
+    now = time.time()
+    self.__last_pong = now
+    if self.__last_ping_sent is None:
+      return
+    # Running average and variance of the round trip, in milliseconds.
+    rtt = (now - self.__last_ping_sent) * 1000.0
+    self.__pings_answered += 1
+    delta = rtt - self.ping_avg
+    self.ping_avg += delta / self.__pings_answered
+    self.ping_var += (delta * (rtt - self.ping_avg) - self.ping_var) / (
+        self.__pings_answered)
@@ -43,10 +43,12 @@ class User(object):
   def update(self, msg):
     assert msg.session == self.session
     if msg.name: self.name = msg.name
-    if msg.user_id is not None:
+    if msg.HasField('user_id'):
       self.id = msg.user_id
       self.is_superuser = msg.user_id == 0
-    if msg.channel_id is not None:
+    # Users in the root channel come without channel_id. For those already
+    # placed, no channel_id means they didn't move.
+    if msg.HasField('channel_id') or self.channel is None:
       chan = self.bot.get_channel_by_id(msg.channel_id)
       if not self.channel:
         chan.add_user(self)
@@ -59,11 +61,18 @@ class User(object):
     if msg.deaf: self.is_deaf = msg.deaf
     if msg.suppress: self.is_suppressed = msg.suppress
 
+    # None if the bot was stopped from another thread in the meantime.
+    connection = self.bot.connection
     if msg.comment:
       self.comment = msg.comment
     elif msg.comment_hash:
+      # Users kept across a reconnection may have that comment already.
+      if connection is not None and (
+          msg.comment_hash != getattr(self, 'comment_hash', None) or
+          not hasattr(self, 'comment')):
+        connection.ask_comment_for_user(self.session)
+        # The callback will set it automatically.
       self.comment_hash = msg.comment_hash
-      self.bot.connection.ask_comment_for_user(self.session)
-      # The callback will set it automatically.
-    self.bot.connection.ask_stats_for_user(self.session)
+    if connection is not None:
+      connection.ask_stats_for_user(self.session)
 
@@ -0,0 +1,133 @@
+# Bot.join(), with the connection on a thread of its own or on mumble.loop(),
+# across reconnections.
+
+import socket
+import threading
+import time
+import unittest
+
+import mumble
+from mumble.emulator import Emulator
+
+
+# Wait until condition() is true, or fail after timeout seconds.
+def _wait_for(condition, timeout = 10.0):
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      raise AssertionError("Timed out.")
+    time.sleep(0.02)
+
+
+class _Bot(mumble.Bot):
+  def __init__(self, **kwargs):
+    mumble.Bot.__init__(self, **kwargs)
+    self.syncs = 0
+
+  def connected(self):
+    self.syncs += 1
+
+
+class BotJoinTest(unittest.TestCase):
+  def setUp(self):
+    self.emulator = Emulator(users = 5, channels = 2, seed = 1)
+    self.emulator.start()
+    self.loop = None
+
+  def tearDown(self):
+    self.emulator.stop()
+    if self.loop is not None:
+      self.loop.join(5)
+
+  def start(self, bot, async):
+    if not async:
+      bot.start(self.emulator.server(), "-Bot-")
+    else:
+      bot.start_async(self.emulator.server(), "-Bot-")
+      self.loop = threading.Thread(target = mumble.loop)
+      self.loop.daemon = True
+      self.loop.start()
+    _wait_for(lambda: bot.syncs == 1)
+
+  # Run bot.join(timeout) on another thread; returns the thread.
+  def join(self, bot, timeout = None):
+    joiner = threading.Thread(target = bot.join, args = (timeout,))
+    joiner.daemon = True
+    joiner.start()
+    return joiner
+
+  def kill_connections(self):
+    for client in self.emulator._Emulator__clients.values():
+      client.socket.shutdown(socket.SHUT_RDWR)
+
+  def check_stop(self, async):
+    bot = _Bot()
+    self.start(bot, async)
+    joiner = self.join(bot)
+    joiner.join(0.2)
+    self.assertTrue(joiner.is_alive())
+    bot.stop()
+    joiner.join(5)
+    self.assertFalse(joiner.is_alive())
+
+  def check_reconnect(self, async):
+    bot = _Bot(reconnect = mumble.ReconnectPolicy(base_delay = 0.3,
+                                                  jitter = 0))
+    self.start(bot, async)
+    joiner = self.join(bot)
+    self.kill_connections()
+    _wait_for(lambda: bot.syncs == 2)
+    # Reconnecting isn't disconnecting.
+    self.assertTrue(joiner.is_alive())
+    bot.stop()
+    joiner.join(5)
+    self.assertFalse(joiner.is_alive())
+
+  def check_disconnect(self, async):
+    bot = _Bot()
+    self.start(bot, async)
+    joiner = self.join(bot)
+    self.kill_connections()
+    joiner.join(5)
+    self.assertFalse(joiner.is_alive())
+
+  def check_timeout(self, async):
+    bot = _Bot(reconnect = mumble.ReconnectPolicy(base_delay = 10.0))
+    self.start(bot, async)
+    self.kill_connections()
+    _wait_for(bot.is_reconnecting)
+    start = time.time()
+    bot.join(0.2)
+    self.assertTrue(time.time() - start < 2.0)
+    bot.stop()
+    # Stopping cancels the reconnection.
+    self.assertFalse(bot.is_reconnecting())
+    bot.join()
+
+  def test_stop(self):
+    self.check_stop(async = False)
+
+  def test_stop_async(self):
+    self.check_stop(async = True)
+
+  def test_reconnect(self):
+    self.check_reconnect(async = False)
+
+  def test_reconnect_async(self):
+    self.check_reconnect(async = True)
+
+  def test_disconnect(self):
+    self.check_disconnect(async = False)
+
+  def test_disconnect_async(self):
+    self.check_disconnect(async = True)
+
+  def test_timeout(self):
+    self.check_timeout(async = False)
+
+  def test_timeout_async(self):
+    self.check_timeout(async = True)
+
+
+if __name__ == '__main__':
+  unittest.main()
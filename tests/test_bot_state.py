@@ -0,0 +1,75 @@
+# BotState fed with the messages of a server, replayed from a capture.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mumble import bot
+from mumble import capture
+from mumble import mumble_pb2
+from mumble import protocol
+
+
+def _record(writer, msg_class, **fields):
+  msg = msg_class()
+  for name, value in fields.items():
+    setattr(msg, name, value)
+  writer.inbound(protocol.MESSAGE_TYPE_LOOKUP[msg_class],
+                 msg.SerializeToString())
+
+
+class BotStateTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'session.cap')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def replay(self, *messages):
+    writer = capture.CaptureWriter(self.path)
+    _record(writer, mumble_pb2.ChannelState, channel_id = 0, parent = 0,
+            name = "Root")
+    _record(writer, mumble_pb2.ChannelState, channel_id = 1, parent = 0,
+            name = "Lobby")
+    for msg_class, fields in messages:
+      _record(writer, msg_class, **fields)
+    writer.close()
+    listener = bot.Bot()
+    listener.replay(self.path)
+    return listener.state
+
+  def test_root_user(self):
+    # Murmur leaves channel_id out for users in the root channel.
+    state = self.replay(
+        (mumble_pb2.UserState, {'session': 1, 'name': "Alice"}),
+        (mumble_pb2.UserState, {'session': 2, 'name': "Bob",
+                                'channel_id': 1}),
+        (mumble_pb2.ServerSync, {'session': 1}))
+    root, lobby = state.channels_by_id[0], state.channels_by_id[1]
+    alice, bob = state.users_by_session[1], state.users_by_session[2]
+    self.assertIs(alice.channel, root)
+    self.assertIn(alice.session, root.users)
+    self.assertIs(bob.channel, lobby)
+    self.assertIs(state.user, alice)
+
+  def test_update_without_channel(self):
+    # Only a move has channel_id; other updates keep the user where it is.
+    state = self.replay(
+        (mumble_pb2.UserState, {'session': 2, 'name': "Bob",
+                                'channel_id': 1}),
+        (mumble_pb2.UserState, {'session': 2, 'mute': True}),
+        (mumble_pb2.UserState, {'session': 3, 'name': "Carol"}),
+        (mumble_pb2.UserState, {'session': 3, 'channel_id': 1}),
+        (mumble_pb2.UserState, {'session': 2, 'channel_id': 0}))
+    root, lobby = state.channels_by_id[0], state.channels_by_id[1]
+    bob, carol = state.users_by_session[2], state.users_by_session[3]
+    self.assertTrue(bob.is_muted)
+    self.assertIs(bob.channel, root)
+    self.assertIs(carol.channel, lobby)
+    self.assertNotIn(carol.session, root.users)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+# CryptState against the OCB test vectors, and the way it follows the
+# packets received. Needs PyCrypto (or PyCryptodome).
+
+import unittest
+
+from mumble import crypt_state
+from mumble.crypt_state import CryptState
+
+_KEY = ''.join(chr(i) for i in range(16))
+_NONCE = _KEY
+
+# OCB draft test vectors, with key and nonce 000102..0F: the plain text is
+# bytes 00, 01... of the given length.
+_VECTORS = [
+  (0, '', 'BF3108130773AD5EC70EC69E7875A7B0'),
+  (40, 'F75D6BC8B4DC8D66B836A2B08B32A6369F1CD3C5228D79FD'
+       '6C267F5F6AA7B231C7DFB9D59951AE9C',
+   '9DB0CDF880F73E3E10D4EB3217766688'),
+]
+
+def _pair():
+  client, server = CryptState(), CryptState()
+  client_nonce, server_nonce = '\x01' * 16, '\x80' * 16
+  client.set_key(_KEY, client_nonce, server_nonce)
+  server.set_key(_KEY, server_nonce, client_nonce)
+  return client, server
+
+
+@unittest.skipIf(crypt_state.AES is None, "PyCrypto is not installed.")
+class CryptStateTest(unittest.TestCase):
+  def test_vectors(self):
+    state = CryptState()
+    state.set_key(_KEY, _NONCE, _NONCE)
+    for length, encrypted, tag in _VECTORS:
+      plain = ''.join(chr(i) for i in range(length))
+      result = state._CryptState__ocb_encrypt(plain, _NONCE)
+      self.assertEqual((result[0].encode('hex').upper(),
+                        result[1].encode('hex').upper()), (encrypted, tag))
+      result = state._CryptState__ocb_decrypt(result[0], _NONCE)
+      self.assertEqual(result, (plain, tag.decode('hex')))
+
+  def test_round_trip(self):
+    client, server = _pair()
+    for length in range(0, 100, 7) + [1000]:
+      plain = ''.join(chr((i * 7 + 3) & 0xFF) for i in range(length))
+      packet = client.encrypt(plain)
+      self.assertEqual(len(packet), length + crypt_state.HEADER_SIZE)
+      self.assertEqual(server.decrypt(packet), plain)
+    self.assertEqual((server.good, server.late, server.lost), (16, 0, 0))
+
+  def test_wraparound(self):
+    client, server = _pair()
+    for i in range(600):
+      self.assertEqual(server.decrypt(client.encrypt('voice %d' % i)),
+                       'voice %d' % i)
+    self.assertEqual(client.encrypt_iv, server.decrypt_iv)
+
+  def test_replay_and_forgery(self):
+    client, server = _pair()
+    packet = client.encrypt('voice')
+    self.assertEqual(server.decrypt(packet), 'voice')
+    self.assertEqual(server.decrypt(packet), None)
+    packet = client.encrypt('voice')
+    forged = packet[:-1] + chr(ord(packet[-1]) ^ 1)
+    self.assertEqual(server.decrypt(forged), None)
+    self.assertEqual(server.decrypt(packet[:3]), None)
+    self.assertEqual(server.decrypt(packet), 'voice')
+
+  def test_late_and_lost(self):
+    client, server = _pair()
+    packets = [client.encrypt('voice %d' % i) for i in range(5)]
+    self.assertEqual(server.decrypt(packets[0]), 'voice 0')
+    self.assertEqual(server.decrypt(packets[3]), 'voice 3')
+    self.assertEqual(server.lost, 2)
+    self.assertEqual(server.decrypt(packets[1]), 'voice 1')
+    self.assertEqual((server.late, server.lost), (1, 1))
+    self.assertEqual(server.decrypt(packets[1]), None)
+    self.assertEqual(server.decrypt(packets[4]), 'voice 4')
+    self.assertEqual(server.good, 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,120 @@
+# Ordering and overflow of the SessionExecutor.
+
+import logging
+import random
+import threading
+import time
+import unittest
+
+from mumble.executor import OVERFLOW_DROP, SessionExecutor
+
+
+class SessionExecutorTest(unittest.TestCase):
+  def setUp(self):
+    self.executor = None
+
+  def tearDown(self):
+    if self.executor is not None:
+      self.executor.shutdown()
+
+  def test_order_by_key(self):
+    self.executor = SessionExecutor(workers = 4)
+    mutex = threading.Lock()
+    done = dict((key, []) for key in range(5))
+    running = set()
+    overlaps = []
+    def task(key, i):
+      with mutex:
+        if key in running:
+          overlaps.append(key)
+        running.add(key)
+      time.sleep(random.random() * 0.002)
+      with mutex:
+        running.discard(key)
+        done[key].append(i)
+    for i in range(40):
+      for key in done:
+        self.executor.submit(key, task, key, i)
+    self.executor.shutdown()
+    self.assertEqual(overlaps, [])
+    for key in done:
+      self.assertEqual(done[key], range(40))
+    self.assertEqual(self.executor.completed, 200)
+
+  def test_keys_in_parallel(self):
+    self.executor = SessionExecutor(workers = 2)
+    blocked = threading.Event()
+    ran = threading.Event()
+    self.executor.submit(1, blocked.wait, 5)
+    # Not held up by the task of key 1.
+    self.executor.submit(2, ran.set)
+    self.assertTrue(ran.wait(5))
+    blocked.set()
+
+  def test_overflow_block(self):
+    self.executor = SessionExecutor(workers = 1, max_pending = 1)
+    blocked = threading.Event()
+    self.executor.submit(1, blocked.wait, 5)
+    self.executor.submit(1, lambda: None)
+    returned = threading.Event()
+    def submit():
+      self.executor.submit(2, lambda: None)
+      returned.set()
+    submitter = threading.Thread(target = submit)
+    submitter.daemon = True
+    submitter.start()
+    # Waits for room.
+    self.assertFalse(returned.wait(0.2))
+    blocked.set()
+    self.assertTrue(returned.wait(5))
+    self.executor.shutdown()
+    self.assertEqual((self.executor.completed, self.executor.dropped), (3, 0))
+
+  def test_overflow_drop(self):
+    self.executor = SessionExecutor(workers = 1, max_pending = 2,
+                                    overflow = OVERFLOW_DROP)
+    blocked = threading.Event()
+    self.executor.submit(1, blocked.wait, 5)
+    while self.executor.busy == 0:
+      time.sleep(0.001)
+    logger = logging.getLogger('mumble.executor')
+    logger.disabled = True
+    try:
+      results = [self.executor.submit(1, lambda: None) for _ in range(4)]
+    finally:
+      logger.disabled = False
+    self.assertEqual(results, [True, True, False, False])
+    self.assertEqual(self.executor.depths(), {1: 2})
+    self.assertEqual(self.executor.max_depth, 2)
+    blocked.set()
+    self.executor.shutdown()
+    self.assertEqual((self.executor.completed, self.executor.dropped), (3, 2))
+
+  def test_failed(self):
+    self.executor = SessionExecutor(workers = 1)
+    ran = []
+    def fail():
+      raise ValueError("Oops.")
+    logger = logging.getLogger('mumble.executor')
+    logger.disabled = True
+    try:
+      self.executor.submit(1, fail)
+      self.executor.submit(1, ran.append, 'next')
+      self.executor.shutdown()
+    finally:
+      logger.disabled = False
+    self.assertEqual(ran, ['next'])
+    self.assertEqual(self.executor.failed, 1)
+
+  def test_shutdown(self):
+    self.executor = SessionExecutor(workers = 1)
+    self.executor.shutdown()
+    self.assertFalse(self.executor.submit(1, lambda: None))
+
+  def test_bad_overflow(self):
+    self.assertRaises(ValueError, SessionExecutor, workers = 0,
+                      overflow = 'explode')
+
+
+if __name__ == '__main__':
+  unittest.main()
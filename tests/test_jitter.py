@@ -0,0 +1,144 @@
+# Jitter buffers: ordering, pauses between transmissions, and counters.
+
+import unittest
+
+from mumble.jitter import JitterBuffer, JitterBuffers
+
+# Clients send a packet of 20 ms, two sequence numbers, every 20 ms.
+_STEP = 2
+_INTERVAL = 0.02
+
+
+class JitterBufferTest(unittest.TestCase):
+  def setUp(self):
+    self.buffer = JitterBuffer(delay = 0.06, size = 64)
+    self.released = []
+
+  # Put the packets, as (sequence, arrival time, last), releasing every
+  # interval until all of them are played.
+  def play(self, packets):
+    packets = sorted(packets, key = lambda p: p[1])
+    now = packets[0][1]
+    while packets or len(self.buffer):
+      while packets and packets[0][1] <= now:
+        sequence, _, last = packets.pop(0)
+        self.buffer.put(sequence, 'voice %d' % sequence, now, last)
+      self.released.extend(s for s, _ in self.buffer.release(now))
+      now += _INTERVAL
+
+  # A transmission of count packets from sequence, starting at start.
+  def spurt(self, sequence, start, count, last = True):
+    return [(sequence + i * _STEP, start + i * _INTERVAL,
+             last and i == count - 1) for i in range(count)]
+
+  def test_in_order(self):
+    self.play(self.spurt(0, 0.0, 10))
+    self.assertEqual(self.released, range(0, 20, 2))
+    stats = self.buffer.stats
+    self.assertEqual((stats.received, stats.released, stats.lost, stats.late),
+                     (10, 10, 0, 0))
+
+  def test_delay(self):
+    self.buffer.put(0, 'voice', 10.0)
+    self.assertEqual(self.buffer.release(10.05), [])
+    self.assertEqual(self.buffer.release(10.06), [(0, 'voice')])
+
+  def test_reordered(self):
+    packets = self.spurt(0, 0.0, 10)
+    # 6 comes after 8, 10 after 14: both within the delay.
+    packets[3] = (6, packets[4][1] + 0.001, False)
+    packets[5] = (10, packets[7][1] + 0.001, False)
+    self.play(packets)
+    self.assertEqual(self.released, range(0, 20, 2))
+    self.assertEqual((self.buffer.stats.lost, self.buffer.stats.late), (0, 0))
+
+  def test_reordered_first(self):
+    # The second packet comes first: the transmission starts at the other.
+    self.play([(2, 0.0, False), (0, 0.01, False), (4, 0.04, True)])
+    self.assertEqual(self.released, [0, 2, 4])
+
+  def test_late(self):
+    packets = self.spurt(0, 0.0, 10)
+    packets[2] = (4, 0.5, False)
+    self.play(packets)
+    self.assertEqual(self.released, [0, 2] + range(6, 20, 2))
+    self.assertEqual(self.buffer.stats.late, 1)
+
+  def test_duplicates(self):
+    packets = self.spurt(0, 0.0, 5)
+    packets.append((2, 0.021, False))
+    # Long after it was played, it is only late.
+    packets.append((0, 0.2, False))
+    self.play(packets)
+    self.assertEqual(self.released, range(0, 10, 2))
+    self.assertEqual((self.buffer.stats.duplicates, self.buffer.stats.late),
+                     (1, 1))
+
+  def test_lost(self):
+    packets = self.spurt(0, 0.0, 20)
+    del packets[12]
+    del packets[5:7]
+    self.play(packets)
+    self.assertEqual(self.buffer.stats.lost, 3)
+    self.assertEqual(self.buffer.stats.released, 17)
+
+  def test_pause_after_terminator(self):
+    for pause in (0.1, 0.3, 0.6, 0.66, 0.7, 2.0):
+      self.setUp()
+      first = self.spurt(0, 0.0, 50)
+      # Sequence numbers go on during the silence.
+      start = 1.0 + pause
+      second = self.spurt(int(round(start / 0.01)), start, 50)
+      self.play(first + second)
+      stats = self.buffer.stats
+      self.assertEqual(len(self.released), 100, pause)
+      self.assertEqual((stats.lost, stats.overflows, stats.late), (0, 0, 0),
+                       pause)
+
+  def test_pause_without_terminator(self):
+    # The terminator was lost: a jump of the sequence by the size of the
+    # buffer or more starts a new transmission all the same.
+    for pause in (0.62, 0.66, 0.7):
+      self.setUp()
+      first = self.spurt(0, 0.0, 50, last = False)
+      start = 1.0 + pause
+      second = self.spurt(int(round(start / 0.01)), start, 50)
+      self.play(first + second)
+      self.assertEqual(len(self.released), 100, pause)
+      self.assertEqual(self.buffer.stats.overflows, 0, pause)
+
+  def test_overflow(self):
+    # Too far ahead of a packet still waiting to be played.
+    self.buffer.put(0, 'voice', 0.0)
+    self.buffer.put(64, 'voice', 0.01)
+    self.assertEqual(self.buffer.stats.overflows, 1)
+    self.assertEqual(len(self.buffer), 1)
+
+  def test_late_after_terminator(self):
+    # A packet of the transmission that ended, after it was played.
+    self.play(self.spurt(0, 0.0, 5))
+    self.buffer.put(6, 'voice', 0.5)
+    self.assertEqual(self.buffer.stats.late, 1)
+    self.assertEqual(len(self.buffer), 0)
+
+
+class JitterBuffersTest(unittest.TestCase):
+  def test_sessions(self):
+    buffers = JitterBuffers(delay = 0.04, expire = 1.0)
+    buffers.put(1, 2, 'b', now = 0.0)
+    buffers.put(2, 0, 'x', now = 0.0)
+    buffers.put(1, 0, 'a', now = 0.01)
+    self.assertEqual(len(buffers), 3)
+    released = buffers.release(now = 0.1)
+    self.assertEqual(sorted(released), [(1, 0, 'a'), (1, 2, 'b'),
+                                        (2, 0, 'x')])
+    self.assertEqual(sorted(buffers.stats()), [1, 2])
+    buffers.remove(2)
+    self.assertEqual(sorted(buffers.stats()), [1])
+    # Forgotten once silent for expire seconds.
+    buffers.release(now = 2.0)
+    self.assertEqual(buffers.stats(), {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+# Voice varints and headers. Run from the top of the repository:
+#   python -m unittest discover tests
+
+import unittest
+
+from mumble import protocol
+
+# Largest value of each size of varint, and the sizes around it.
+_BOUNDARIES = [
+  (0x7F, 1, 2),
+  (0x3FFF, 2, 3),
+  (0x1FFFFF, 3, 4),
+  (0xFFFFFFF, 4, 5),
+  (0xFFFFFFFF, 5, 9),
+]
+_UINT64_MAX = 0xFFFFFFFFFFFFFFFF
+
+def _inputs(encoded):
+  return [encoded, bytearray(encoded), memoryview(encoded)]
+
+
+class VarintTest(unittest.TestCase):
+  def assertRoundTrip(self, value, size = None):
+    encoded = protocol.encode_varint(value)
+    if size is not None:
+      self.assertEqual(len(encoded), size, "%d: %r" % (value, encoded))
+    for data in _inputs(encoded):
+      self.assertEqual(protocol.decode_varint(data), (value, len(encoded)),
+                       "%d from %r" % (value, type(data)))
+      # At an offset, with data after it.
+      padded = type(data)('\x7f' * 3 + encoded + '\xff')
+      self.assertEqual(protocol.decode_varint(padded, 3),
+                       (value, len(encoded)))
+
+  def test_small_values(self):
+    for value in xrange(0x10000):
+      self.assertRoundTrip(value)
+
+  def test_boundaries(self):
+    self.assertRoundTrip(0, 1)
+    for largest, size, next_size in _BOUNDARIES:
+      self.assertRoundTrip(largest - 1, size)
+      self.assertRoundTrip(largest, size)
+      self.assertRoundTrip(largest + 1, next_size)
+    self.assertRoundTrip(_UINT64_MAX - 1, 9)
+    self.assertRoundTrip(_UINT64_MAX, 9)
+
+  def test_forms(self):
+    self.assertEqual(protocol.encode_varint(0x80), '\x80\x80')
+    self.assertEqual(protocol.encode_varint(0x4000), '\xc0\x40\x00')
+    self.assertEqual(protocol.encode_varint(0x200000), '\xe0\x20\x00\x00')
+    self.assertEqual(protocol.encode_varint(0x10000000),
+                     '\xf0\x10\x00\x00\x00')
+    self.assertEqual(protocol.encode_varint(0x100000000),
+                     '\xf4\x00\x00\x00\x01\x00\x00\x00\x00')
+
+  def test_negative_two_bits(self):
+    # 111111xx: ~xx, for -1 to -4.
+    for value in (-1, -2, -3, -4):
+      self.assertEqual(protocol.encode_varint(value), chr(0xFC | ~value))
+      self.assertRoundTrip(value, 1)
+
+  def test_negative_varint(self):
+    # 111110__ followed by the varint of ~value.
+    self.assertEqual(protocol.encode_varint(-5), '\xf8\x04')
+    self.assertRoundTrip(-5, 2)
+    for largest, size, next_size in _BOUNDARIES:
+      self.assertRoundTrip(~largest, 1 + size)
+      self.assertRoundTrip(~(largest + 1), 1 + next_size)
+    self.assertRoundTrip(~_UINT64_MAX, 10)
+    for value in xrange(-0x1000, 0):
+      self.assertRoundTrip(value)
+
+  def test_out_of_range(self):
+    self.assertRaises(ValueError, protocol.encode_varint, _UINT64_MAX + 1)
+    self.assertRaises(ValueError, protocol.encode_varint, ~(_UINT64_MAX + 1))
+
+  def test_truncated(self):
+    values = [0, 0x80, 0x4000, 0x200000, 0x10000000, 0x100000000, -5,
+              ~0x4000]
+    for value in values:
+      encoded = protocol.encode_varint(value)
+      for end in xrange(len(encoded)):
+        for data in _inputs(encoded[:end]):
+          self.assertRaises(ValueError, protocol.decode_varint, data)
+
+
+class VoiceHeaderTest(unittest.TestCase):
+  # A voice packet as the server sends it: with the session of the speaker.
+  def packet(self, type, session, sequence, payload = 'frames', target = 0):
+    return (chr(type << 5 | target) + protocol.encode_varint(session) +
+            protocol.encode_varint(sequence) + payload)
+
+  def test_offsets(self):
+    for session, sequence in ((1, 0), (5, 300), (0x4000, 0x200000),
+                              (0xFFFFFFFF, 0x100000000)):
+      packet = self.packet(protocol.VOICE_OPUS, session, sequence, target = 2)
+      length = (1 + len(protocol.encode_varint(session)) +
+                len(protocol.encode_varint(sequence)))
+      for data in _inputs(packet):
+        self.assertEqual(protocol.parse_voice_header(data),
+                         (protocol.VOICE_OPUS, 2, session, sequence, length))
+      self.assertEqual(packet[length:], 'frames')
+
+  def test_ping(self):
+    # A timestamp, and no sequence.
+    packet = chr(protocol.VOICE_PING << 5) + protocol.encode_varint(123456)
+    self.assertEqual(protocol.parse_voice_header(packet),
+                     (protocol.VOICE_PING, 0, 123456, 0, len(packet)))
+
+  def test_truncated(self):
+    self.assertRaises(ValueError, protocol.parse_voice_header, '')
+    packet = self.packet(protocol.VOICE_OPUS, 0x4000, 0x4000, payload = '')
+    for end in xrange(1, len(packet)):
+      self.assertRaises(ValueError, protocol.parse_voice_header,
+                        packet[:end])
+
+  def test_frames(self):
+    frames = ['a' * 10, 'b' * 127, '']
+    sent = protocol.voice_packet(protocol.VOICE_CELT_ALPHA, 7, frames)
+    packet = sent[0] + protocol.encode_varint(3) + sent[1:]
+    type, _, session, sequence, offset = protocol.parse_voice_header(packet)
+    self.assertEqual((session, sequence), (3, 7))
+    self.assertEqual([frame.tobytes() for frame in
+                      protocol.iter_voice_frames(packet, offset, type)],
+                     frames)
+    sent = protocol.opus_voice(9, 'opus', last = True)
+    packet = sent[0] + protocol.encode_varint(3) + sent[1:]
+    type, _, _, sequence, offset = protocol.parse_voice_header(packet)
+    self.assertEqual(sequence, 9)
+    self.assertEqual([frame.tobytes() for frame in
+                      protocol.iter_voice_frames(packet, offset, type)],
+                     ['opus', ''])
+
+
+if __name__ == '__main__':
+  unittest.main()
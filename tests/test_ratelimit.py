@@ -0,0 +1,88 @@
+# Token buckets of the rate limiter, and the messages it holds between
+# connections.
+
+import unittest
+
+from mumble import mumble_pb2
+from mumble.ratelimit import (DEFAULT_BURST, DEFAULT_RATE, RateLimiter,
+                              TokenBucket)
+
+
+class TokenBucketTest(unittest.TestCase):
+  def test_burst(self):
+    bucket = TokenBucket(rate = 2.0, burst = 3)
+    self.assertEqual([bucket.reserve(100.0) for _ in range(3)], [0, 0, 0])
+    # Then one every half second.
+    self.assertAlmostEqual(bucket.reserve(100.0), 0.5)
+    self.assertAlmostEqual(bucket.reserve(100.0), 1.0)
+
+  def test_refill(self):
+    bucket = TokenBucket(rate = 2.0, burst = 3)
+    for _ in range(3):
+      bucket.reserve(100.0)
+    self.assertAlmostEqual(bucket.reserve(100.25), 0.25)
+    # The reservation above took the token refilled at 100.5.
+    self.assertAlmostEqual(bucket.reserve(100.5), 0.5)
+    self.assertEqual(bucket.reserve(101.5), 0)
+
+  def test_refill_up_to_burst(self):
+    bucket = TokenBucket(rate = 1.0, burst = 2)
+    bucket.reserve(100.0)
+    bucket.reserve(1000.0)
+    self.assertAlmostEqual(bucket.tokens, 1.0)
+    self.assertEqual(bucket.reserve(1000.0), 0)
+    self.assertAlmostEqual(bucket.reserve(1000.0), 1.0)
+
+
+class RateLimiterTest(unittest.TestCase):
+  def test_defaults(self):
+    limiter = RateLimiter()
+    waits = [limiter.reserve(mumble_pb2.TextMessage, 100.0)
+             for _ in range(DEFAULT_BURST + 1)]
+    self.assertEqual(waits[:DEFAULT_BURST], [0] * DEFAULT_BURST)
+    self.assertAlmostEqual(waits[-1], 1 / DEFAULT_RATE)
+
+  def test_by_type(self):
+    limiter = RateLimiter(rate = 1.0, burst = 1,
+                          limits = {mumble_pb2.UserState: (10.0, 2)})
+    self.assertEqual(limiter.reserve(mumble_pb2.TextMessage, 100.0), 0)
+    # A flood of text messages doesn't hold back the moves.
+    self.assertAlmostEqual(limiter.reserve(mumble_pb2.TextMessage, 100.0), 1.0)
+    self.assertEqual(limiter.reserve(mumble_pb2.UserState, 100.0), 0)
+    self.assertEqual(limiter.reserve(mumble_pb2.UserState, 100.0), 0)
+    self.assertAlmostEqual(limiter.reserve(mumble_pb2.UserState, 100.0), 0.1)
+
+  def test_stats(self):
+    limiter = RateLimiter(rate = 1.0, burst = 1)
+    for _ in range(3):
+      limiter.reserve(mumble_pb2.TextMessage, 100.0)
+    self.assertEqual(limiter.delayed, 2)
+    self.assertAlmostEqual(limiter.total_wait, 3.0)
+    self.assertAlmostEqual(limiter.max_wait, 2.0)
+
+  def test_configure(self):
+    limiter = RateLimiter(rate = 1.0, burst = 1,
+                          limits = {mumble_pb2.UserState: (1.0, 1)})
+    limiter.reserve(mumble_pb2.TextMessage, 100.0)
+    limiter.reserve(mumble_pb2.UserState, 100.0)
+    limiter.configure(4.0, 2)
+    # Existing buckets follow, except those with limits of their own.
+    self.assertAlmostEqual(limiter.reserve(mumble_pb2.TextMessage, 100.0),
+                           0.25)
+    self.assertAlmostEqual(limiter.reserve(mumble_pb2.UserState, 100.0), 1.0)
+    self.assertEqual(limiter.reserve(mumble_pb2.ChannelState, 100.0), 0)
+    self.assertEqual(limiter.reserve(mumble_pb2.ChannelState, 100.0), 0)
+
+  def test_hold(self):
+    limiter = RateLimiter()
+    self.assertEqual(limiter.take_held(), [])
+    limiter.hold([(101.0, 11, 'a'), (102.0, 11, 'b')])
+    limiter.hold([(101.5, 9, 'c')])
+    self.assertEqual(limiter.take_held(),
+                     [(101.0, 11, 'a'), (102.0, 11, 'b'), (101.5, 9, 'c')])
+    # Taken once.
+    self.assertEqual(limiter.take_held(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
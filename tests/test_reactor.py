@@ -0,0 +1,56 @@
+# Connections served by a Reactor, stopped while it dispatches their frames.
+
+import logging
+import threading
+import time
+import unittest
+
+import mumble
+from mumble import mumble_pb2
+from mumble.emulator import Emulator
+
+
+class _Errors(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self, logging.ERROR)
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+class ReactorTest(unittest.TestCase):
+  def setUp(self):
+    self.emulator = Emulator(users = 50, channels = 10, seed = 2)
+    self.emulator.start()
+    self.reactor = mumble.Reactor()
+    self.errors = _Errors()
+    logging.getLogger('mumble').addHandler(self.errors)
+
+  def tearDown(self):
+    logging.getLogger('mumble').removeHandler(self.errors)
+    self.reactor.stop()
+    self.reactor.join(5)
+    self.emulator.stop()
+
+  def test_stop_while_dispatching(self):
+    bot = mumble.Bot()
+    stopped = threading.Event()
+    # Stopped with the channels and users of the handshake still to come.
+    def stop(msg):
+      bot.stop()
+      stopped.set()
+    bot.subscribe(mumble_pb2.ChannelState, stop)
+    bot.start(self.emulator.server(), "-Bot-", reactor = self.reactor)
+    self.assertTrue(stopped.wait(5))
+    deadline = time.time() + 5
+    while len(self.reactor) and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(len(self.reactor), 0)
+    # The frames left aren't handled, with the connection of the bot gone.
+    self.assertEqual(self.errors.records, [])
+    self.assertEqual(bot.users(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
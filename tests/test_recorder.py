@@ -0,0 +1,157 @@
+# Ogg Opus files written by the recorder: pages, checksums and granule
+# positions.
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from mumble import protocol
+from mumble.player import read_ogg_opus
+from mumble.recorder import (PRE_SKIP, OggOpusWriter, VoiceRecorder, ogg_crc,
+                             opus_samples)
+
+_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+
+# CELT fullband, mono, one frame of 20 and 10 ms.
+_TOC_20MS = chr(31 << 3)
+_TOC_10MS = chr(30 << 3)
+
+# The pages of an Ogg file, as (flags, granule position, sequence number,
+# lacing values, body), checking their CRC.
+def read_pages(path, test):
+  with open(path, 'rb') as fin:
+    data = fin.read()
+  pages = []
+  pos = 0
+  serials = set()
+  while pos < len(data):
+    (capture, version, flags, granule, serial, sequence, crc,
+     segments) = _PAGE_HEADER.unpack_from(data, pos)
+    test.assertEqual((capture, version), ('OggS', 0))
+    header_end = pos + _PAGE_HEADER.size + segments
+    lacing = bytearray(data[pos + _PAGE_HEADER.size:header_end])
+    end = header_end + sum(lacing)
+    page = data[pos:end]
+    test.assertEqual(crc, ogg_crc(page[:22] + '\0' * 4 + page[26:]))
+    serials.add(serial)
+    pages.append((flags, granule, sequence, list(lacing),
+                  data[header_end:end]))
+    pos = end
+  test.assertEqual(len(serials), 1)
+  return pages
+
+
+class OggTest(unittest.TestCase):
+  def test_crc(self):
+    # Check value of CRC-32/OGG.
+    self.assertEqual(ogg_crc('123456789'), 0x89A1897F)
+    self.assertEqual(ogg_crc(''), 0)
+
+  def test_opus_samples(self):
+    self.assertEqual(opus_samples(_TOC_20MS + 'x'), 960)
+    self.assertEqual(opus_samples(_TOC_10MS), 480)
+    # SILK 60 ms.
+    self.assertEqual(opus_samples(chr(3 << 3)), 2880)
+    # Two frames, then an arbitrary number of them.
+    self.assertEqual(opus_samples(chr(31 << 3 | 1) + 'xx'), 1920)
+    self.assertEqual(opus_samples(chr(31 << 3 | 3) + chr(3) + 'xxx'), 2880)
+
+
+class OggOpusWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'test.opus')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_headers(self):
+    writer = OggOpusWriter(self.path, channels = 2, comments = [u'TITLE=\xe9'])
+    writer.close()
+    pages = read_pages(self.path, self)
+    head, tags = pages[0], pages[1]
+    self.assertEqual(head[:3], (0x02, 0, 0))
+    self.assertEqual(struct.unpack('<8sBBHIhB', head[4]),
+                     ('OpusHead', 1, 2, PRE_SKIP, 48000, 0, 0))
+    self.assertEqual(tags[:3], (0, 0, 1))
+    self.assertTrue(tags[4].startswith('OpusTags'))
+    self.assertTrue(tags[4].endswith(u'TITLE=\xe9'.encode('utf-8')))
+    # Without audio, padded with silence up to the pre-skip.
+    self.assertEqual(pages[-1][0], 0x04)
+    self.assertTrue(pages[-1][1] >= PRE_SKIP)
+
+  def test_pages(self):
+    writer = OggOpusWriter(self.path, page_duration = 0.1)
+    packets = [_TOC_20MS + chr(i) * (i * 10) for i in range(1, 31)]
+    for packet in packets:
+      writer.write(packet, 960)
+    writer.close()
+    pages = read_pages(self.path, self)
+    self.assertEqual([p[2] for p in pages], range(len(pages)))
+    audio = pages[2:]
+    # 100 ms of audio per page. The last one was full: an empty page ends
+    # the stream.
+    self.assertEqual([p[1] for p in audio],
+                     range(4800, 30 * 960 + 1, 4800) + [30 * 960])
+    self.assertEqual([p[0] for p in audio], [0] * 6 + [0x04])
+    self.assertEqual(audio[-1][3], [])
+    # Packets of 255 bytes or more take several lacing values.
+    self.assertEqual(audio[-2][3][-2:], [255, 301 - 255])
+    self.assertEqual(list(read_ogg_opus(self.path)), packets)
+
+  def test_full_page(self):
+    # A page holds 255 lacing values at most.
+    writer = OggOpusWriter(self.path, page_duration = 60.0)
+    for i in range(300):
+      writer.write(_TOC_10MS, 480)
+    writer.close()
+    pages = read_pages(self.path, self)
+    self.assertEqual([len(p[3]) for p in pages[2:]], [255, 45])
+    self.assertEqual([p[1] for p in pages[2:]], [255 * 480, 300 * 480])
+    self.assertEqual(len(list(read_ogg_opus(self.path))), 300)
+
+
+class VoiceRecorderTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.recorder = VoiceRecorder(self.directory)
+
+  def tearDown(self):
+    self.recorder.close()
+    shutil.rmtree(self.directory)
+
+  def test_gaps(self):
+    r = self.recorder
+    # Sequence numbers count 10 ms: a packet of 20 ms every 2 of them.
+    for sequence in (0, 2, 4, 10, 12):
+      r.record(7, sequence, protocol.VOICE_OPUS, [_TOC_20MS + 'voice'],
+               name = 'Bob', now = 100.0 + sequence * 0.01)
+    # Late: its place is gone.
+    r.record(7, 6, protocol.VOICE_OPUS, [_TOC_20MS + 'late'], now = 100.15)
+    # Other codecs are skipped, and so is the end of the transmission.
+    r.record(7, 14, protocol.VOICE_CELT_ALPHA, ['celt'], now = 100.14)
+    r.record(7, 14, protocol.VOICE_OPUS, [''], now = 100.14)
+    path = r.paths()[7]
+    self.assertTrue(path.endswith('-Bob-7.opus'))
+    r.close()
+    packets = list(read_ogg_opus(path))
+    # The 40 ms lost are filled with silence.
+    self.assertEqual(packets, [_TOC_20MS + 'voice'] * 3 + [_TOC_20MS] * 2 +
+                              [_TOC_20MS + 'voice'] * 2)
+    self.assertEqual(read_pages(path, self)[-1][1], 14 * 480)
+    self.assertEqual((r.packets, r.skipped), (5, 1))
+
+  def test_expire(self):
+    r = self.recorder
+    r.record(1, 0, protocol.VOICE_OPUS, [_TOC_20MS + 'a'], now = 100.0)
+    r.record(2, 0, protocol.VOICE_OPUS, [_TOC_20MS + 'b'], now = 150.0)
+    r.flush(now = 155.0)
+    self.assertEqual(sorted(r.paths()), [1, 2])
+    r.flush(now = 101.0 + r.expire)
+    self.assertEqual(sorted(r.paths()), [2])
+
+
+if __name__ == '__main__':
+  unittest.main()
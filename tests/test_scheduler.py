@@ -0,0 +1,101 @@
+# Timers of the Scheduler run by the loops of the connections.
+
+import logging
+import time
+import unittest
+
+from mumble.scheduler import Scheduler
+
+
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    self.wakes = 0
+    self.scheduler = Scheduler(wake = self.wake)
+    self.calls = []
+
+  def wake(self):
+    self.wakes += 1
+
+  def test_order(self):
+    s = self.scheduler
+    s.call_at(102.0, self.calls.append, 'c')
+    s.call_at(100.0, self.calls.append, 'a')
+    s.call_at(101.0, self.calls.append, 'b1')
+    # Same time: in the order added.
+    s.call_at(101.0, self.calls.append, 'b2')
+    s.run_due(101.5)
+    self.assertEqual(self.calls, ['a', 'b1', 'b2'])
+    s.run_due(102.0)
+    self.assertEqual(self.calls, ['a', 'b1', 'b2', 'c'])
+    self.assertEqual(len(s), 0)
+
+  def test_timeout(self):
+    s = self.scheduler
+    self.assertEqual(s.timeout(100.0), None)
+    self.assertEqual(s.next_due(), None)
+    s.call_at(105.0, self.calls.append, 'a')
+    s.call_at(103.0, self.calls.append, 'b')
+    self.assertEqual(s.next_due(), 103.0)
+    self.assertEqual(s.timeout(100.0), 3.0)
+    # Overdue.
+    self.assertEqual(s.timeout(104.0), 0)
+
+  def test_cancel(self):
+    s = self.scheduler
+    first = s.call_at(100.0, self.calls.append, 'a')
+    s.call_at(101.0, self.calls.append, 'b')
+    first.cancel()
+    self.assertEqual(len(s), 1)
+    self.assertEqual(s.next_due(), 101.0)
+    s.run_due(200.0)
+    self.assertEqual(self.calls, ['b'])
+
+  def test_call_every(self):
+    s = self.scheduler
+    start = time.time()
+    timer = s.call_every(10.0, self.calls.append, 'tick')
+    self.assertAlmostEqual(timer.when, start + 10.0, delta = 1.0)
+    first = timer.when
+    s.run_due(first)
+    self.assertEqual(self.calls, ['tick'])
+    # On the original pace, even when run a bit late.
+    self.assertEqual(timer.when, first + 10.0)
+    s.run_due(first + 12.0)
+    self.assertEqual(timer.when, first + 20.0)
+    self.assertEqual(len(self.calls), 2)
+    # Far behind: a single call, then the pace starts over from now.
+    s.run_due(first + 100.0)
+    self.assertEqual(len(self.calls), 3)
+    self.assertEqual(timer.when, first + 110.0)
+    timer.cancel()
+    s.run_due(first + 1000.0)
+    self.assertEqual(len(self.calls), 3)
+    self.assertEqual(len(s), 0)
+
+  def test_wake(self):
+    s = self.scheduler
+    s.call_at(100.0, self.calls.append, 'a')
+    self.assertEqual(self.wakes, 1)
+    # Not the first one due: the loop's timeout is still right.
+    s.call_at(101.0, self.calls.append, 'b')
+    self.assertEqual(self.wakes, 1)
+    s.call_at(99.0, self.calls.append, 'c')
+    self.assertEqual(self.wakes, 2)
+
+  def test_error(self):
+    s = self.scheduler
+    def fail():
+      raise ValueError("Oops.")
+    s.call_at(100.0, fail)
+    s.call_at(101.0, self.calls.append, 'a')
+    logger = logging.getLogger('mumble.scheduler')
+    logger.disabled = True
+    try:
+      s.run_due(102.0)
+    finally:
+      logger.disabled = False
+    self.assertEqual(self.calls, ['a'])
+
+
+if __name__ == '__main__':
+  unittest.main()
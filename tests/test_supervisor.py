@@ -0,0 +1,110 @@
+# Workers of the supervisor outliving their server.
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from mumble import supervisor
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port():
+  s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  s.bind(('127.0.0.1', 0))
+  port = s.getsockname()[1]
+  s.close()
+  return port
+
+# Wait until condition() is true, or fail after timeout seconds.
+def _wait_for(condition, timeout = 20.0):
+  deadline = time.time() + timeout
+  while not condition():
+    if time.time() > deadline:
+      raise AssertionError("Timed out.")
+    time.sleep(0.05)
+
+
+class SupervisorTest(unittest.TestCase):
+  def setUp(self):
+    self.port = _free_port()
+    self.emulator = None
+    self.supervisor = supervisor.Supervisor(
+        [{"bot": "mumble.Bot", "server": "127.0.0.1:%d" % self.port,
+          "nickname": "-Bot-"}],
+        workers = 1, report_interval = 0.2, restart_delay = 0.2)
+    self.thread = None
+
+  def tearDown(self):
+    self.supervisor.stop()
+    if self.thread is not None:
+      self.thread.join(5)
+    self.kill_server()
+
+  # The emulator runs in a process of its own, so that killing it really
+  # closes its port.
+  def start_server(self):
+    self.emulator = subprocess.Popen(
+        [sys.executable, '-m', 'mumble.emulator', '--tls', '-u', '0',
+         '-p', str(self.port)], cwd = _ROOT,
+        stdout = open(os.devnull, 'w'), stderr = subprocess.STDOUT)
+    def listening():
+      s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      try:
+        return s.connect_ex(('127.0.0.1', self.port)) == 0
+      finally:
+        s.close()
+    _wait_for(listening)
+
+  def kill_server(self):
+    if self.emulator is not None:
+      self.emulator.kill()
+      self.emulator.wait()
+      self.emulator = None
+
+  def run_supervisor(self):
+    self.thread = threading.Thread(target = self.supervisor.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  # The connections of the last report, or None.
+  def connections(self):
+    load = self.supervisor.load[0]
+    return None if load is None else load['connections']
+
+  def test_server_killed(self):
+    self.start_server()
+    self.run_supervisor()
+    _wait_for(lambda: self.connections() == 1)
+    pid = self.supervisor.load[0]['pid']
+    self.kill_server()
+    _wait_for(lambda: self.connections() == 0)
+    # The worker waits for the server to come back.
+    time.sleep(1.0)
+    self.assertTrue(self.supervisor.processes[0].is_alive())
+    self.start_server()
+    _wait_for(lambda: self.connections() == 1)
+    self.assertEqual(self.supervisor.load[0]['pid'], pid)
+    self.assertEqual(self.supervisor.restarts, [0])
+
+  def test_worker_without_reconnections(self):
+    # Once its bots are gone for good, the worker exits with an error, and
+    # is restarted.
+    self.supervisor.shards[0][0]['reconnect'] = False
+    self.start_server()
+    self.run_supervisor()
+    _wait_for(lambda: self.connections() == 1)
+    pid = self.supervisor.load[0]['pid']
+    self.kill_server()
+    self.start_server()
+    _wait_for(lambda: self.supervisor.restarts == [1])
+    _wait_for(lambda: self.supervisor.load[0]['pid'] != pid and
+                      self.connections() == 1)
+
+
+if __name__ == '__main__':
+  unittest.main()